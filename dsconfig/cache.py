@@ -0,0 +1,175 @@
+"""
+A local, on disk cache of DB snapshots.
+
+Dumping the relevant parts of a large Tango DB takes time, and often
+nothing has changed since the last time. The cache stores the result
+of each dump together with a "stamp"; a few aggregate values (row
+counts, latest modification dates and a checksum of the device table)
+that are cheap to get with a single query. If the stamp is unchanged
+the cached snapshot is used, otherwise the DB is dumped again.
+
+The snapshots are stored per TANGO_HOST and "scope", where the scope
+is anything (JSON serializable) that identifies what was dumped.
+
+The PlanCache similarly stores the plans (DB calls) computed for a
+config, keyed by digests of the config, the DB data it was compared
+with and the configure() flags. The oldest plans are removed when the
+cache grows too big.
+"""
+
+import hashlib
+import json
+import os
+from tempfile import NamedTemporaryFile, mkstemp
+
+import tango
+
+from .digest import get_digest
+from .plan import save_plan, load_plan
+
+CACHE_DIR = os.environ.get(
+    "DSCONFIG_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "dsconfig"))
+
+# Max total size of the cached plans, in bytes
+PLAN_CACHE_SIZE = int(os.environ.get("DSCONFIG_PLAN_CACHE_SIZE", 100000000))
+
+# Aliases and device moves don't update any dates, so the device
+# table is checksummed instead.
+STAMP_QUERY = (
+    "SELECT NOW(),"
+    " (SELECT COUNT(*) FROM device),"
+    " (SELECT SUM(CRC32(CONCAT_WS('|', name, server, class,"
+    " IFNULL(alias, '')))) FROM device),"
+    " (SELECT COUNT(*) FROM property_device),"
+    " (SELECT MAX(date) FROM property_device),"
+    " (SELECT COUNT(*) FROM property_attribute_device),"
+    " (SELECT MAX(date) FROM property_attribute_device),"
+    " (SELECT COUNT(*) FROM property_class),"
+    " (SELECT MAX(date) FROM property_class),"
+    " (SELECT COUNT(*) FROM property_attribute_class),"
+    " (SELECT MAX(date) FROM property_attribute_class)")
+
+
+def get_db_stamp(dbproxy):
+    """
+    Get a list of values that changes whenever the DB configuration
+    changes. The first value is the current time of the DB.
+    """
+    _, result = dbproxy.command_inout("DbMySqlSelect", STAMP_QUERY)
+    return list(result)
+
+
+def is_settled(stamp):
+    """
+    The dates in the DB only have a resolution of one second, so a change
+    made in the same second as the stamp was taken might go unnoticed.
+    Such stamps should not be trusted.
+    """
+    now, dates = stamp[0], stamp[4::2]
+    return all(date < now for date in dates)
+
+
+class SnapshotCache(object):
+
+    def __init__(self, db, directory=CACHE_DIR, dbproxy=None):
+        self.host = "%s:%s" % (db.get_db_host(), db.get_db_port())
+        self.directory = directory
+        self.dbproxy = dbproxy or tango.DeviceProxy(db.dev_name())
+
+    def path(self, scope):
+        key = json.dumps([self.host, scope], sort_keys=True)
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, "snapshot-%s.json" % digest)
+
+    def get(self, scope, fetch):
+        """
+        Return the snapshot for the given scope. If there is no cached
+        snapshot, or the DB has changed since it was stored, 'fetch' is
+        called to get a new one, which is then stored.
+        """
+        stamp = get_db_stamp(self.dbproxy)
+        path = self.path(scope)
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+            if cached["stamp"][1:] == stamp[1:]:
+                return cached["data"]
+        except (IOError, ValueError, KeyError):
+            pass  # no usable snapshot
+
+        # Note that the stamp was taken *before* fetching the data, so
+        # anything changed meanwhile will cause a refetch next time.
+        data = fetch()
+        if is_settled(stamp):
+            self.store(path, stamp, data)
+        return data
+
+    def store(self, path, stamp, data):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # write to a temporary file first, so that a concurrent run
+        # never sees a half written snapshot
+        with NamedTemporaryFile("w", dir=self.directory, suffix=".tmp",
+                                delete=False) as f:
+            json.dump({"stamp": stamp, "data": data}, f)
+        os.replace(f.name, path)
+
+
+class PlanCache(object):
+
+    def __init__(self, directory=CACHE_DIR, max_size=PLAN_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, data, dbdata, **flags):
+        """
+        The key for the plan for configuring 'data', given 'dbdata'
+        and the flags to configure().
+        """
+        return get_digest([get_digest(data), get_digest(dbdata), flags])
+
+    def path(self, key):
+        return os.path.join(self.directory, "plan-%s.json.gz" % key)
+
+    def get(self, key, compute):
+        """
+        Return the plan stored with the given key. If there is none,
+        'compute' is called to make it, and it is stored.
+        """
+        path = self.path(key)
+        try:
+            plan = load_plan(path)
+            os.utime(path, None)  # recently used
+            return plan
+        except (IOError, ValueError, KeyError):
+            pass  # no usable plan
+        plan = compute()
+        self.store(path, plan)
+        return plan
+
+    def store(self, path, plan):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, tmp_path = mkstemp(dir=self.directory, suffix=".tmp.json.gz")
+        os.close(fd)
+        save_plan(plan, tmp_path)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        "Remove the least recently used plans, until under the max size"
+        plans = []
+        for name in os.listdir(self.directory):
+            if name.startswith("plan-"):
+                stat = os.stat(os.path.join(self.directory, name))
+                plans.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in plans)
+        for _, size, name in sorted(plans):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass  # e.g. removed by a concurrent run
+            total -= size
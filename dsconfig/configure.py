@@ -3,11 +3,13 @@ Functionality for configuring a Tango DB from a dsconfig file
 """
 
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 
 import tango
 
-from .appending_dict.caseless import CaselessDictionary
+from .digest import get_digests, same_digest
+from .plan import Call, Plan, encode_call, decode_call
 from .tangodb import SPECIAL_ATTRIBUTE_PROPERTIES, is_protected
 from .utils import ObjectWrapper
 
@@ -20,6 +22,31 @@ def check_attribute_property(propname):
     return True
 
 
+def lower_keys(d):
+    """
+    A plain dict with the keys of d in lowercase, for quick caseless
+    lookups. Like with a CaselessDictionary, the last value wins if
+    there are keys that only differ in case.
+    """
+    return dict((key.lower(), value) for key, value in d.items())
+
+
+def caseless_items(d):
+    """
+    The items of d, merging keys that only differ in case the same
+    way a CaselessDictionary does (first key, last value).
+    """
+    items = {}
+    for key, value in d.items():
+        first_key = items.get(key.lower(), (key,))[0]
+        items[key.lower()] = (first_key, value)
+    return list(items.values())
+
+
+def _same(d):
+    return d
+
+
 def update_properties(db, parent, db_props, new_props,
                       attribute=False, cls=False,
                       delete=True, ignore_case=False, strict_attr_props=True):
@@ -29,46 +56,50 @@ def update_properties(db, parent, db_props, new_props,
 
     'parent' is the name of the containing device or class.
     """
+    # Index the names once, instead of building caseless dicts in the
+    # loops; with ignore_case all names are looked up in lowercase.
     if ignore_case:
-        caseless_db_props = CaselessDictionary(db_props)
-        caseless_new_props = CaselessDictionary(new_props)
+        fold = str.lower
+        index = lower_keys
     else:
-        caseless_db_props = db_props
-        caseless_new_props = new_props
+        fold = index = _same
+    db_index = index(db_props)
+    new_index = index(new_props)
+
     # Figure out what's going to be added/changed or removed
     if attribute:
+        db_attr_index = dict((attr, index(props))
+                             for attr, props in db_index.items())
+        new_attr_index = dict((attr, index(props))
+                              for attr, props in new_props.items())
         added_props = defaultdict(dict)
         # For attribute properties we need to go one step deeper into
         # the dict, since each attribute can have several properties.
         # A little messy, but at least it's consistent.
         for attr, props in list(new_props.items()):
+            db_attr_props = db_attr_index.get(fold(attr), {})
             for prop, value in list(props.items()):
-                if ignore_case:
-                    orig = CaselessDictionary(caseless_db_props.get(attr, {})).get(prop)
-                else:
-                    orig = caseless_db_props.get(attr, {}).get(prop)
+                orig = db_attr_props.get(fold(prop))
                 if value and value != orig and (not strict_attr_props
                                                 or check_attribute_property(prop)):
                     added_props[attr][prop] = value
         removed_props = defaultdict(dict)
         for attr, props in list(db_props.items()):
+            new_attr_props = new_attr_index.get(attr, {})
             for prop in props:
-                if ignore_case:
-                    new = CaselessDictionary(new_props.get(attr, {})).get(prop)
-                else:
-                    new = new_props.get(attr, {}).get(prop)
+                new = new_attr_props.get(fold(prop))
                 if (new is None and not is_protected(prop, True)) or new == []:
                     # empty list forces removal of "protected" properties
                     removed_props[attr][prop] = value
     else:
         added_props = {}
         for prop, value in list(new_props.items()):
-            old_value = caseless_db_props.get(prop, [])
+            old_value = db_index.get(fold(prop), [])
             if value and value != old_value:
                 added_props[prop] = value
         removed_props = {}
         for prop, value in list(db_props.items()):
-            new_value = caseless_new_props.get(prop)
+            new_value = new_index.get(fold(prop))
             if (new_value is None and not is_protected(prop)) or new_value == []:
                 # empty list forces removal of "protected" properties
                 removed_props[prop] = value
@@ -91,40 +122,56 @@ def update_properties(db, parent, db_props, new_props,
 
 def update_server(db, server_name, server_dict, db_dict,
                   update=False, ignore_case=False,
-                  difactory=tango.DbDevInfo, strict_attr_props=True):
+                  difactory=tango.DbDevInfo, strict_attr_props=True,
+                  digests=None, db_digests=None):
     """
     Creates/removes devices for a given server. Optionally
     ignores removed devices, only adding new and updating old ones.
+    Classes and devices whose digests (see dsconfig.digest) are the
+    same in the server_dict and db_dict are skipped.
     """
 
+    # With ignore_case, names are looked up in lowercase indexes
     if ignore_case:
-        db_dict = CaselessDictionary(db_dict)
+        fold = str.lower
+        db_dict = lower_keys(db_dict)
+    else:
+        fold = _same
+
+    added_devices = removed_devices = []
 
     for class_name, cls in list(server_dict.items()):  # classes
+        db_devices = db_dict.get(fold(class_name), {})
         if ignore_case:
-            cls = CaselessDictionary(cls)
-        removed_devices = [dev for dev in db_dict.get(class_name, {})
-                           if dev not in cls
+            added_devices = caseless_items(cls)
+            devs = lower_keys(db_devices)
+        else:
+            added_devices = list(cls.items())
+            devs = db_devices
+        if same_digest(digests, db_digests, (server_name, fold(class_name))):
+            removed_devices = []
+            continue  # nothing to do for this class
+        new_devices = set(fold(name) for name, _ in added_devices)
+        removed_devices = [dev for dev in db_devices
+                           if fold(dev) not in new_devices
                            # never remove dservers
                            and not class_name.lower() == "dserver"]
-        added_devices = list(cls.items())
         if not update:
             for device_name in removed_devices:
                 db.delete_device(device_name)
 
         for device_name, dev in added_devices:
-            if ignore_case:
-                devs = CaselessDictionary(db_dict.get(class_name, {}))
-            else:
-                devs = db_dict.get(class_name, {})
-            if device_name not in devs:
+            if same_digest(digests, db_digests,
+                           (server_name, fold(class_name), fold(device_name))):
+                continue
+            if fold(device_name) not in devs:
                 devinfo = difactory()
                 devinfo.server = server_name
                 devinfo._class = class_name
                 devinfo.name = device_name
                 db.add_device(devinfo)
 
-            update_device(db, device_name, devs.get(device_name, {}),
+            update_device(db, device_name, devs.get(fold(device_name), {}),
                           dev, update=update, ignore_case=ignore_case,
                           strict_attr_props=strict_attr_props)
 
@@ -169,35 +216,174 @@ update_device = partial(update_device_or_class, cls=False)
 update_class = partial(update_device_or_class, cls=True)
 
 
-def configure(data, dbdata, update=False, ignore_case=False,
-              strict_attr_props=True):
-    """
-    Takes an input data dict and the relevant current DB data.  Returns
-    the DB calls needed to bring the Tango DB to the state described
-    by 'data'.  The 'update' flag means that servers/devices are not
-    removed, only added or changed. If the 'ignore_case' flag is True,
-    the names of servers, devices and properties will be treated as
-    caseless.
-
-    Note: This function does *not* itself modify the Tango DB. It passes a
-    "fake" database object around that just records what the various other
-    functions do to it, and then returns the list of calls made.
-    """
+def _unit_digests(digests, instance, class_key, device_keys):
+    "The digests needed for configuring one class in a server instance"
+    keys = [(instance, class_key)]
+    keys.extend((instance, class_key, device) for device in device_keys)
+    return dict((key, digests.get(key)) for key in keys)
 
-    db = ObjectWrapper()
 
+def get_server_units(data, dbdata, ignore_case=False, digests=None,
+                     db_digests=None):
+    """
+    Split the servers part of the config into units of work that can
+    be configured independently; one per class in each server instance.
+    Yields (instance, class name, devices, DB devices, digests, DB
+    digests), skipping any units (or whole instances) that have the
+    same digests in the DB.
+    """
+    fold = str.lower if ignore_case else _same
     for servername, serverdata in list(data.get("servers", {}).items()):
         for instname, instdata in list(serverdata.items()):
+            instance = "%s/%s" % (servername, instname)
+            if same_digest(digests, db_digests, (instance,)):
+                continue
             dbinstdata = (dbdata.get("servers", {})
                           .get(servername, {})
                           .get(instname, {}))
-            added, removed = update_server(
-                db, "%s/%s" % (servername, instname),
-                instdata, dbinstdata, update, ignore_case,
-                strict_attr_props=strict_attr_props)
+            if ignore_case:
+                dbinstdata = lower_keys(dbinstdata)
+            for class_name, cls in list(instdata.items()):
+                class_key = fold(class_name)
+                if same_digest(digests, db_digests, (instance, class_key)):
+                    continue
+                device_keys = [fold(device) for device in cls]
+                yield (instance, class_name, cls,
+                       dbinstdata.get(class_key, {}),
+                       _unit_digests(digests or {}, instance, class_key,
+                                     device_keys),
+                       _unit_digests(db_digests or {}, instance, class_key,
+                                     device_keys))
+
+
+def configure_units(units, update=False, ignore_case=False,
+                    strict_attr_props=True):
+    """
+    Configure some units from get_server_units. Returns the DB calls,
+    encoded, since this runs in a worker process and DbDevInfo objects
+    can't be sent back.
+    """
+    db = ObjectWrapper()
+    for instance, class_name, cls, db_cls, digests, db_digests in units:
+        update_server(db, instance, {class_name: cls}, {class_name: db_cls},
+                      update, ignore_case,
+                      strict_attr_props=strict_attr_props,
+                      digests=digests, db_digests=db_digests)
+    return [encode_call(*call) for call in db.calls]
 
+
+def iter_class_calls(data, dbdata, update=False):
+    "Yields the DB calls needed for the classes part of the config"
     for classname, classdata in list(data.get("classes", {}).items()):
+        db = ObjectWrapper()
         dbclassdata = dbdata.get("classes", {}).get(classname, {})
         update_class(db, classname, dbclassdata, classdata, update=update)
+        for call in db.calls:
+            yield Call(*call)
+
 
-    return db.calls
+def iter_configure(data, dbdata, update=False, ignore_case=False,
+                   strict_attr_props=True, digests=None, db_digests=None):
+    """
+    Like configure(), but yields the DB calls as soon as they have
+    been worked out for each server instance. Unless given, the digests
+    are also computed per server instance, so the first calls come
+    quickly even for a large config.
+    """
+    for servername, serverdata in list(data.get("servers", {}).items()):
+        for instname, instdata in list(serverdata.items()):
+            instance = "%s/%s" % (servername, instname)
+            dbinstdata = (dbdata.get("servers", {})
+                          .get(servername, {})
+                          .get(instname, {}))
+            inst_digests, inst_db_digests = digests, db_digests
+            if digests is None:
+                inst_digests = get_digests({servername: {instname: instdata}},
+                                           ignore_case)
+            if db_digests is None:
+                inst_db_digests = get_digests(
+                    {servername: {instname: dbinstdata}}, ignore_case,
+                    scope={servername: {instname: instdata}})
+            if same_digest(inst_digests, inst_db_digests, (instance,)):
+                continue  # nothing changed in this server instance
+            db = ObjectWrapper()
+            update_server(db, instance, instdata, dbinstdata, update,
+                          ignore_case, strict_attr_props=strict_attr_props,
+                          digests=inst_digests, db_digests=inst_db_digests)
+            for call in db.calls:
+                yield Call(*call)
+
+    for call in iter_class_calls(data, dbdata, update):
+        yield call
+
+
+def configure(data, dbdata, update=False, ignore_case=False,
+              strict_attr_props=True, digests=None, db_digests=None, jobs=1):
+    """
+    Takes an input data dict and the relevant current DB data.  Returns
+    a Plan of the DB calls needed to bring the Tango DB to the state
+    described by 'data'.  The 'update' flag means that servers/devices are not
+    removed, only added or changed. If the 'ignore_case' flag is True,
+    the names of servers, devices and properties will be treated as
+    caseless.
+
+    Server instances, classes and devices that have the same content
+    digests in 'data' and 'dbdata' are skipped. The digests can be
+    given, if they are already known (see dsconfig.digest.get_digests;
+    those of 'dbdata' should have the servers of 'data' as scope).
+
+    With 'jobs' > 1, the classes of the servers are configured in that
+    many processes. The result is the same, in the same order.
+
+    Note: This function does *not* itself modify the Tango DB. It passes a
+    "fake" database object around that just records what the various other
+    functions do to it, and then returns the list of calls made.
+    """
+
+    if jobs <= 1:
+        return Plan(iter_configure(data, dbdata, update, ignore_case,
+                                   strict_attr_props, digests, db_digests))
+
+    if digests is None:
+        digests = get_digests(data.get("servers", {}), ignore_case)
+    if db_digests is None:
+        db_digests = get_digests(dbdata.get("servers", {}), ignore_case,
+                                 scope=data.get("servers", {}))
+
+    calls = []
+    units = list(get_server_units(data, dbdata, ignore_case,
+                                  digests, db_digests))
+    # A few chunks per process, to even out the load
+    size = max(1, -(-len(units) // (jobs * 4)))
+    chunks = [units[i:i + size] for i in range(0, len(units), size)]
+    with ProcessPoolExecutor(jobs) as executor:
+        results = executor.map(
+            partial(configure_units, update=update, ignore_case=ignore_case,
+                    strict_attr_props=strict_attr_props),
+            chunks)
+        for unit_calls in results:
+            calls.extend(decode_call(call) for call in unit_calls)
+    calls.extend(iter_class_calls(data, dbdata, update))
+    return Plan(calls)
+
+
+def has_changes(data, dbdata, update=False, ignore_case=False,
+                strict_attr_props=True, digests=None, db_digests=None):
+    """
+    Check if configure() would come up with any DB calls, without
+    working them all out. Server instances and classes are checked
+    one at a time, skipping the ones with the same digests, and we
+    stop at the first difference.
+    """
+    if digests is None:
+        digests = get_digests(data.get("servers", {}), ignore_case)
+    if db_digests is None:
+        db_digests = get_digests(dbdata.get("servers", {}), ignore_case,
+                                 scope=data.get("servers", {}))
+
+    for unit in get_server_units(data, dbdata, ignore_case,
+                                 digests, db_digests):
+        if configure_units([unit], update, ignore_case, strict_attr_props):
+            return True
+
+    return any(True for _ in iter_class_calls(data, dbdata, update))
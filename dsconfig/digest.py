@@ -0,0 +1,164 @@
+"""
+Content digests of config data, for quickly finding out which parts
+of a config are already the same in the DB.
+
+The digests form a tree: the digest of a server instance is made from
+the digests of its classes, which are made from those of their
+devices. If the digests of two subtrees are equal, so is their
+content, and there is no need to compare them any further.
+
+With ignore_case, names (of classes, devices, properties...) are
+lowercased first. A digest is None where the data can't be compared
+this way, e.g. if there are empty property values (which mean "remove"
+in a config) or names that only differ in case.
+
+get_entity_digests() instead gives a digest of the state of single
+devices and classes in DB data (including e.g. which server a device
+is in), to find out if they have been changed by someone else.
+"""
+
+import hashlib
+import json
+
+
+def get_digest(value):
+    "The digest of anything JSON serializable"
+    text = json.dumps(value, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _fold_keys(d, ignore_case):
+    if not ignore_case:
+        return d
+    result = {}
+    for key, value in d.items():
+        if key.lower() in result:
+            raise ValueError("Ambiguous name: %s" % key)
+        result[key.lower()] = value
+    return result
+
+
+def _normalize_properties(props, ignore_case, attribute=False):
+    if not isinstance(props, dict):
+        raise ValueError("Bad properties: %r" % (props,))
+    props = _fold_keys(props, ignore_case)
+    if attribute:
+        return dict((attr, _normalize_properties(attr_props, ignore_case))
+                    for attr, attr_props in props.items())
+    if not all(props.values()):
+        raise ValueError("Empty property value")
+    return props
+
+
+def device_digest(device, ignore_case=False):
+    """
+    The digest of the data for a device (or class); only the parts
+    that configure() looks at.
+    """
+    data = {}
+    try:
+        if "properties" in device:
+            data["properties"] = _normalize_properties(
+                device["properties"], ignore_case)
+        if "attribute_properties" in device:
+            data["attribute_properties"] = _normalize_properties(
+                device["attribute_properties"], ignore_case, attribute=True)
+    except ValueError:
+        return None
+    if "alias" in device:
+        data["alias"] = device["alias"]
+    return get_digest(data)
+
+
+def combine(digests):
+    "The digest of a dict of name: digest, or None if any is None"
+    if any(digest is None for digest in digests.values()):
+        return None
+    return get_digest(digests)
+
+
+def _add(digests, key, digest):
+    # Names that collide can't be compared by digest
+    digests[key] = None if key in digests else digest
+
+
+def get_digests(servers, ignore_case=False, scope=None):
+    """
+    Compute the digests for a "servers" dict. Returns a flat dict,
+    with keys like (instance,), (instance, class) and (instance,
+    class, device), where instance is e.g. "TangoTest/1". With
+    ignore_case, the class and device names are lowercase.
+
+    configure() only looks at the classes that are in the config, so
+    for DB data the config's "servers" can be given as 'scope'. The
+    digest of each instance then only covers the classes that are in
+    the same instance in the scope (e.g. not the DServer class).
+    """
+    digests = {}
+    for server, instances in servers.items():
+        for instance, classes in instances.items():
+            name = "%s/%s" % (server, instance)
+            if scope is not None:
+                wanted = set(
+                    clss.lower() if ignore_case else clss
+                    for clss in scope.get(server, {}).get(instance, {}))
+            class_digests = {}
+            class_devices = {}
+            for clss, devices in classes.items():
+                key = clss.lower() if ignore_case else clss
+                device_digests = {}
+                for device, data in devices.items():
+                    _add(device_digests,
+                         device.lower() if ignore_case else device,
+                         device_digest(data, ignore_case))
+                _add(class_digests, key, combine(device_digests))
+                if key in class_devices:
+                    device_digests = dict.fromkeys(device_digests)
+                    device_digests.update(
+                        dict.fromkeys(class_devices[key]))
+                class_devices[key] = device_digests
+            if scope is None:
+                digests[(name,)] = combine(class_digests)
+            else:
+                digests[(name,)] = combine(dict(
+                    (clss, digest) for clss, digest in class_digests.items()
+                    if clss in wanted))
+            for clss, digest in class_digests.items():
+                digests[(name, clss)] = digest
+                for device, device_dig in class_devices[clss].items():
+                    digests[(name, clss, device)] = device_dig
+    return digests
+
+
+def same_digest(digests, other_digests, key):
+    "Check if the digests of something are known, and equal"
+    if digests is None or other_digests is None:
+        return False
+    digest = digests.get(key)
+    return digest is not None and digest == other_digests.get(key)
+
+
+def get_entity_digests(dbdata, keys):
+    """
+    The digests of the given devices and classes in DB data, as a dict
+    with the same keys. The keys are like those of get_call_keys, e.g.
+    ("device", "sys/tg_test/1"). Other kinds of keys are left out.
+    """
+    devices = {}
+    for server, instances in dbdata.get("servers", {}).items():
+        for instance, classes in instances.items():
+            for clss, devs in classes.items():
+                for name, device in devs.items():
+                    devices[name.lower()] = [
+                        ("%s/%s" % (server, instance)).lower(),
+                        clss.lower(), device_digest(device)]
+    classes = dict((name.lower(), clss)
+                   for name, clss in dbdata.get("classes", {}).items())
+    digests = {}
+    for kind, name in keys:
+        if kind == "device":
+            digests[(kind, name)] = get_digest(devices.get(name))
+        elif kind == "class":
+            digests[(kind, name)] = get_digest(
+                device_digest(classes.get(name, {})))
+    return digests
@@ -6,47 +6,270 @@ $ python -m dsconfig.dump server:TangoTest/1 > result.json
 $ python -m dsconfig.dump device:sys/tg_test/1 device:sys/tg_test/2
 ...
 
+For very large databases, the --page-size option reads the DB page by
+page and writes the JSON as it goes, using bounded memory.
+
+$ python -m dsconfig.dump --page-size 1000 > result.json
+
+With --since, only what has changed after an earlier (timestamped)
+dump is read, see dsconfig.history.
+
+$ python -m dsconfig.dump --since snapshot.json > new_snapshot.json
+
 """
 
+import json
+
 import tango
 
-from .appending_dict import SetterDict
-from .tangodb import get_servers_with_filters, get_classes_properties
+from .appending_dict import SetterDict, merge
+from .cache import SnapshotCache
+from .history import (get_db_data_since, get_db_time, format_report,
+                      TIMESTAMP_KEY)
+from .tangodb import (get_servers_with_filters, get_classes_properties,
+                      iter_servers_with_filters, get_servers_queries,
+                      servers_from_results, get_classes_queries,
+                      classes_from_results, get_devices_from_dict,
+                      quote_list, select_all, compile_patterns, ProxyPool,
+                      get_servers_from_server_cache, get_database)
 
 
-def get_db_data(db, patterns=None, class_properties=False, **options):
+def get_db_data(db, patterns=None, class_properties=False, pool=None,
+                **options):
     # dump TANGO database into JSON. Optionally filter which things to include
     # (currently only "positive" filters are possible; you can say which
     # servers/classes/devices to include, but you can't exclude selectively)
     # By default, dserver devices aren't included!
+    # All the patterns are combined into one condition, so that the DB
+    # is only queried once no matter how many patterns there are, and
+    # class properties are included for the classes of the matching
+    # devices.
+    # If a ProxyPool is given, all the queries are run concurrently.
+
+    if pool:
+        return get_db_data_concurrently(pool, patterns, class_properties,
+                                        **options)
 
     dbproxy = tango.DeviceProxy(db.dev_name())
     data = SetterDict()
 
-    if not patterns:
-        # the user did not specify a pattern, so we will dump *everything*
-        servers = get_servers_with_filters(
-            dbproxy, **options)
-        data.servers.update(servers)
-        if class_properties:
-            classes = get_classes_properties(dbproxy)
-            data.classes.update(classes)
+    # if the user did not specify a pattern, we will dump *everything*
+    where = compile_patterns(patterns) if patterns else None
+    servers = get_servers_with_filters(dbproxy, where=where, **options)
+    data.servers.update(servers)
+    if class_properties:
+        classes = get_classes_properties(dbproxy, where=where)
+        data.classes.update(classes)
+    return data.to_dict()
+
+
+def get_db_data_concurrently(pool, patterns=None, class_properties=False,
+                             aliases=True, uppercase_devices=False,
+                             **options):
+    """
+    Like get_db_data, but all the queries are sent at once, on separate
+    proxies from the pool, instead of one by one.
+    """
+
+    where = compile_patterns(patterns) if patterns else None
+    queries = get_servers_queries(where=where, **options)
+    if class_properties:
+        queries += get_classes_queries(where=where)
+
+    results = pool.select(queries)
+
+    data = SetterDict()
+    data.servers.update(servers_from_results(
+        results, aliases, uppercase_devices))
+    if class_properties:
+        data.classes.update(classes_from_results(results))
+    return data.to_dict()
+
+
+def get_config_scope(config):
+    """
+    The server instances, devices and classes that a config concerns,
+    as sorted lists.
+    """
+    servers = config.get("servers", {})
+    instances = sorted(set("%s/%s" % (srv, inst)
+                           for srv, insts in servers.items()
+                           for inst in insts))
+    devices = sorted(set(dev for _, _, _, dev
+                         in get_devices_from_dict(servers)))
+    classes = sorted(config.get("classes", {}))
+    return instances, devices, classes
+
+
+def get_db_data_for_config(db, config, **kwargs):
+    """
+    Get the DB data relevant for a dsconfig file, using targeted queries
+    instead of dumping everything. This means all devices in the server
+    instances of the config, plus the devices in the config wherever
+    they currently are (so that moved devices can be detected), and the
+    classes of the config. See get_db_data_for_scope for the arguments.
+    """
+    instances, devices, classes = get_config_scope(config)
+    return get_db_data_for_scope(db, instances, devices, classes, **kwargs)
+
+
+def get_db_data_for_scope(db, instances=(), devices=(), classes=(),
+                          device_aliases=(), class_properties=True,
+                          pool=None, batch_size=500, aliases=True,
+                          uppercase_devices=False, timeout=10,
+                          server_cache=False, **options):
+    """
+    Get the DB data for the given server instances, devices, classes
+    and devices with the given aliases, in the same format as
+    get_db_data.
+
+    With 'server_cache', the server instances are read one by one with
+    the DbGetDataForServerCache command, which is quicker when there
+    are only a few of them. Any instances where that does not work are
+    read with the queries as usual.
+    """
+
+    instances, devices, classes, device_aliases = [
+        sorted(values)
+        for values in (instances, devices, classes, device_aliases)]
+
+    data = SetterDict()
+    data.servers = {}
+    if server_cache:
+        dbproxy = tango.DeviceProxy(db.dev_name())
+        servers, instances = get_servers_from_server_cache(
+            dbproxy, instances, aliases=aliases,
+            dservers=options.get("dservers", False),
+            subdevices=options.get("subdevices", False),
+            uppercase_devices=uppercase_devices, timeout=timeout)
+        merge(data.servers, servers.to_dict())
+
+    def batches(column, values):
+        for i in range(0, len(values), batch_size):
+            yield "%s IN (%s)" % (column,
+                                  quote_list(values[i:i + batch_size]))
+
+    # Each scope is a list of queries whose results belong together
+    server_scopes = [get_servers_queries(where=where, **options)
+                     for where in batches("device.server", instances)]
+    server_scopes.extend(get_servers_queries(where=where, **options)
+                         for where in batches("device.name", devices))
+    server_scopes.extend(get_servers_queries(where=where, **options)
+                         for where in batches("device.alias",
+                                              device_aliases))
+    class_scopes = []
+    if class_properties:
+        class_scopes = [get_classes_queries(where=where)
+                        for where in batches("device.class", classes)]
+
+    queries = [("%s %d" % (name, i), query)
+               for i, scope in enumerate(server_scopes + class_scopes)
+               for name, query in scope]
+    if pool:
+        results = pool.select(queries)
     else:
-        # go through all patterns and fill in the data
-        for pattern in patterns:
-            prefix, pattern = pattern.split(":")
-            kwargs = {prefix: pattern}
-            kwargs.update(options)
-            servers = get_servers_with_filters(dbproxy, **kwargs)
-            data.servers.update(servers)
-            if class_properties:
-                classes = get_classes_properties(dbproxy, server=pattern)
-                data.classes.update(classes)
+        dbproxy = tango.DeviceProxy(db.dev_name())
+        results = select_all(dbproxy, queries, timeout=timeout)
+
+    def scope_results(i, scope):
+        return dict((name, results["%s %d" % (name, i)]) for name, _ in scope)
+
+    # The scopes may overlap, so the results are merged
+    for i, scope in enumerate(server_scopes):
+        servers = servers_from_results(scope_results(i, scope), aliases,
+                                       uppercase_devices)
+        merge(data.servers, servers.to_dict())
+    if class_properties:
+        data.classes = {}
+        for i, scope in enumerate(class_scopes, len(server_scopes)):
+            classes = classes_from_results(scope_results(i, scope))
+            merge(data.classes, classes.to_dict())
     return data.to_dict()
 
 
+def iter_db_devices(dbproxy, patterns=None, page_size=1000, **options):
+    """
+    Yields (server, instance, class, device, data) for all devices
+    matching any of the patterns, reading the DB page by page. Devices
+    come out grouped by server, instance and class.
+    """
+    where = compile_patterns(patterns) if patterns else None
+    return iter_servers_with_filters(dbproxy, page_size=page_size,
+                                     where=where, **options)
+
+
+def _indent(text, level):
+    return text.replace("\n", "\n" + "    " * level)
+
+
+def write_servers(devices, out, level=1):
+    """
+    Write (server, instance, class, device, data) items to 'out' as a
+    JSON "servers" dict, one device at a time. The items must be grouped
+    by server, instance and class.
+    """
+    opened = []  # the currently open server, instance and class
+    written = [False] * 4  # if there is already something at each level
+    out.write("{")
+    for srv, inst, clss, dev, data in devices:
+        keys = [srv, inst, clss]
+        depth = 0
+        while (depth < len(opened)
+               and opened[depth].upper() == keys[depth].upper()):
+            depth += 1
+        for d in reversed(range(depth, len(opened))):
+            out.write("\n%s}" % ("    " * (level + d + 1)))
+        del opened[depth:]
+        for d in range(depth, 3):
+            out.write(",\n" if written[d] else "\n")
+            out.write("%s%s: {" % ("    " * (level + d + 1),
+                                   json.dumps(keys[d], ensure_ascii=False)))
+            written[d] = True
+            written[d + 1] = False
+            opened.append(keys[d])
+        out.write(",\n" if written[3] else "\n")
+        written[3] = True
+        value = json.dumps(data, ensure_ascii=False, indent=4, sort_keys=True)
+        out.write("%s%s: %s" % ("    " * (level + 4),
+                                json.dumps(dev, ensure_ascii=False),
+                                _indent(value, level + 4)))
+    for d in reversed(range(len(opened))):
+        out.write("\n%s}" % ("    " * (level + d + 1)))
+    if written[0]:
+        out.write("\n" + "    " * level)
+    out.write("}")
+
+
+def dump_db_data(db, out, patterns=None, class_properties=False,
+                 page_size=1000, timestamp=None, **options):
+    """
+    Like get_db_data, but writes the result as JSON to 'out' while the
+    DB is being read page by page, instead of building it all in memory.
+    If a 'timestamp' is given, it is included like with --timestamp.
+    """
+
+    dbproxy = tango.DeviceProxy(db.dev_name())
+
+    out.write("{\n")
+    if timestamp is not None:
+        out.write('    %s: %s,\n' % (json.dumps(TIMESTAMP_KEY),
+                                     json.dumps(timestamp)))
+    if class_properties:
+        # class properties are comparatively few, just get them at once
+        where = compile_patterns(patterns) if patterns else None
+        classes = get_classes_properties(dbproxy, where=where)
+        value = json.dumps(classes.to_dict(), ensure_ascii=False,
+                           indent=4, sort_keys=True)
+        out.write('    "classes": %s,\n' % _indent(value, 1))
+    out.write('    "servers": ')
+    write_servers(iter_db_devices(dbproxy, patterns, page_size, **options),
+                  out)
+    out.write("\n}\n")
+
+
 def main():
-    import json
+    import os
+    import sys
     from optparse import OptionParser
 
     usage = "Usage: %prog [term:pattern term2:pattern2...]"
@@ -70,16 +293,80 @@ def main():
                       dest="class_properties",
                       action="store_true", default=False,
                       help="Include class properties")
+    parser.add_option("-P", "--page-size", dest="page_size", type="int",
+                      help=("Read the DB in pages of this many devices, "
+                            "writing the output as it goes"))
+    parser.add_option("--cache", dest="cache", action="store_true",
+                      default=False,
+                      help=("Reuse the previous dump if the DB has not "
+                            "changed since"))
+    parser.add_option("-t", "--timestamp", dest="timestamp",
+                      action="store_true", default=False,
+                      help=("Include the time of the dump, so that it can "
+                            "be used with --since later"))
+    parser.add_option("--since", dest="since",
+                      help=("Only read what has changed since the given "
+                            "timestamped dump file (or DB time, e.g. "
+                            "'2020-01-31 12:00:00') and report it"))
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help=("Run the DB queries concurrently, using this "
+                            "many connections"))
+    parser.add_option("--read-host", dest="read_host", metavar="HOST:PORT",
+                      help=("Read from the DB at this TANGO_HOST (e.g. a "
+                            "read-only replica) instead of the usual one"))
 
     options, args = parser.parse_args()
+    if options.since and (options.page_size or options.cache
+                          or options.jobs > 1):
+        parser.error("--since can't be combined with --page-size, --cache "
+                     "or --jobs")
+    if options.page_size and (options.cache or options.jobs > 1):
+        parser.error("--page-size can't be combined with --cache or --jobs")
 
-    db = tango.Database()
-    dbdata = get_db_data(db, args,
-                         properties=options.properties,
-                         class_properties=options.class_properties,
-                         attribute_properties=options.attribute_properties,
-                         aliases=options.aliases, dservers=options.dservers,
-                         subdevices=options.subdevices)
+    db = get_database(options.read_host)
+    if options.jobs > 1:
+        pool = ProxyPool(db.dev_name(), size=options.jobs)
+    else:
+        pool = None
+    kwargs = dict(properties=options.properties,
+                  class_properties=options.class_properties,
+                  attribute_properties=options.attribute_properties,
+                  aliases=options.aliases, dservers=options.dservers,
+                  subdevices=options.subdevices)
+    if options.since:
+        if os.path.isfile(options.since):
+            with open(options.since) as f:
+                baseline = json.load(f)
+            if TIMESTAMP_KEY not in baseline:
+                sys.exit("The file %s has no timestamp; make the dump "
+                         "using --timestamp." % options.since)
+            since = baseline[TIMESTAMP_KEY]
+        else:
+            baseline, since = None, options.since
+        dbdata, report = get_db_data_since(db, baseline, since, args,
+                                           **kwargs)
+        print("\n".join(format_report(report)), file=sys.stderr)
+        print(json.dumps(dbdata, ensure_ascii=False, indent=4,
+                         sort_keys=True))
+        return
+    timestamp = None
+    if options.timestamp:
+        timestamp = get_db_time(tango.DeviceProxy(db.dev_name()))
+    if options.page_size:
+        dump_db_data(db, sys.stdout, args, page_size=options.page_size,
+                     timestamp=timestamp, **kwargs)
+        return
+    if options.cache:
+        cache = SnapshotCache(db)
+        dbdata = cache.get(["dump", args, kwargs],
+                           lambda: get_db_data(db, args, pool=pool, **kwargs))
+    else:
+        dbdata = get_db_data(db, args, pool=pool, **kwargs)
+    if pool:
+        print("Query timings:", file=sys.stderr)
+        print("\n".join(pool.summary()), file=sys.stderr)
+    if options.timestamp:
+        dbdata[TIMESTAMP_KEY] = timestamp
     print((json.dumps(dbdata, ensure_ascii=False, indent=4, sort_keys=True)))
 
 
@@ -0,0 +1,199 @@
+"""
+Incremental dumps, using the history tables of the Tango DB.
+
+Whenever a property is written or deleted, the Tango DB also stores
+the change, with a timestamp, in one of the history tables. So given
+an earlier dump and the time it was made, only the devices and classes
+that have changed since then need to be read again. Added, removed and
+moved devices, and changed aliases, are found by comparing with a
+listing of the device table, which is comparatively cheap.
+
+$ python -m dsconfig.dump --timestamp > snapshot.json
+...
+$ python -m dsconfig.dump --since snapshot.json > new_snapshot.json
+"""
+
+from copy import deepcopy
+
+import tango
+
+from .appending_dict import SetterDict
+from .tangodb import (get_servers_queries, servers_from_results,
+                      get_classes_queries, classes_from_results,
+                      get_devices_from_dict, nwise, quote_list, select,
+                      select_all, compile_patterns)
+
+# The dump time is stored in the snapshot under this key. Since it
+# starts with an underscore it is ignored by json2tango.
+TIMESTAMP_KEY = "_timestamp"
+
+DEVICE_HISTORY_TABLES = ["property_device_hist",
+                         "property_attribute_device_hist"]
+CLASS_HISTORY_TABLES = ["property_class_hist",
+                        "property_attribute_class_hist"]
+
+
+def get_db_time(dbproxy):
+    "The current time, according to the DB"
+    return select(dbproxy, "SELECT NOW()")[0]
+
+
+def get_changed_since(dbproxy, since, tables, column):
+    """
+    Return the (lowercase) names of the devices or classes that have
+    any rows in the given history tables since the given time.
+    """
+    names = set()
+    for table in tables:
+        query = ("SELECT DISTINCT %s FROM %s WHERE date >= '%s'"
+                 % (column, table, since))
+        result = select(dbproxy, query)
+        names.update(name.lower() for name in result)
+    return names
+
+
+def list_devices(dbproxy, patterns=None, dservers=False):
+    """
+    Returns (server, class, name, alias) for all devices matching any
+    of the patterns, as a dict keyed on lowercase device name.
+    """
+    where = compile_patterns(patterns) if patterns else None
+    [(_, query)] = get_servers_queries(properties=False,
+                                       attribute_properties=False,
+                                       dservers=dservers, where=where)
+    result = select(dbproxy, query)
+    devices = {}
+    for server, clss, name, alias in nwise(result, 4):
+        devices.setdefault(name.lower(), (server, clss, name, alias))
+    return devices
+
+
+def batched_where(column, values, batch_size):
+    values = sorted(values)
+    for i in range(0, len(values), batch_size):
+        yield "%s IN (%s)" % (column, quote_list(values[i:i + batch_size]))
+
+
+def get_db_data_since(db, baseline, since, patterns=None,
+                      class_properties=False, aliases=True,
+                      uppercase_devices=False, dservers=False,
+                      batch_size=500, **options):
+    """
+    Make a fresh snapshot, by re-reading only what has changed after
+    the time 'since' and patching the 'baseline' snapshot (which should
+    be a dump made at that time, with the same patterns and options).
+    If there is no baseline, the snapshot contains just the changed
+    devices and classes.
+
+    Returns the new snapshot and a dict listing the names of "added",
+    "removed", "moved" and "changed" devices, and "changed" classes.
+    """
+
+    dbproxy = tango.DeviceProxy(db.dev_name())
+    # Get the time first, so that nothing changed while we are
+    # reading gets missed next time
+    now = get_db_time(dbproxy)
+
+    changed = get_changed_since(dbproxy, since, DEVICE_HISTORY_TABLES,
+                                "device")
+    current = list_devices(dbproxy, patterns, dservers)
+    old = {}
+    if baseline:
+        for srv, inst, clss, dev in get_devices_from_dict(
+                baseline.get("servers", {})):
+            old[dev.lower()] = (srv, inst, clss, dev)
+
+    report = {"added": [], "removed": [], "moved": [], "changed": [],
+              "changed_classes": []}
+    refetch = set()
+    for key, (server, clss, name, alias) in sorted(current.items()):
+        if baseline is None:
+            if key in changed:
+                report["changed"].append(name)
+                refetch.add(name)
+        elif key not in old:
+            report["added"].append(name)
+            refetch.add(name)
+        else:
+            srv, inst, oclss, oname = old[key]
+            old_alias = baseline["servers"][srv][inst][oclss][oname].get(
+                "alias")
+            if ("%s/%s" % (srv, inst)).lower() != server.lower() \
+                    or oclss.lower() != clss.lower():
+                report["moved"].append(name)
+            if key in changed:
+                report["changed"].append(name)
+                refetch.add(name)
+            elif aliases and (old_alias or "") != alias:
+                report["changed"].append(name)
+    report["removed"] = sorted(dev for key, (_, _, _, dev) in old.items()
+                               if key not in current)
+
+    # Read the changed devices again
+    fetched = {}
+    for where in batched_where("device.name", refetch, batch_size):
+        results = select_all(dbproxy, get_servers_queries(
+            where=where, dservers=dservers, **options))
+        servers = servers_from_results(results, aliases).to_dict()
+        for srv, inst, clss, dev in get_devices_from_dict(servers):
+            fetched[dev.lower()] = servers[srv][inst][clss][dev]
+
+    data = SetterDict()
+    data.servers = {}
+    for key, (server, clss, name, alias) in current.items():
+        try:
+            srv, inst = server.split("/")
+        except ValueError:
+            continue  # malformed server name, skipped by dumps too
+        if key in fetched:
+            device = fetched[key]
+        elif baseline is not None and key in old:
+            osrv, oinst, oclss, oname = old[key]
+            device = deepcopy(baseline["servers"][osrv][oinst][oclss][oname])
+            device.pop("alias", None)
+            if alias and aliases:
+                device["alias"] = alias
+        else:
+            continue
+        devname = name.upper() if uppercase_devices else name
+        data.servers[srv][inst][clss][devname] = device
+
+    if class_properties:
+        # Classes that are no longer used are dropped, and new ones
+        # read, along with any that have changed.
+        classes = set(clss.lower() for _, clss, _, _ in current.values())
+        old_classes = set(oclss.lower() for _, _, oclss, _ in old.values())
+        changed_classes = get_changed_since(
+            dbproxy, since, CLASS_HISTORY_TABLES, "class") & classes
+        report["changed_classes"] = sorted(changed_classes)
+        if baseline is not None:
+            changed_classes |= classes - old_classes
+            data.classes = dict(
+                (name, value)
+                for name, value in baseline.get("classes", {}).items()
+                if name.lower() in classes
+                and name.lower() not in changed_classes)
+        else:
+            data.classes = {}
+        for where in batched_where("device.class", changed_classes,
+                                   batch_size):
+            results = select_all(dbproxy, get_classes_queries(where=where))
+            data.classes.update(classes_from_results(results))
+
+    data = data.to_dict()
+    data[TIMESTAMP_KEY] = now
+    return data, report
+
+
+def format_report(report):
+    "A readable summary of the changes found by get_db_data_since"
+    lines = []
+    for key, title in [("added", "Added devices"),
+                       ("removed", "Removed devices"),
+                       ("moved", "Moved devices"),
+                       ("changed", "Changed devices"),
+                       ("changed_classes", "Changed classes")]:
+        if report[key]:
+            lines.append("%s (%d):" % (title, len(report[key])))
+            lines.extend("    %s" % name for name in report[key])
+    return lines or ["No changes."]
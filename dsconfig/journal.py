@@ -0,0 +1,197 @@
+"""
+A write-ahead journal for applying DB calls, so that an apply that
+was interrupted can be resumed.
+
+The journal is a file of JSON lines. The first line contains all the
+calls to be made, and then each call is recorded by index when it is
+started ("begin") and when it has finished ("done"). When resuming,
+the calls that are not done are checked against the current DB state,
+since some may have been made (or made unnecessary) anyway.
+"""
+
+import json
+import os
+import threading
+
+from .appending_dict.caseless import CaselessDictionary
+from .dump import get_db_data_for_scope
+from .plan import encode_call, decode_call
+from .writer import get_call_keys
+
+
+class Journal(object):
+    """
+    Records the progress of a list of calls in a file. Should be
+    safe to use from several threads.
+    """
+
+    def __init__(self, path, calls=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.started = set()  # indices of the calls begun so far
+        if calls is None:
+            # continue an existing journal
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                complete = f.read() == b"\n"
+            self.file = open(path, "a")
+            if not complete:
+                # the last line was cut short
+                self.file.write("\n")
+        else:
+            self.file = open(path, "w")
+            self._write({"calls": [encode_call(*call) for call in calls]})
+
+    def _write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            # Don't leave it in a buffer, in case we crash
+            self.file.flush()
+
+    def begin(self, i):
+        self._write({"begin": i})
+        self.started.add(i)
+
+    def done(self, i):
+        self._write({"done": i})
+
+    def close(self):
+        self.file.close()
+
+    def subset(self, indices):
+        "A journal for only the calls with the given indices"
+        return JournalSubset(self, indices)
+
+
+class JournalSubset(object):
+
+    def __init__(self, journal, indices):
+        self.journal = journal
+        self.indices = indices
+        self.path = journal.path
+
+    def begin(self, i):
+        self.journal.begin(self.indices[i])
+
+    def done(self, i):
+        self.journal.done(self.indices[i])
+
+    def close(self):
+        self.journal.close()
+
+
+def load_journal(path):
+    """
+    Read a journal file. Returns the calls, and the indices of the
+    calls that were started and finished, respectively.
+    """
+    with open(path) as f:
+        lines = f.readlines()
+    calls = [decode_call(call) for call in json.loads(lines[0])["calls"]]
+    begun = set()
+    done = set()
+    for line in lines[1:]:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # The last line may be cut short if we crashed
+            continue
+        if "begin" in entry:
+            begun.add(entry["begin"])
+        if "done" in entry:
+            done.add(entry["done"])
+    return calls, begun, done
+
+
+def index_devices(servers):
+    """
+    Make a caseless dict of device: (server instance, class, data)
+    from a servers dict.
+    """
+    devices = CaselessDictionary()
+    for srv, insts in servers.items():
+        for inst, classes in insts.items():
+            for clss, devs in classes.items():
+                for name, dev in devs.items():
+                    devices[name] = ("%s/%s" % (srv, inst), clss, dev)
+    return devices
+
+
+def get_calls_scope(calls):
+    """
+    The devices, classes and aliases that the calls concern, as sets.
+    """
+    scope = {"device": set(), "class": set(), "alias": set()}
+    for method, args, _ in calls:
+        for kind, name in get_call_keys(method, args) or []:
+            scope[kind].add(name)
+    return scope["device"], scope["class"], scope["alias"]
+
+
+def _props_applied(method, props, current):
+    if method.startswith("delete_"):
+        return not any(prop in current for prop in props)
+    return all(current.get(prop) == [str(v) for v in values]
+               for prop, values in props.items())
+
+
+def is_applied(method, args, devices, classes):
+    """
+    Check if the DB already is as it would be after the call, given
+    the relevant parts of the DB; 'devices' is a caseless dict of
+    device: (server, class, data) and 'classes' one of class: data.
+    """
+    if method == "add_device":
+        info = args[0]
+        if info.name not in devices:
+            return False
+        server, clss, _ = devices[info.name]
+        return (server.lower() == info.server.lower()
+                and clss.lower() == info._class.lower())
+    if method == "delete_device":
+        return args[0] not in devices
+    if method == "put_device_alias":
+        name, alias = args
+        return (name in devices
+                and devices[name][2].get("alias", "").lower() == alias.lower())
+    if method == "delete_device_alias":
+        return not any(data.get("alias", "").lower() == args[0].lower()
+                       for _, _, data in devices.values())
+    if method.endswith("_property"):
+        name, props = args
+        if "_class_" in method:
+            if method.startswith("delete_"):
+                # Class properties are only found for classes that have
+                # devices, so we can't be sure they are really gone.
+                return False
+            data = classes.get(name, {})
+        else:
+            data = devices.get(name, (None, None, {}))[2]
+        if "_attribute_" in method:
+            current = CaselessDictionary(data.get("attribute_properties", {}))
+            return all(
+                _props_applied(method, attr_props,
+                               CaselessDictionary(current.get(attr, {})))
+                for attr, attr_props in props.items())
+        current = CaselessDictionary(data.get("properties", {}))
+        return _props_applied(method, props, current)
+    return False  # no idea, better do it
+
+
+def get_remaining_calls(db, calls, done, **kwargs):
+    """
+    Returns the indices of the calls that are not done, and are still
+    needed judging by the current DB state. The devices and classes
+    concerned are read from the DB, with get_db_data_for_scope (which
+    also gets any keyword arguments).
+    """
+    remaining = [i for i in range(len(calls)) if i not in done]
+    devices, classes, aliases = get_calls_scope(calls[i] for i in remaining)
+    data = get_db_data_for_scope(db, devices=devices, classes=classes,
+                                 device_aliases=aliases, dservers=True,
+                                 subdevices=True, **kwargs)
+    db_devices = index_devices(data["servers"])
+    db_classes = CaselessDictionary(data.get("classes", {}))
+    return [i for i in remaining
+            if not is_applied(calls[i][0], calls[i][1],
+                              db_devices, db_classes)]
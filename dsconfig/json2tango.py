@@ -6,30 +6,395 @@ optionally be run.
 """
 
 import json
+import os
 import sys
-import time
 from optparse import OptionParser
 from tempfile import NamedTemporaryFile
 
 import tango
 from dsconfig.appending_dict.caseless import CaselessDictionary
-from dsconfig.configure import configure
-from dsconfig.dump import get_db_data
+from dsconfig.configure import configure, has_changes, iter_configure
+from dsconfig.cache import SnapshotCache, PlanCache
+from dsconfig.dump import (get_db_data_for_config, get_config_scope,
+                           get_db_data_for_scope)
 from dsconfig.filtering import filter_config
+from dsconfig.journal import (Journal, load_journal, get_remaining_calls,
+                              get_calls_scope)
+from dsconfig.plan import Plan, save_plan, load_plan, add_digests
+from dsconfig.verify import verify_calls, find_stale, read_entity_digests
+from dsconfig.undo import get_undo_calls, save_undo_calls, load_undo_calls
 from dsconfig.formatting import (CLASSES_LEVELS, SERVERS_LEVELS, load_json,
                                  normalize_config, validate_json,
                                  clean_metadata)
 from dsconfig.output import show_actions
-from dsconfig.tangodb import summarise_calls, get_devices_from_dict
-from dsconfig.utils import SUCCESS, ERROR, CONFIG_APPLIED, CONFIG_NOT_APPLIED
+from dsconfig.tangodb import (summarise_calls, get_devices_from_dict,
+                              ProxyPool, get_database)
+from dsconfig.writer import (BatchWriter, ConflictChecker, FailureReport,
+                             RateLimiter, make_call, write_concurrently,
+                             write_stream)
+from dsconfig.utils import (SUCCESS, ERROR, CONFIG_APPLIED, CONFIG_NOT_APPLIED,
+                            CONFIG_PARTIALLY_APPLIED)
 from dsconfig.utils import green, red, yellow, progressbar, no_colors
 
 
+def make_checker(db, dbcalls, options):
+    "With --check-conflicts, a ConflictChecker for a plan with digests"
+    if not options.check_conflicts or getattr(dbcalls, "digests",
+                                              None) is None:
+        return None
+    return ConflictChecker(dbcalls, dbcalls.digests,
+                           lambda keys: read_entity_digests(db, keys))
+
+
+def write_calls(db, dbcalls, options, journal=None):
+    """
+    Perform the DB calls, in the way given by the options. If a journal
+    is given, each call is recorded in it. With --keep-going or
+    --check-conflicts, returns a FailureReport.
+    """
+    limiter = RateLimiter(min_delay=options.sleep,
+                          target=options.target_latency)
+    checker = make_checker(db, dbcalls, options)
+    report = None
+    if options.keep_going or checker:
+        report = FailureReport(options.keep_going, checker)
+    if options.jobs > 1:
+        def progress(n, total):
+            if options.verbose:
+                progressbar(n - 1, total, 20)
+        write_concurrently(dbcalls, tango.Database, options.jobs,
+                           limiter, progress, journal, options.retries,
+                           report)
+    else:
+        if options.batch:
+            writer = BatchWriter(db, limiter=limiter)
+        for i, (method, args, kwargs) in enumerate(dbcalls):
+            if options.verbose:
+                progressbar(i, len(dbcalls), 20)
+            if report is not None and report.skip(i, dbcalls[i]):
+                continue
+            if journal:
+                journal.begin(i)
+            if options.batch:
+                writer.write(method, args, kwargs)
+            else:
+                try:
+                    make_call(getattr(db, method), args, kwargs, limiter,
+                              options.retries)
+                except tango.DevFailed as e:
+                    if report is None or not report.keep_going:
+                        raise
+                    report.fail(i, dbcalls[i], e)
+                    continue
+                if journal:
+                    journal.done(i)
+        if options.batch:
+            writer.flush()
+            # We don't know exactly when each call was made
+            if journal:
+                for i in range(len(dbcalls)):
+                    journal.done(i)
+    print()
+    if options.verbose:
+        print("Wrote %d changes: %s." % (len(dbcalls), limiter.summary()),
+              file=sys.stderr)
+    return report
+
+
+def show_failures(report, options):
+    "Print out what went wrong, and save the report if wanted"
+    print(red("\n*** Some changes could not be written to the Tango DB ***"),
+          file=sys.stderr)
+    print("\n".join(report.summary()), file=sys.stderr)
+    if options.failure_report:
+        with open(options.failure_report, "w") as f:
+            json.dump(report.to_dict(), f, indent=4)
+        print("Failure report saved to %s" % options.failure_report,
+              file=sys.stderr)
+
+
+def exit_written(report):
+    "Exit after writing, with a code telling if everything went well"
+    if report:
+        print(red("\n*** Data was partly written to the Tango DB ***"),
+              file=sys.stderr)
+        sys.exit(CONFIG_PARTIALLY_APPLIED)
+    print(red("\n*** Data was written to the Tango DB ***"), file=sys.stderr)
+    sys.exit(CONFIG_APPLIED)
+
+
+def make_journal(options, dbcalls):
+    "Start a journal in the file given in the options, or a temporary one"
+    if options.journal:
+        return Journal(options.journal, dbcalls)
+    with NamedTemporaryFile(prefix="dsconfig-journal-", suffix=".jsonl",
+                            delete=False) as f:
+        return Journal(f.name, dbcalls)
+
+
+def apply_calls(db, dbcalls, options, journal):
+    "Perform the DB calls, telling the user how to resume if it fails"
+    try:
+        report = write_calls(db, dbcalls, options, journal)
+        if report:
+            show_failures(report, options)
+        if report and report.failed:
+            print("To retry the failed changes, use --resume %s"
+                  % journal.path, file=sys.stderr)
+        if report and report.conflicts:
+            print("To make the conflicting changes anyway, run again with "
+                  "the current DB state.", file=sys.stderr)
+        return report
+    except (tango.DevFailed, KeyboardInterrupt):
+        print(red("\n*** Writing to the Tango DB was interrupted! ***"),
+              file=sys.stderr)
+        print("To continue where it stopped, use --resume %s"
+              % journal.path, file=sys.stderr)
+        raise
+    finally:
+        journal.close()
+
+
+def write_with_undo(db, dbcalls, original, options):
+    """
+    Perform the DB calls with a journal, and save the calls needed to
+    undo whatever was done.
+    """
+    journal = make_journal(options, dbcalls)
+    try:
+        report = apply_calls(db, dbcalls, options, journal)
+    finally:
+        # Whatever happened, make it possible to go back
+        started = [call for i, call in enumerate(dbcalls)
+                   if i in journal.started]
+        if started:
+            save_undo(started, original)
+    if not options.journal and not report:
+        os.remove(journal.path)
+    return report
+
+
+def stream_calls(dbcalls, original, options):
+    """
+    Perform the DB calls from an iterator, as they come. Returns the
+    calls that were made (or at least started), and a FailureReport
+    with --keep-going.
+    """
+    limiter = RateLimiter(min_delay=options.sleep,
+                          target=options.target_latency)
+    report = FailureReport() if options.keep_going else None
+    started = []
+
+    def progress(n):
+        if options.verbose and n % 100 == 0:
+            print("\rWrote %d changes" % n, end="", file=sys.stderr)
+
+    try:
+        write_stream(dbcalls, tango.Database, options.jobs, limiter,
+                     progress, started, retries=options.retries,
+                     report=report)
+    except (tango.DevFailed, KeyboardInterrupt):
+        print(red("\n*** Writing to the Tango DB was interrupted! ***"),
+              file=sys.stderr)
+        print("Run the same command again to continue.", file=sys.stderr)
+        raise
+    finally:
+        if started:
+            save_undo(started, original)
+    if options.verbose:
+        print("\rWrote %d changes: %s." % (len(started), limiter.summary()),
+              file=sys.stderr)
+    if report:
+        show_failures(report, options)
+    return Plan(started), report
+
+
+def resume(options):
+    """
+    Continue writing the DB calls from an interrupted run, according to
+    its journal. Only the calls that are still needed are made.
+    """
+    db = tango.Database()
+    dbcalls, _, done = load_journal(options.resume)
+    remaining = get_remaining_calls(db, dbcalls, done)
+    print("%d of %d changes were made, %d changes remain to be made."
+          % (len(dbcalls) - len(remaining), len(dbcalls), len(remaining)),
+          file=sys.stderr)
+    if not remaining:
+        print(green("\n*** No changes needed in Tango DB ***"),
+              file=sys.stderr)
+        sys.exit(SUCCESS)
+
+    remaining_calls = [dbcalls[i] for i in remaining]
+    if options.dbcalls:
+        print("Tango database calls:", file=sys.stderr)
+        for method, args, kwargs in remaining_calls:
+            print(method, args, file=sys.stderr)
+    if not options.write:
+        print(yellow("\n*** Nothing was written to the Tango DB (use -w) ***"),
+              file=sys.stderr)
+        sys.exit(CONFIG_NOT_APPLIED)
+
+    journal = Journal(options.resume)
+    report = apply_calls(db, remaining_calls, options,
+                         journal.subset(remaining))
+    exit_written(report)
+
+
+def save_undo(dbcalls, original):
+    "Save the calls needed to undo the given calls to a file"
+    with NamedTemporaryFile(prefix="dsconfig-undo-", suffix=".json",
+                            mode="w", delete=False) as f:
+        save_undo_calls(get_undo_calls(dbcalls, original), f)
+    print("To undo the changes, use --undo %s" % f.name, file=sys.stderr)
+
+
+def undo(options):
+    "Perform the calls from an undo file"
+    db = tango.Database()
+    with open(options.undo) as f:
+        dbcalls = load_undo_calls(f)
+    if options.dbcalls:
+        print("Tango database calls:", file=sys.stderr)
+        for method, args, kwargs in dbcalls:
+            print(method, args, file=sys.stderr)
+    if not dbcalls:
+        print(green("\n*** No changes needed in Tango DB ***"),
+              file=sys.stderr)
+        sys.exit(SUCCESS)
+    if not options.write:
+        print(yellow("\n*** Nothing was written to the Tango DB (use -w) ***"),
+              file=sys.stderr)
+        sys.exit(CONFIG_NOT_APPLIED)
+    journal = make_journal(options, dbcalls)
+    report = apply_calls(db, dbcalls, options, journal)
+    if not options.journal and not report:
+        os.remove(journal.path)
+    exit_written(report)
+
+
+def apply_plan(options):
+    """
+    Perform the calls from a plan saved by an earlier run, without
+    looking at any config. Only the parts of the DB that the plan
+    concerns are read, for the summary and the undo file.
+    """
+    db = tango.Database()
+    dbcalls = load_plan(options.apply_plan)
+    if options.check_conflicts and dbcalls.digests is None:
+        print(red("The plan %s has no digests; can't check for conflicts."
+                  % options.apply_plan), file=sys.stderr)
+        sys.exit(ERROR)
+    if options.dbcalls:
+        print("Tango database calls:", file=sys.stderr)
+        for method, args, kwargs in dbcalls:
+            print(method, args, file=sys.stderr)
+    if not dbcalls:
+        print(green("\n*** No changes needed in Tango DB ***"),
+              file=sys.stderr)
+        sys.exit(SUCCESS)
+
+    devices, classes, aliases = get_calls_scope(dbcalls)
+    original = get_db_data_for_scope(db, devices=devices, classes=classes,
+                                     device_aliases=aliases, dservers=True,
+                                     subdevices=True)
+    print("Summary:", file=sys.stderr)
+    print("\n".join(summarise_calls(dbcalls, original)), file=sys.stderr)
+    if not options.write:
+        print(yellow("\n*** Nothing was written to the Tango DB (use -w) ***"),
+              file=sys.stderr)
+        sys.exit(CONFIG_NOT_APPLIED)
+    report = write_with_undo(db, dbcalls, original, options)
+    exit_written(report)
+
+
+def find_collisions(data, original):
+    """
+    Find the devices in the config that already exist in some other
+    server, and will be moved. Returns a dict of the servers they are
+    in now, and the (class, device) pairs.
+    """
+    if "servers" in data:
+        devices = CaselessDictionary({
+            dev: (srv, inst, cls)
+            for srv, inst, cls, dev
+            in get_devices_from_dict(data["servers"])
+        })
+    else:
+        devices = CaselessDictionary({})
+    orig_devices = CaselessDictionary({
+        dev: (srv, inst, cls)
+        for srv, inst, cls, dev
+        in get_devices_from_dict(original["servers"])
+    })
+    collisions = {}
+    for dev, (srv, inst, cls) in list(devices.items()):
+        if dev in orig_devices:
+            server = "{}/{}".format(srv, inst)
+            osrv, oinst, ocls = orig_devices[dev]
+            origserver = "{}/{}".format(osrv, oinst)
+            if server.lower() != origserver.lower():
+                collisions.setdefault(origserver, []).append((ocls, dev))
+    return collisions
+
+
+def check(data, original, options):
+    """
+    Only find out if the DB matches the config, and exit with the
+    corresponding code.
+    """
+    if has_changes(data, original, update=options.update,
+                   ignore_case=not options.case_sensitive,
+                   strict_attr_props=not options.nostrictcheck):
+        print(yellow("*** The Tango DB does not match the config ***"),
+              file=sys.stderr)
+        sys.exit(CONFIG_NOT_APPLIED)
+    print(green("*** The Tango DB matches the config ***"), file=sys.stderr)
+    sys.exit(SUCCESS)
+
+
+def check_stale(db, original, dbcalls, options):
+    "Make sure that the DB data read from --read-host was up to date"
+    stale = find_stale(db, original, dbcalls)
+    if stale:
+        print(red("The data from %s is out of date for %d devices/classes; "
+                  "nothing was written. Try again later."
+                  % (options.read_host, len(stale))), file=sys.stderr)
+        if options.verbose:
+            for name in stale:
+                print("    %s" % name, file=sys.stderr)
+        sys.exit(ERROR)
+
+
+def verify(db, data, dbcalls, options):
+    "Check that the DB calls made had the intended effect"
+    remaining, n_devices, n_classes = verify_calls(
+        db, data, dbcalls, update=options.update,
+        ignore_case=not options.case_sensitive,
+        strict_attr_props=not options.nostrictcheck)
+    if remaining:
+        print(red("\n*** Verification failed! The Tango DB does not match "
+                  "the config ***"), file=sys.stderr)
+        print("Changes that are still needed:", file=sys.stderr)
+        for method, args, kwargs in remaining:
+            print(method, args, file=sys.stderr)
+        sys.exit(ERROR)
+    print(green("Verified %d devices and %d classes." % (n_devices, n_classes)),
+          file=sys.stderr)
+
+
 def json_to_tango(options, args):
 
     if options.no_colors:
         no_colors()
 
+    if options.resume:
+        return resume(options)
+    if options.undo:
+        return undo(options)
+    if options.apply_plan:
+        return apply_plan(options)
+
     if len(args) == 0:
         data = load_json(sys.stdin)
     else:
@@ -75,53 +440,79 @@ def json_to_tango(options, args):
 
     # check if there is anything in the DB that will be changed or removed
     db = tango.Database()
+    if options.read_host:
+        read_db = get_database(options.read_host)
+    else:
+        read_db = db
     if options.dbdata:
         with open(options.dbdata) as f:
             original = json.loads(f.read())
-        collisions = {}
     else:
-        original = get_db_data(db, dservers=True, class_properties=True)
-        if "servers" in data:
-            devices = CaselessDictionary({
-                dev: (srv, inst, cls)
-                for srv, inst, cls, dev
-                in get_devices_from_dict(data["servers"])
-            })
+        if options.query_jobs > 1:
+            pool = ProxyPool(read_db.dev_name(), size=options.query_jobs)
         else:
-            devices = CaselessDictionary({})
-        orig_devices = CaselessDictionary({
-            dev: (srv, inst, cls)
-            for srv, inst, cls, dev
-            in get_devices_from_dict(original["servers"])
-        })
+            pool = None
+        def get_original():
+            return get_db_data_for_config(read_db, data, dservers=True,
+                                          class_properties=True, pool=pool,
+                                          server_cache=options.server_cache)
+        if options.cache:
+            cache = SnapshotCache(read_db)
+            original = cache.get(["json2tango", get_config_scope(data)],
+                                 get_original)
+        else:
+            original = get_original()
+        if pool and options.verbose:
+            print("DB query timings:", file=sys.stderr)
+            print("\n".join(pool.summary()), file=sys.stderr)
+
+    if options.check:
+        return check(data, original, options)
+
+    if options.dbdata:
         collisions = {}
-        for dev, (srv, inst, cls) in list(devices.items()):
-            if dev in orig_devices:
-                server = "{}/{}".format(srv, inst)
-                osrv, oinst, ocls = orig_devices[dev]
-                origserver = "{}/{}".format(osrv, oinst)
-                if server.lower() != origserver.lower():
-                    collisions.setdefault(origserver, []).append((ocls, dev))
-
-    # get the list of DB calls needed
-    dbcalls = configure(data, original,
-                        update=options.update,
-                        ignore_case=not options.case_sensitive,
-                        strict_attr_props=not options.nostrictcheck)
+    else:
+        collisions = find_collisions(data, original)
+
+    report = None
+    if options.stream:
+        # Write the calls while they are being worked out
+        dbcalls, report = stream_calls(
+            iter_configure(data, original, update=options.update,
+                           ignore_case=not options.case_sensitive,
+                           strict_attr_props=not options.nostrictcheck),
+            original, options)
+    else:
+        # get the list of DB calls needed
+        flags = dict(update=options.update,
+                     ignore_case=not options.case_sensitive,
+                     strict_attr_props=not options.nostrictcheck)
+
+        def make_plan():
+            return configure(data, original, jobs=options.diff_jobs, **flags)
+
+        if options.plan_cache:
+            plan_cache = PlanCache()
+            dbcalls = plan_cache.get(plan_cache.key(data, original, **flags),
+                                     make_plan)
+        else:
+            dbcalls = make_plan()
+        if options.check_conflicts or options.plan_out:
+            # Remember what the plan was based on
+            dbcalls = add_digests(dbcalls, original)
+
+    if options.plan_out:
+        save_plan(dbcalls, options.plan_out)
 
     # Print out a nice diff
-    if options.verbose:
+    if options.verbose and not options.stream:
         show_actions(original, dbcalls)
 
     # perform the db operations (if we're supposed to)
-    if options.write and dbcalls:
-        for i, (method, args, kwargs) in enumerate(dbcalls):
-            if options.sleep:
-                time.sleep(options.sleep)
-            if options.verbose:
-                progressbar(i, len(dbcalls), 20)
-            getattr(db, method)(*args, **kwargs)
-        print()
+    if options.write and dbcalls and not options.stream:
+        if options.read_host:
+            check_stale(db, original, dbcalls, options)
+        report = write_with_undo(db, dbcalls, original, options)
 
     # optionally dump some information to stdout
     if options.output:
@@ -159,13 +550,9 @@ def json_to_tango(options, args):
             print(red("Removed %d empty servers." % len(empty)), file=sys.stderr)
 
         if options.write:
-            print(red("\n*** Data was written to the Tango DB ***"), file=sys.stderr)
-            with NamedTemporaryFile(prefix="dsconfig-", suffix=".json",
-                                    delete=False) as f:
-                f.write(json.dumps(original, indent=4).encode())
-                print(("The previous DB data was saved to %s" %
-                       f.name), file=sys.stderr)
-            sys.exit(CONFIG_APPLIED)
+            if options.verify and not report:
+                verify(db, data, dbcalls, options)
+            exit_written(report)
         else:
             print(yellow(
                 "\n*** Nothing was written to the Tango DB (use -w) ***"), file=sys.stderr)
@@ -202,9 +589,15 @@ def main():
                       help="print out all db calls.")
     parser.add_option("-v", "--no-validation", dest="validate", default=True,
                       action="store_false", help=("Skip JSON validation"))
-    parser.add_option("-s", "--sleep", dest="sleep", default=0.01,
+    parser.add_option("-s", "--sleep", dest="sleep", default=0,
                       type="float",
-                      help=("Number of seconds to sleep between DB calls"))
+                      help=("Minimum number of seconds to sleep between DB "
+                            "calls. The actual time is adapted to how "
+                            "quickly the DB responds."))
+    parser.add_option("--target-latency", dest="target_latency",
+                      default=0.1, type="float",
+                      help=("Slow down writing if DB calls take longer than "
+                            "this many seconds"))
     parser.add_option("-n", "--no-colors",
                       action="store_true", dest="no_colors", default=False,
                       help="Don't print colored output")
@@ -226,8 +619,111 @@ def main():
         "-D", "--dbdata",
         help="Read the given file as DB data instead of using the actual DB",
         dest="dbdata")
+    parser.add_option(
+        "--cache", dest="cache", action="store_true", default=False,
+        help=("Keep a local copy of the DB data, and reuse it as long as "
+              "the DB has not changed"))
+    parser.add_option(
+        "--plan-cache", dest="plan_cache", action="store_true",
+        default=False,
+        help=("Keep the DB calls worked out for a config locally, and reuse "
+              "them if the config and the DB data are the same next time"))
+    parser.add_option(
+        "--read-host", dest="read_host", metavar="HOST:PORT",
+        help=("Read the DB data from this TANGO_HOST (e.g. a read-only "
+              "replica), and only write to the usual one. Before writing, "
+              "the parts to be changed are checked against the latter."))
+    parser.add_option(
+        "--query-jobs", dest="query_jobs", type="int", default=1,
+        help="Run the DB dump queries concurrently on this many connections")
+    parser.add_option(
+        "--diff-jobs", dest="diff_jobs", type="int", default=1,
+        help="Compare the config with the DB data in this many processes")
+    parser.add_option(
+        "-b", "--batch", dest="batch", action="store_true", default=False,
+        help=("Combine property writes for many devices into a few big DB "
+              "calls. The --sleep is then between those calls."))
+    parser.add_option(
+        "-j", "--jobs", dest="jobs", type="int", default=1,
+        help=("Write to the DB using this many connections at once. Changes "
+              "to the same device are still made in order."))
+    parser.add_option(
+        "--stream", dest="stream", action="store_true", default=False,
+        help=("Start writing to the DB right away, while the rest of the "
+              "changes are being worked out (with --jobs connections). "
+              "The diff is not shown. Use with -w."))
+    parser.add_option(
+        "-k", "--keep-going", dest="keep_going", action="store_true",
+        default=False,
+        help=("If a change fails, skip the remaining changes to the same "
+              "device, class or alias, but go on with the rest. Exits "
+              "with 4 if anything failed."))
+    parser.add_option(
+        "--retries", dest="retries", type="int", default=3,
+        help=("Retry DB calls that fail because of timeouts or connection "
+              "problems this many times"))
+    parser.add_option(
+        "--failure-report", dest="failure_report", metavar="FILE",
+        help="With --keep-going, save a report of the failures as JSON")
+    parser.add_option(
+        "--check-conflicts", dest="check_conflicts", action="store_true",
+        default=False,
+        help=("Just before writing each device or class, check that it has "
+              "not been changed by someone else since the DB was read (or "
+              "the --apply-plan was saved). If it has, skip the changes to "
+              "it, and exit with 4."))
+    parser.add_option(
+        "--journal", dest="journal",
+        help=("Keep a record of the DB calls made in this file (by default "
+              "a temporary file, removed when done)"))
+    parser.add_option(
+        "--resume", dest="resume", metavar="JOURNAL",
+        help=("Continue writing where an interrupted run stopped, according "
+              "to its journal. Use with -w."))
+    parser.add_option(
+        "--undo", dest="undo", metavar="FILE",
+        help=("Undo the changes made by an earlier run, using the file it "
+              "saved. Use with -w."))
+    parser.add_option(
+        "--check", dest="check", action="store_true", default=False,
+        help=("Only check if the DB matches the config, stopping at the "
+              "first difference. Exits with 0 if it does, otherwise 3."))
+    parser.add_option(
+        "--verify", dest="verify", action="store_true", default=False,
+        help=("After writing, read back the devices and classes that were "
+              "changed, and check that they match the config"))
+    parser.add_option(
+        "--plan-out", dest="plan_out", metavar="FILE",
+        help=("Save the DB calls needed to this file, to be applied later "
+              "with --apply-plan (compressed if the name ends with .gz)"))
+    parser.add_option(
+        "--apply-plan", dest="apply_plan", metavar="FILE",
+        help=("Make the DB calls saved with --plan-out, instead of "
+              "comparing a config with the DB. Use with -w."))
+    parser.add_option(
+        "--server-cache", dest="server_cache", action="store_true",
+        default=False,
+        help=("Read each server from the DB in one go, like device servers "
+              "do at startup. Quicker when there are few servers."))
 
     options, args = parser.parse_args()
+    if options.batch and options.jobs > 1:
+        parser.error("--batch can't be combined with --jobs")
+    if options.keep_going and options.batch:
+        parser.error("--keep-going can't be combined with --batch")
+    if options.check and options.write:
+        parser.error("--check can't be combined with --write")
+    if options.stream and not options.write:
+        parser.error("--stream needs --write")
+    if options.stream and (options.batch or options.journal
+                           or options.diff_jobs > 1 or options.plan_cache):
+        parser.error("--stream can't be combined with --batch, --journal, "
+                     "--diff-jobs or --plan-cache")
+    if options.check_conflicts and options.stream:
+        parser.error("--check-conflicts can't be combined with --stream")
+    if options.read_host and (options.stream or options.dbdata):
+        parser.error("--read-host can't be combined with --stream or "
+                     "--dbdata")
 
     json_to_tango(options, args)
 
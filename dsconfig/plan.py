@@ -0,0 +1,161 @@
+"""
+A "plan" is the list of DB calls that configure() came up with.
+
+The plan can be saved to a file, and applied later (e.g. computed on
+some other machine beforehand, so that only the writing needs to be
+done during a maintenance window). The file is JSON, compressed with
+gzip if the name ends with ".gz".
+
+A plan can also record digests of the DB state of the devices and
+classes it concerns, as they were when it was made. They can be used
+to check that nobody else has changed them before the calls are made.
+"""
+
+import gzip
+import json
+from collections import namedtuple
+
+import tango
+
+from .digest import get_entity_digests
+from .writer import get_call_keys
+
+PLAN_VERSION = 1
+
+Call = namedtuple("Call", "method args kwargs")
+
+
+def encode_arg(arg):
+    if isinstance(arg, tango.DbDevInfo):
+        return {"__DbDevInfo__": {"name": arg.name, "server": arg.server,
+                                  "_class": arg._class}}
+    return arg
+
+
+def decode_arg(arg, difactory=tango.DbDevInfo):
+    if isinstance(arg, dict) and "__DbDevInfo__" in arg:
+        devinfo = difactory()
+        for attr, value in arg["__DbDevInfo__"].items():
+            setattr(devinfo, attr, value)
+        return devinfo
+    return arg
+
+
+def encode_call(method, args, kwargs):
+    "Make a DB call JSON serializable"
+    return [method, [encode_arg(arg) for arg in args], kwargs]
+
+
+def decode_call(call):
+    method, args, kwargs = call
+    return Call(method, tuple(decode_arg(arg) for arg in args), kwargs)
+
+
+class Plan(object):
+    """
+    An ordered, unchangeable sequence of DB calls, as Call tuples of
+    (method, args, kwargs). It can be used like a list of the calls.
+    The 'digests', if any, are a dict of (kind, name): digest.
+    """
+
+    def __init__(self, calls=(), digests=None):
+        self.calls = tuple(Call(*call) for call in calls)
+        self.digests = digests
+        self._methods = None
+        self._names = None
+
+    def __len__(self):
+        return len(self.calls)
+
+    def __iter__(self):
+        return iter(self.calls)
+
+    def __getitem__(self, index):
+        return self.calls[index]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Plan(%r)" % (list(self.calls),)
+
+    def _index(self):
+        self._methods = {}
+        self._names = {}
+        for i, (method, args, _) in enumerate(self.calls):
+            self._methods.setdefault(method, []).append(i)
+            for key in get_call_keys(method, args) or []:
+                self._names.setdefault(key, []).append(i)
+
+    def by_method(self, method):
+        "The calls to the given Database method"
+        if self._methods is None:
+            self._index()
+        return [self.calls[i] for i in self._methods.get(method, [])]
+
+    def by_name(self, name, kind="device"):
+        """
+        The calls concerning the given device (or class, or alias,
+        depending on 'kind'). Calls to methods we don't know about
+        (e.g. delete_server) are not included.
+        """
+        if self._names is None:
+            self._index()
+        return [self.calls[i]
+                for i in self._names.get((kind, name.lower()), [])]
+
+    def methods(self):
+        "The number of calls to each method"
+        if self._methods is None:
+            self._index()
+        return dict((method, len(indices))
+                    for method, indices in self._methods.items())
+
+    def keys(self):
+        "The devices, classes and aliases concerned, as (kind, name)"
+        if self._names is None:
+            self._index()
+        return set(self._names)
+
+    def to_dict(self):
+        data = {"version": PLAN_VERSION,
+                "calls": [encode_call(*call) for call in self.calls]}
+        if self.digests is not None:
+            data["digests"] = [[kind, name, digest] for (kind, name), digest
+                               in sorted(self.digests.items())]
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get("version") != PLAN_VERSION:
+            raise ValueError("Unsupported plan version: %r"
+                             % data.get("version"))
+        digests = None
+        if "digests" in data:
+            digests = dict(((kind, name), digest)
+                           for kind, name, digest in data["digests"])
+        return cls((decode_call(call) for call in data["calls"]), digests)
+
+
+def add_digests(plan, dbdata):
+    "A copy of the plan, with digests of what it concerns in 'dbdata'"
+    return Plan(plan, get_entity_digests(dbdata, plan.keys()))
+
+
+def _open(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t")
+    return open(path, mode)
+
+
+def save_plan(plan, path):
+    with _open(path, "w") as f:
+        json.dump(plan.to_dict(), f, separators=(",", ":"))
+
+
+def load_plan(path):
+    with _open(path, "r") as f:
+        return Plan.from_dict(json.load(f))
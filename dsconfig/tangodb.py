@@ -1,12 +1,16 @@
 "Various functionality for dealing with the TANGO database"
 
+import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import islice
+from queue import Queue
 
 import tango
 from dsconfig.utils import green, red, yellow
 
-from .appending_dict import AppendingDict, SetterDict, CaselessDictionary
+from .appending_dict import (AppendingDict, SetterDict, CaselessDictionary,
+                             merge)
 
 # These are special properties that we'll ignore for now
 PROTECTED_PROPERTIES = [
@@ -213,13 +217,57 @@ def get_device(db, devname, data, skip_protected=True):
     return dev
 
 
-def get_dict_from_db(db, data, narrow=False, skip_protected=True):
+def make_device(alias, properties, attribute_properties, data,
+                skip_protected=True):
+    """
+    Like get_device, but from already fetched information about the
+    device; its alias, properties and attribute properties (a caseless
+    dict of attribute: {property: values}).
+    """
+
+    dev = {}
+    if alias:
+        dev["alias"] = alias
+
+    if properties:
+        dev["properties"] = dict(
+            (prop, [str(v) for v in value])
+            for prop, value in properties.items()
+            if (not (skip_protected and is_protected(prop))
+                or prop in data.get("properties", {})))
+
+    # Only for the attributes in the input data (see get_device)
+    attr_props = CaselessDictionary(data.get("attribute_properties", {}))
+    if attr_props:
+        dev_attr_props = {}
+        for attr in attr_props.keys():
+            input_props = CaselessDictionary(attr_props[attr])
+            props = dict(
+                (prop, [str(v) for v in values])
+                for prop, values in attribute_properties.get(attr, {}).items()
+                if (not (skip_protected and is_protected(prop, True))
+                    or prop in input_props))
+            if props:
+                dev_attr_props[attr] = props
+        if dev_attr_props:
+            dev["attribute_properties"] = dev_attr_props
+
+    return dev
+
+
+def get_dict_from_db(db, data, narrow=False, skip_protected=True,
+                     server_cache=False):
     """
     Takes a data dict, checks if any if the definitions are already
     in the DB and returns a dict describing them.
 
     By default it includes all devices for each server+class, use the
     'narrow' flag to limit to the devices present in the input data.
+
+    The 'server_cache' flag means that the devices of each server are
+    read using DbGetDataForServerCache (see get_server_cache_devices)
+    instead of several calls per device. If that does not work, e.g.
+    because the DB is too old, the usual way is used instead.
     """
 
     # This is where we'll collect all the relevant data
@@ -238,23 +286,56 @@ def get_dict_from_db(db, data, narrow=False, skip_protected=True):
         except tango.DevFailed:
             pass
 
+    if server_cache:
+        dbproxy = tango.DeviceProxy(db.dev_name())
+
     # Servers
     for srvr, insts in list(data.get("servers", {}).items()):
         for inst, classes in insts.items():
+            srv_full_name = "%s/%s" % (srvr, inst)
+            cached = None
+            if server_cache:
+                try:
+                    cached = CaselessDictionary(
+                        (name, (clss, alias, props, attr_props))
+                        for _, clss, name, alias, props, attr_props
+                        in get_server_cache_devices(dbproxy, srv_full_name))
+                except tango.DevFailed as e:
+                    # No point in trying again for the other servers
+                    server_cache = not is_command_not_found(e)
+                except ValueError:
+                    pass
             for clss, devs in classes.items():
                 devs = CaselessDictionary(devs)
                 if narrow:
                     devices = list(devs.keys())
+                elif cached is not None:
+                    devices = [name for name, (c, _, _, _) in cached.items()
+                               if c.lower() == clss.lower()]
                 else:
-                    srv_full_name = "%s/%s" % (srvr, inst)
                     devices = db.get_device_name(srv_full_name, clss)
                 for device in devices:
                     new_props = devs.get(device, {})
-                    db_props = get_device(db, device, new_props, skip_protected)
+                    if cached is not None and device in cached:
+                        _, alias, props, attr_props = cached[device]
+                        db_props = make_device(alias, props, attr_props,
+                                               new_props, skip_protected)
+                    else:
+                        db_props = get_device(db, device, new_props,
+                                              skip_protected)
                     dbdict.servers[srvr][inst][clss][device] = db_props
 
-    # Classes
-    for class_name, cls in data.get("classes", {}).items():
+    get_classes_from_db(db, data.get("classes", {}), dbdict)
+
+    return dbdict.to_dict(), moved_devices
+
+
+def get_classes_from_db(db, classes, dbdict):
+    """
+    Fill in the DB properties and attribute properties of the given
+    classes into the dbdict (a SetterDict).
+    """
+    for class_name, cls in classes.items():
         props = list(cls.get("properties", {}).keys())
         for prop, value in db.get_class_property(class_name, props).items():
             if value:
@@ -270,6 +351,112 @@ def get_dict_from_db(db, data, narrow=False, skip_protected=True):
                              for prop, values in props.items())
                 dbdict.classes[class_name].attribute_properties[attr] = props
 
+
+def select_in(dbproxy, query, values, columns, batch_size=500):
+    """
+    Run a DbMySqlSelect query containing an "IN (%s)" clause over the
+    given values, in batches of at most 'batch_size' values. Returns
+    all the resulting rows, as tuples of 'columns' values.
+    """
+    values = list(values)
+    rows = []
+    for i in range(0, len(values), batch_size):
+        batch = quote_list(values[i:i + batch_size])
+        result = select(dbproxy, query % batch)
+        rows.extend(nwise(result, columns))
+    return rows
+
+
+def get_dict_from_db_bulk(db, data, narrow=False, skip_protected=True,
+                          batch_size=500):
+    """
+    Does the same thing as get_dict_from_db, but instead of making
+    several DB calls per device, the information is fetched with a
+    handful of SQL queries over batches of devices.
+    """
+
+    dbproxy = tango.DeviceProxy(db.dev_name())
+
+    dbdict = SetterDict()
+    moved_devices = defaultdict(list)
+
+    servers = data.get("servers", {})
+    input_devices = get_devices_from_dict(servers)
+
+    # Where the input devices currently are, and their aliases
+    aliases = CaselessDictionary()
+    locations = CaselessDictionary()
+    for name, server, clss, alias in select_in(
+            dbproxy, "SELECT name, server, class, alias FROM device"
+            " WHERE name IN (%s)", set(dev for _, _, _, dev in input_devices),
+            4, batch_size):
+        locations[name] = server
+        aliases[name] = alias
+
+    # Devices that are already defined somewhere else
+    for server, inst, clss, device in input_devices:
+        if device in locations:
+            ds_full_name = locations[device]
+            srvname = "%s/%s" % (server, inst)
+            if ds_full_name.lower() != srvname.lower():
+                moved_devices[ds_full_name].append((clss, device))
+
+    # All the devices currently in the servers
+    server_devices = defaultdict(list)
+    if not narrow:
+        instances = set("%s/%s" % (srvr, inst)
+                        for srvr, insts in servers.items() for inst in insts)
+        for server, clss, name, alias in select_in(
+                dbproxy, "SELECT server, class, name, alias FROM device"
+                " WHERE server IN (%s) ORDER BY name", instances, 4,
+                batch_size):
+            server_devices[server.lower(), clss.lower()].append(name)
+            aliases[name] = alias
+
+    # Put together the devices to get information about
+    devices = []
+    for srvr, insts in servers.items():
+        for inst, classes in insts.items():
+            for clss, devs in classes.items():
+                devs = CaselessDictionary(devs)
+                if narrow:
+                    names = list(devs.keys())
+                else:
+                    srv_full_name = "%s/%s" % (srvr, inst)
+                    names = server_devices[srv_full_name.lower(),
+                                           clss.lower()]
+                for device in names:
+                    devices.append((srvr, inst, clss, device,
+                                    devs.get(device, {})))
+
+    # Properties
+    properties = CaselessDictionary()
+    for device, prop, value in select_in(
+            dbproxy, "SELECT device, name, value FROM property_device"
+            " WHERE device IN (%s) ORDER BY count ASC",
+            set(device for _, _, _, device, _ in devices), 3, batch_size):
+        properties.setdefault(device, {}).setdefault(prop, []).append(value)
+
+    # Attribute properties, but only for the devices where we have
+    # some in the input data (see get_device)
+    attribute_properties = CaselessDictionary()
+    for device, attr, prop, value in select_in(
+            dbproxy, "SELECT device, attribute, name, value"
+            " FROM property_attribute_device"
+            " WHERE device IN (%s) ORDER BY count ASC",
+            set(device for _, _, _, device, new_props in devices
+                if new_props.get("attribute_properties")), 4, batch_size):
+        attrs = attribute_properties.setdefault(device, CaselessDictionary())
+        attrs.setdefault(attr, {}).setdefault(prop, []).append(value)
+
+    for srvr, inst, clss, device, new_props in devices:
+        dev = make_device(aliases.get(device), properties.get(device),
+                          attribute_properties.get(device, {}), new_props,
+                          skip_protected)
+        dbdict.servers[srvr][inst][clss][device] = dev
+
+    get_classes_from_db(db, data.get("classes", {}), dbdict)
+
     return dbdict.to_dict(), moved_devices
 
 
@@ -338,31 +525,143 @@ def maybe_upper(s, upper=False):
     return s
 
 
-def get_servers_with_filters(dbproxy, server="*", clss="*", device="*",
-                             properties=True, attribute_properties=True,
-                             aliases=True, dservers=False,
-                             subdevices=False, uppercase_devices=False,
-                             timeout=10):
+# Reasons for DB errors that may well go away if we try again
+TRANSIENT_REASONS = [
+    "API_DeviceTimedOut", "API_CorbaException", "API_CommunicationFailed",
+    "API_CantConnectToDatabase", "API_DatabaseAccess",
+]
+
+
+def is_transient(error):
+    "Check if a DevFailed looks like a temporary problem"
+    return any(getattr(err, "reason", None) in TRANSIENT_REASONS
+               for err in error.args)
+
+
+def is_timeout(error):
+    "Check if a DevFailed was caused by a timeout"
+    return any("timedout" in err.reason.lower()
+               or "timeout" in err.reason.lower()
+               for err in error.args)
+
+
+def is_command_not_found(error):
+    "Check if a DevFailed was caused by the command not existing"
+    return any(err.reason == "API_CommandNotFound" for err in error.args)
+
+
+def select(dbproxy, query, timeout=10, retries=3, backoff=1.0):
     """
-    A performant way to get servers and devices in bulk from the DB
-    by direct SQL statements and joins, instead of e.g. using one
-    query to get the properties of each device.
+    Run a DbMySqlSelect query and return the result. Big queries can
+    take a long time, and the DB may be temporarily busy, so queries
+    that time out (or fail in some other temporary way) are retried a
+    number of times, waiting a bit longer and doubling the timeout (in
+    seconds) each time. Other errors, e.g. bad SQL, are raised at once.
+    """
+    for attempt in range(retries + 1):
+        dbproxy.set_timeout_millis(int(timeout * 1000))
+        try:
+            _, result = dbproxy.command_inout("DbMySqlSelect", query)
+            return result
+        except tango.DevFailed as e:
+            if attempt == retries or not (is_timeout(e) or is_transient(e)):
+                raise
+            time.sleep(backoff * 2 ** attempt)
+            timeout *= 2
 
-    TODO: are there any length restrictions on the query results? In
-    that case, use limit and offset to get page by page.
+
+def select_all(dbproxy, queries, **kwargs):
+    """
+    Run the given (name, query) pairs one after another, and return
+    the results as a dict of name: result. Any keyword arguments are
+    passed on to select().
     """
+    results = {}
+    for name, query in queries:
+        results[name] = select(dbproxy, query, **kwargs)
+    return results
 
-    server = server.replace("*", "%")  # mysql wildcards
-    clss = clss.replace("*", "%")
-    device = device.replace("*", "%")
 
-    devices = AppendingDict()
+def escape_like(text):
+    "Escape the characters that are special in an SQL LIKE pattern"
+    # In an SQL string, a backslash must itself be written as two
+    return (text.replace("\\", "\\\\\\\\").replace("_", "\\_")
+            .replace("%", "\\%"))
 
-    # Queries can sometimes take more than de default 3 s, so it's
-    # good to increase the timeout a bit.
-    # TODO: maybe instead use automatic retry and increase timeout
-    # each time?
-    dbproxy.set_timeout_millis(timeout * 1000)
+
+def _pattern_length(stem):
+    """
+    The number of characters matched by a LIKE pattern without "%",
+    counting escaped characters as one. None if there is a "%".
+    """
+    length = 0
+    i = 0
+    while i < len(stem):
+        if stem.startswith("\\\\\\\\", i):
+            i += 4
+        elif stem[i] == "\\":
+            i += 2
+        elif stem[i] == "%":
+            return None
+        else:
+            i += 1
+        length += 1
+    return length
+
+
+def split_server_pattern(dbproxy, server, **kwargs):
+    """
+    Split a server wildcard ending with "%", e.g. "Foo%", into several
+    narrower ones that together match the same servers, one for each
+    following character in the server names, e.g. "Fooa%", "Foob%"...
+    Returns None if the pattern can't be split.
+    """
+    server = server.replace("*", "%")
+    length = _pattern_length(server[:-1])
+    if not server.endswith("%") or length is None:
+        return None
+    query = ("SELECT DISTINCT LEFT(server, %d) FROM device"
+             " WHERE server LIKE '%s'" % (length + 1, server))
+    prefixes = select(dbproxy, query, **kwargs)
+    # The prefixes are plain text, so that e.g. "Foo_" doesn't also
+    # match "FooX". A server named exactly like the stem gets a
+    # pattern of its own.
+    return sorted(set(escape_like(prefix) if len(prefix) == length
+                      else escape_like(prefix) + "%"
+                      for prefix in prefixes))
+
+
+def get_servers_queries(server="*", clss="*", device="*",
+                        properties=True, attribute_properties=True,
+                        dservers=False, subdevices=False, where=None):
+    """
+    Returns the SQL queries needed to get the servers and devices
+    matching the given filters, as a list of (name, query) pairs.
+    The results can be combined using servers_from_results().
+
+    An arbitrary SQL condition on the device table can also be given as
+    'where' (e.g. from compile_patterns). Since it is used in joins, the
+    columns must be qualified, e.g. "device.server".
+    """
+
+    if where is None:
+        server = server.replace("*", "%")  # mysql wildcards
+        clss = clss.replace("*", "%")
+        device = device.replace("*", "%")
+        joined_where = ("server LIKE '%s' AND class LIKE '%s'"
+                        " AND device LIKE '%s'" % (server, clss, device))
+        device_where = ("server LIKE '%s' AND class LIKE '%s'"
+                        " AND name LIKE '%s'" % (server, clss, device))
+    else:
+        conditions = [where]
+        for column, pattern in [("device.server", server),
+                                ("device.class", clss),
+                                ("device.name", device)]:
+            if pattern != "*":
+                conditions.append(match_condition(column, pattern))
+        joined_where = device_where = " AND ".join(conditions)
+
+    queries = []
 
     if properties:
         # Get all relevant device properties
@@ -370,16 +669,13 @@ def get_servers_with_filters(dbproxy, server="*", clss="*", device="*",
             "SELECT device, property_device.name, property_device.value"
             " FROM property_device"
             " INNER JOIN device ON property_device.device = device.name"
-            " WHERE server LIKE '%s' AND class LIKE '%s' AND device LIKE '%s'")
+            " WHERE " + joined_where)
         if not dservers:
             query += " AND class != 'DServer'"
         if not subdevices:
             query += " AND property_device.name != '__SubDevices'"
         query += " ORDER BY property_device.count ASC"
-        _, result = dbproxy.command_inout("DbMySqlSelect",
-                                          query % (server, clss, device))
-        for d, p, v in nwise(result, 3):
-            devices[d.upper()].properties[p] = v
+        queries.append(("device_properties", query))
 
     if attribute_properties:
         # Get all relevant attribute properties
@@ -389,29 +685,41 @@ def get_servers_with_filters(dbproxy, server="*", clss="*", device="*",
             " FROM property_attribute_device"
             " INNER JOIN device ON property_attribute_device.device ="
             " device.name"
-            " WHERE server LIKE '%s' AND class LIKE '%s' AND device LIKE '%s'")
+            " WHERE " + joined_where)
         if not dservers:
             query += " AND class != 'DServer'"
         query += " ORDER BY property_attribute_device.count ASC"
-        _, result = dbproxy.command_inout("DbMySqlSelect", query % (server, clss, device))
-        for d, a, p, v in nwise(result, 4):
-            dev = devices[d.upper()]
-            dev.attribute_properties[a][p] = v
-
-    devices = devices.to_dict()
+        queries.append(("attribute_properties", query))
 
     # dump relevant servers
-    query = (
-        "SELECT server, class, name, alias FROM device"
-        " WHERE server LIKE '%s' AND class LIKE '%s' AND name LIKE '%s'")
-
+    query = "SELECT server, class, name, alias FROM device WHERE " + device_where
     if not dservers:
         query += " AND class != 'DServer'"
-    _, result = dbproxy.command_inout("DbMySqlSelect", query % (server, clss, device))
+    queries.append(("devices", query))
+
+    return queries
+
+
+def servers_from_results(results, aliases=True, uppercase_devices=False):
+    """
+    Combine the results of the queries from get_servers_queries(),
+    given as a dict of name: result, into a server dict.
+    """
+
+    devices = AppendingDict()
+
+    for d, p, v in nwise(results.get("device_properties", []), 3):
+        devices[d.upper()].properties[p] = v
+
+    for d, a, p, v in nwise(results.get("attribute_properties", []), 4):
+        dev = devices[d.upper()]
+        dev.attribute_properties[a][p] = v
+
+    devices = devices.to_dict()
 
     # combine all the information we have
     servers = SetterDict()
-    for s, c, d, a in nwise(result, 4):
+    for s, c, d, a in nwise(results["devices"], 4):
         try:
             srv, inst = s.split("/")
         except ValueError:
@@ -426,17 +734,347 @@ def get_servers_with_filters(dbproxy, server="*", clss="*", device="*",
     return servers
 
 
-def get_classes_properties(dbproxy, server='*', cls_properties=True,
-                           cls_attribute_properties=True, timeout=10):
+def _parse_properties(result, i):
     """
-    Get all classes properties from server wildcard
+    Parse a block of properties in a DbGetDataForServerCache result,
+    starting at index i. It has the same format as the result of e.g.
+    DbGetDeviceProperty: [name, n_props, (prop, n_values, values...)...]
+    Returns the properties and the index after the block.
     """
-    # Mysql wildcards
-    server = server.replace("*", "%")
-    # Change device proxy timeout
-    dbproxy.set_timeout_millis(timeout * 1000)
-    # Classes output dict
-    classes = AppendingDict()
+    n_props = int(result[i + 1])
+    i += 2
+    properties = {}
+    for _ in range(n_props):
+        prop, n_values = result[i], int(result[i + 1])
+        values = result[i + 2:i + 2 + n_values]
+        if n_values < 0 or len(values) != n_values:
+            raise ValueError("Bad number of values for property %s" % prop)
+        if values:
+            properties[prop] = list(values)
+        i += 2 + n_values
+    return properties, i
+
+
+def _parse_attribute_properties(result, i):
+    """
+    Parse a block of attribute properties in a DbGetDataForServerCache
+    result, starting at index i. The format is like that of e.g.
+    DbGetDeviceAttributeProperty2: [name, n_attrs, (attr, n_props,
+    (prop, n_values, values...)...)...]
+    Returns the attribute properties and the index after the block.
+    """
+    n_attrs = int(result[i + 1])
+    i += 2
+    attribute_properties = CaselessDictionary()
+    for _ in range(n_attrs):
+        attr = result[i]
+        props, i = _parse_properties(result, i)
+        if props:
+            attribute_properties[attr] = props
+    return attribute_properties, i
+
+
+def _find_device_in_server_cache(result, index, device, attributes=True):
+    """
+    Find and parse the properties and attribute properties of a device
+    in a DbGetDataForServerCache result. The layout of the result has
+    changed between versions of the DB device, so rather than going
+    through it from the start, we look for a property block followed by
+    an attribute property block for the device. The index is a dict of
+    the positions of each (lowercase) item in the result.
+    """
+    found = []
+    for i in index.get(device.lower(), []):
+        try:
+            props, j = _parse_properties(result, i)
+            if j < len(result) and result[j].lower() == device.lower():
+                attr_props, j = _parse_attribute_properties(result, j)
+            elif attributes:
+                continue
+            else:
+                attr_props = CaselessDictionary()
+        except (ValueError, IndexError):
+            continue
+        if j > len(result):
+            continue
+        if (props, attr_props) not in found:
+            found.append((props, attr_props))
+    if len(found) != 1:
+        # Either it's not there, or we can't tell which one it is
+        raise ValueError("Device %s found %d times in server cache"
+                         % (device, len(found)))
+    return found[0]
+
+
+def get_server_cache_devices(dbproxy, server, dservers=True,
+                             subdevices=True, timeout=10):
+    """
+    Get all devices in a server instance using DbGetDataForServerCache,
+    which is the command device servers use to get all their
+    configuration in one call at startup. The device list and aliases
+    are not in there, so they are read with one extra query.
+
+    Returns a list of (server, class, device, alias, properties,
+    attribute_properties). Raises DevFailed if the DB device does not
+    have the command, and ValueError if the result can't be made sense
+    of. In either case, the other ways of reading the DB still work.
+    """
+    query = ("SELECT server, class, name, alias FROM device"
+             " WHERE server = '%s'" % server)
+    if not dservers:
+        query += " AND class != 'DServer'"
+    devices = nwise(select(dbproxy, query, timeout), 4)
+    if not devices:
+        return []
+
+    dbproxy.set_timeout_millis(int(timeout * 1000))
+    result = dbproxy.command_inout("DbGetDataForServerCache", [server, ""])
+    index = defaultdict(list)
+    for i, item in enumerate(result):
+        index[item.lower()].append(i)
+
+    found = []
+    for srv, clss, name, alias in devices:
+        # The admin device is not stored with its attribute properties
+        props, attr_props = _find_device_in_server_cache(
+            result, index, name, attributes=clss != "DServer")
+        if not subdevices:
+            props.pop("__SubDevices", None)
+        found.append((srv, clss, name, alias, props, attr_props))
+    return found
+
+
+def get_servers_from_server_cache(dbproxy, servers, aliases=True,
+                                  dservers=False, subdevices=False,
+                                  uppercase_devices=False, timeout=10):
+    """
+    Get the given server instances using get_server_cache_devices, in
+    the same format as get_servers_with_filters. Returns the servers
+    and a list of the server instances that could not be read this
+    way; they must be read in some other way.
+    """
+    servers = list(servers)
+    results = defaultdict(list)
+    failed = []
+    for i, server in enumerate(servers):
+        try:
+            devices = get_server_cache_devices(dbproxy, server, dservers,
+                                               subdevices, timeout)
+        except tango.DevFailed as e:
+            if is_command_not_found(e):
+                # No point in trying any more
+                failed.extend(servers[i:])
+                break
+            failed.append(server)
+            continue
+        except ValueError:
+            failed.append(server)
+            continue
+        # Put it together like the SQL query results
+        for srv, clss, name, alias, props, attr_props in devices:
+            results["devices"].extend([srv, clss, name, alias])
+            for prop, values in props.items():
+                for value in values:
+                    results["device_properties"].extend([name, prop, value])
+            for attr, a_props in attr_props.items():
+                for prop, values in a_props.items():
+                    for value in values:
+                        results["attribute_properties"].extend(
+                            [name, attr, prop, value])
+    servers = servers_from_results(results, aliases, uppercase_devices)
+    return servers, failed
+
+
+def get_servers_with_filters(dbproxy, server="*", clss="*", device="*",
+                             properties=True, attribute_properties=True,
+                             aliases=True, dservers=False,
+                             subdevices=False, uppercase_devices=False,
+                             timeout=10, retries=3, where=None):
+    """
+    A performant way to get servers and devices in bulk from the DB
+    by direct SQL statements and joins, instead of e.g. using one
+    query to get the properties of each device.
+
+    For really large databases, see iter_servers_with_filters.
+    """
+
+    queries = get_servers_queries(server, clss, device, properties,
+                                  attribute_properties, dservers, subdevices,
+                                  where)
+
+    # Queries can sometimes take more than de default 3 s, so it's
+    # good to increase the timeout a bit, and retry a few times.
+    try:
+        results = select_all(dbproxy, queries, timeout=timeout,
+                             retries=retries)
+    except tango.DevFailed as e:
+        # If it still doesn't work, the query may just be too big for
+        # the DB. Try again in smaller parts.
+        patterns = is_timeout(e) and split_server_pattern(dbproxy, server)
+        if not patterns:
+            raise
+        servers = SetterDict()
+        for pattern in patterns:
+            part = get_servers_with_filters(
+                dbproxy, pattern, clss, device, properties,
+                attribute_properties, aliases, dservers, subdevices,
+                uppercase_devices, timeout, retries, where)
+            merge(servers, part.to_dict())
+        return servers
+
+    return servers_from_results(results, aliases, uppercase_devices)
+
+
+# The columns of the device table that the dump filters refer to
+PATTERN_COLUMNS = {
+    "server": "device.server",
+    "clss": "device.class",
+    "device": "device.name"
+}
+
+
+def match_condition(column, pattern):
+    """
+    An SQL condition matching a column against a pattern. If there are
+    no wildcards, plain equality is used, since then the DB can make use
+    of its indexes. Patterns with escapes (see escape_like) also need
+    LIKE, since "=" would compare with the backslashes.
+    """
+    pattern = pattern.replace("*", "%")  # mysql wildcards
+    if "%" in pattern or "\\" in pattern:
+        return "%s LIKE '%s'" % (column, pattern)
+    return "%s = '%s'" % (column, pattern)
+
+
+def compile_patterns(patterns):
+    """
+    Combine a list of "term:pattern" filters, where term is one of
+    "server", "clss" or "device", into one SQL condition on the device
+    table that matches everything that any of the filters match.
+    """
+    conditions = []
+    for pattern in patterns:
+        try:
+            term, value = pattern.split(":", 1)
+            column = PATTERN_COLUMNS[term]
+        except ValueError:
+            raise ValueError(
+                "Bad filter '%s'; should be '<term>:<pattern>'" % pattern)
+        except KeyError:
+            raise ValueError("Bad filter '%s'; term should be one of: %s"
+                             % (pattern, ", ".join(sorted(PATTERN_COLUMNS))))
+        condition = match_condition(column, value)
+        if condition not in conditions:
+            conditions.append(condition)
+    return "(%s)" % " OR ".join(conditions)
+
+
+def quote_list(values):
+    "Format a sequence of strings as an SQL list, e.g. for 'IN (...)'"
+    return ", ".join("'%s'" % v for v in values)
+
+
+def iter_servers_with_filters(dbproxy, server="*", clss="*", device="*",
+                              properties=True, attribute_properties=True,
+                              aliases=True, dservers=False,
+                              subdevices=False, uppercase_devices=False,
+                              timeout=10, page_size=1000, where=None):
+    """
+    A paged version of get_servers_with_filters, which yields one device
+    at a time as (server, instance, class, device, data) tuples instead
+    of building the whole server dict.
+
+    The device table is read in pages of 'page_size' rows, using keyset
+    pagination on (server, class, name), and the properties for each
+    page are then fetched with one query per table. This means that the
+    memory used is bounded by the page size, and that the first devices
+    are available long before the last page has been read.
+
+    Devices come out ordered by server, class and name (using the case
+    insensitive ordering of the DB) so all devices belonging to the
+    same server instance and class are yielded together.
+    """
+
+    [(_, query)] = get_servers_queries(server, clss, device,
+                                       properties=False,
+                                       attribute_properties=False,
+                                       dservers=True, where=where)
+    if not dservers:
+        query += " AND class != 'DServer'"
+
+    last = None
+    while True:
+        page_query = query
+        if last:
+            # continue right after the last row of the previous page
+            page_query += (
+                " AND (server > '%s' OR (server = '%s' AND (class > '%s'"
+                " OR (class = '%s' AND name > '%s'))))"
+                % (last[0], last[0], last[1], last[1], last[2]))
+        page_query += " ORDER BY server, class, name LIMIT %d" % page_size
+        result = select(dbproxy, page_query, timeout)
+        rows = nwise(result, 4)
+        if not rows:
+            return
+
+        names = quote_list(d for _, _, d, _ in rows)
+        devices = AppendingDict()
+
+        if properties:
+            props_query = (
+                "SELECT device, name, value FROM property_device"
+                " WHERE device IN (%s)" % names)
+            if not subdevices:
+                props_query += " AND name != '__SubDevices'"
+            props_query += " ORDER BY count ASC"
+            result = select(dbproxy, props_query, timeout)
+            for d, p, v in nwise(result, 3):
+                devices[d.upper()].properties[p] = v
+
+        if attribute_properties:
+            attr_props_query = (
+                "SELECT device, attribute, name, value"
+                " FROM property_attribute_device"
+                " WHERE device IN (%s) ORDER BY count ASC" % names)
+            result = select(dbproxy, attr_props_query, timeout)
+            for d, a, p, v in nwise(result, 4):
+                devices[d.upper()].attribute_properties[a][p] = v
+
+        devices = devices.to_dict()
+
+        for s, c, d, a in rows:
+            try:
+                srv, inst = s.split("/")
+            except ValueError:
+                # Malformed server name? It can happen!
+                continue
+            devname = maybe_upper(d, uppercase_devices)
+            dev = devices.get(d.upper(), {})
+            if a and aliases:
+                dev["alias"] = a
+            yield srv, inst, c, devname, dev
+
+        if len(rows) < page_size:
+            return
+        last = rows[-1][:3]
+
+
+def get_classes_queries(server="*", cls_properties=True,
+                        cls_attribute_properties=True, where=None):
+    """
+    Returns the SQL queries needed to get the properties of the classes
+    in the servers matching the wildcard, as a list of (name, query).
+    The results can be combined using classes_from_results().
+
+    Like for get_servers_queries, a condition on the device table
+    can also be given as 'where'.
+    """
+    if where is None:
+        # Mysql wildcards
+        where = "server like '%s'" % server.replace("*", "%")
+    elif server != "*":
+        where += " AND " + match_condition("device.server", server)
+    queries = []
     # Get class properties
     if cls_properties:
         querry = (
@@ -446,14 +1084,11 @@ def get_classes_properties(dbproxy, server='*', cls_properties=True,
             "FROM property_class "
             "INNER JOIN device "
             "ON property_class.class = device.class "
-            "WHERE server like '%s' "
+            "WHERE " + where + " "
             "AND device.class != 'DServer' "
             "AND device.class != 'TangoAccessControl' "
             "ORDER BY property_class.count ASC")
-        _, result = dbproxy.command_inout("DbMySqlSelect", querry % (server))
-        # Build the output based on: class, property: value
-        for c, p, v in nwise(result, 3):
-            classes[c].properties[p] = v
+        queries.append(("class_properties", querry))
     # Get class attribute properties
     if cls_attribute_properties:
         querry = (
@@ -464,15 +1099,143 @@ def get_classes_properties(dbproxy, server='*', cls_properties=True,
             "FROM property_attribute_class "
             "INNER JOIN device "
             "ON property_attribute_class.class = device.class "
-            "WHERE server like '%s' "
+            "WHERE " + where + " "
             "AND device.class != 'DServer' "
             "AND device.class != 'TangoAccessControl' "
             "ORDER BY property_attribute_class.count ASC")
-        _, result = dbproxy.command_inout("DbMySqlSelect", querry % (server))
-        # Build output: class, attribute, property: value
-        for c, a, p, v in nwise(result, 4):
-            # the properties are encoded in latin-1; we want utf-8
-            decoded_value = v.decode('iso-8859-1').encode('utf8')
-            classes[c].attribute_properties[a][p] = decoded_value
+        queries.append(("class_attribute_properties", querry))
+    return queries
+
+
+def classes_from_results(results):
+    """
+    Combine the results of the queries from get_classes_queries(),
+    given as a dict of name: result, into a classes dict.
+    """
+    # Classes output dict
+    classes = AppendingDict()
+    # Build the output based on: class, property: value
+    for c, p, v in nwise(results.get("class_properties", []), 3):
+        classes[c].properties[p] = v
+    # Build output: class, attribute, property: value
+    for c, a, p, v in nwise(results.get("class_attribute_properties", []), 4):
+        # the properties are encoded in latin-1; we want utf-8
+        decoded_value = v.decode('iso-8859-1').encode('utf8')
+        classes[c].attribute_properties[a][p] = decoded_value
     # Return classes collection
     return classes
+
+
+def get_classes_properties(dbproxy, server='*', cls_properties=True,
+                           cls_attribute_properties=True, timeout=10,
+                           retries=3, where=None):
+    """
+    Get all classes properties from server wildcard (and/or a
+    condition on the device table, see get_classes_queries)
+    """
+    queries = get_classes_queries(server, cls_properties,
+                                  cls_attribute_properties, where)
+    try:
+        results = select_all(dbproxy, queries, timeout=timeout,
+                             retries=retries)
+    except tango.DevFailed as e:
+        # Too big; try again in smaller parts
+        patterns = is_timeout(e) and split_server_pattern(dbproxy, server)
+        if not patterns:
+            raise
+        # The same class may be in several parts; don't append its
+        # property values more than once
+        classes = SetterDict()
+        for pattern in patterns:
+            part = get_classes_properties(
+                dbproxy, pattern, cls_properties, cls_attribute_properties,
+                timeout, retries, where)
+            merge(classes, part.to_dict())
+        return classes
+    return classes_from_results(results)
+
+
+class HostDatabase(tango.Database):
+    """
+    A Database on a given host and port, instead of the TANGO_HOST.
+    Its dev_name() includes the host, so that any proxies made from it
+    (e.g. for DbMySqlSelect queries) also go to the right DB.
+    """
+
+    def __init__(self, host, port):
+        super(HostDatabase, self).__init__(host, port)
+        self.tango_host = "%s:%s" % (host, port)
+
+    def dev_name(self):
+        name = super(HostDatabase, self).dev_name()
+        if "://" in name:
+            return name
+        return "tango://%s/%s" % (self.tango_host, name)
+
+
+def get_database(tango_host=None):
+    "The Database at the given 'host:port', by default the TANGO_HOST"
+    if not tango_host:
+        return tango.Database()
+    host, _, port = tango_host.rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError("Bad TANGO_HOST: %r (should be host:port)"
+                         % tango_host)
+    return HostDatabase(host, int(port))
+
+
+class ProxyPool(object):
+    """
+    A small pool of proxies to the DB device, for running several
+    independent DbMySqlSelect queries at the same time.
+
+    The time taken by each query is recorded in 'timings' as (name,
+    seconds), along with the total wall time of each batch of queries.
+    """
+
+    def __init__(self, devname, size=4, timeout=10,
+                 factory=tango.DeviceProxy):
+        self.size = size
+        self.timeout = timeout
+        self.proxies = Queue()
+        for _ in range(size):
+            self.proxies.put(factory(devname))
+        self.timings = []
+
+    def _select(self, name, query):
+        proxy = self.proxies.get()
+        try:
+            start = time.time()
+            result = select(proxy, query, self.timeout)
+            self.timings.append((name, time.time() - start))
+            return result
+        finally:
+            self.proxies.put(proxy)
+
+    def select(self, queries):
+        """
+        Run the given (name, query) pairs concurrently, and return
+        the results as a dict of name: result.
+        """
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            futures = [(name, executor.submit(self._select, name, query))
+                       for name, query in queries]
+            results = dict((name, future.result())
+                           for name, future in futures)
+        self.timings.append(("wall time", time.time() - start))
+        return results
+
+    def summary(self):
+        "A readable breakdown of the query timings"
+        lines = []
+        total = 0
+        for name, seconds in self.timings:
+            if name == "wall time":
+                lines.append("Sum of queries: %.2f s, wall time: %.2f s"
+                             % (total, seconds))
+                total = 0
+            else:
+                lines.append("  %s: %.2f s" % (name, seconds))
+                total += seconds
+        return lines
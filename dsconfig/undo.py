@@ -0,0 +1,132 @@
+"""
+Undoing DB changes.
+
+Instead of saving a copy of all the DB data that was relevant before
+an apply, we only save the DB calls that would undo it. They are
+worked out from the calls made and the DB data from before, and can
+be performed like any other calls, e.g. with "json2tango --undo".
+"""
+
+import json
+
+import tango
+
+from .appending_dict.caseless import CaselessDictionary
+from .journal import index_devices
+from .plan import encode_call, decode_call
+
+
+def _undo_properties(method, name, props, old_props):
+    """
+    Undo a change of some properties (or attribute properties) by
+    putting back the old values, and removing any that were added.
+    """
+    kind = method.split("_", 1)[1]  # e.g. "device_property"
+    old_props = CaselessDictionary(old_props)
+    restore = {}
+    remove = {}
+    attribute = "_attribute_" in method
+    for key, value in props.items():
+        if attribute:
+            old_attr_props = CaselessDictionary(old_props.get(key, {}))
+            restore_attr = dict((prop, old_attr_props[prop])
+                                for prop in value if prop in old_attr_props)
+            remove_attr = dict((prop, v) for prop, v in value.items()
+                               if prop not in old_attr_props)
+            if restore_attr:
+                restore[key] = restore_attr
+            if remove_attr:
+                remove[key] = remove_attr
+        elif key in old_props:
+            restore[key] = old_props[key]
+        else:
+            remove[key] = value
+    calls = []
+    if remove and method.startswith("put_"):
+        calls.append(("delete_" + kind, (name, remove), {}))
+    if restore:
+        calls.append(("put_" + kind, (name, restore), {}))
+    return calls
+
+
+def _undo_call(method, args, devices, classes, difactory):
+    "The calls needed to undo one call, given the old DB data"
+
+    def make_devinfo(name):
+        server, clss, _ = devices[name]
+        devinfo = difactory()
+        devinfo.name = name
+        devinfo.server = server
+        devinfo._class = clss
+        return devinfo
+
+    if method == "add_device":
+        name = args[0].name
+        if name in devices:
+            # It was moved, move it back
+            return [("add_device", (make_devinfo(name),), {})]
+        return [("delete_device", (name,), {})]
+
+    if method == "delete_device":
+        name = args[0]
+        if name not in devices:
+            return []
+        _, _, data = devices[name]
+        calls = [("add_device", (make_devinfo(name),), {})]
+        if data.get("properties"):
+            calls.append(("put_device_property",
+                          (name, data["properties"]), {}))
+        if data.get("attribute_properties"):
+            calls.append(("put_device_attribute_property",
+                          (name, data["attribute_properties"]), {}))
+        if data.get("alias"):
+            calls.append(("put_device_alias", (name, data["alias"]), {}))
+        return calls
+
+    if method == "put_device_alias":
+        name, alias = args
+        old_alias = devices.get(name, (None, None, {}))[2].get("alias")
+        if old_alias:
+            return [("put_device_alias", (name, old_alias), {})]
+        return [("delete_device_alias", (alias,), {})]
+
+    if method == "delete_device_alias":
+        for name, (_, _, data) in devices.items():
+            if data.get("alias", "").lower() == args[0].lower():
+                return [("put_device_alias", (name, data["alias"]), {})]
+        return []
+
+    if method.endswith("_property"):
+        name, props = args
+        if "_class_" in method:
+            data = classes.get(name, {})
+        else:
+            data = devices.get(name, (None, None, {}))[2]
+        key = ("attribute_properties" if "_attribute_" in method
+               else "properties")
+        return _undo_properties(method, name, props, data.get(key, {}))
+
+    raise ValueError("Don't know how to undo %s%r" % (method, args))
+
+
+def get_undo_calls(calls, original, difactory=tango.DbDevInfo):
+    """
+    Returns the DB calls needed to undo the given calls, based on the
+    DB data from before they were made (as from dump.get_db_data,
+    containing at least the devices and classes concerned).
+    """
+    devices = index_devices(original.get("servers", {}))
+    classes = CaselessDictionary(original.get("classes", {}))
+    undo_calls = []
+    for method, args, _ in reversed(calls):
+        undo_calls.extend(_undo_call(method, args, devices, classes,
+                                     difactory))
+    return undo_calls
+
+
+def save_undo_calls(calls, f):
+    json.dump({"calls": [encode_call(*call) for call in calls]}, f)
+
+
+def load_undo_calls(f):
+    return [decode_call(call) for call in json.load(f)["calls"]]
@@ -6,6 +6,7 @@ SUCCESS = 0  # NO DB CHANGES
 ERROR = 1
 CONFIG_APPLIED = 2
 CONFIG_NOT_APPLIED = 3
+CONFIG_PARTIALLY_APPLIED = 4  # some DB calls failed
 
 # colors
 ADD = GREEN = '\033[92m'
@@ -0,0 +1,113 @@
+"""
+Checking that DB calls had the intended effect.
+
+Instead of dumping the whole DB again, only the devices, classes and
+aliases that the calls concerned are read back, and compared with
+the corresponding parts of the config. If everything went well, no
+more calls should be needed.
+
+Similarly, find_stale() checks that the DB data a plan was based on
+(e.g. read from a replica, which may lag behind) is still what the DB
+has, for the parts that the plan would change. read_entity_digests()
+gets the current digests of some devices and classes, to compare with
+those recorded in a plan.
+"""
+
+from .appending_dict.caseless import CaselessDictionary
+from .configure import configure
+from .digest import device_digest, get_entity_digests
+from .dump import get_db_data_for_scope
+from .journal import get_calls_scope, index_devices
+from .tangodb import get_devices_from_dict
+
+
+def get_config_subset(data, devices, classes, dbdata=None):
+    """
+    The parts of a config that concern the given devices and classes
+    (lowercase names). Classes in server instances that have devices
+    in 'dbdata' are included even if none of their devices are, so
+    that any devices that should have been removed are noticed.
+    """
+    db_classes = set(
+        (srv.lower(), inst.lower(), clss.lower())
+        for srv, inst, clss, _
+        in get_devices_from_dict((dbdata or {}).get("servers", {})))
+    servers = {}
+    for srv, instances in data.get("servers", {}).items():
+        for inst, inst_classes in instances.items():
+            for clss, devs in inst_classes.items():
+                subset = dict((dev, value) for dev, value in devs.items()
+                              if dev.lower() in devices)
+                key = (srv.lower(), inst.lower(), clss.lower())
+                if subset or key in db_classes:
+                    servers.setdefault(srv, {}).setdefault(inst, {})[
+                        clss] = subset
+    subset = {"servers": servers}
+    if "classes" in data:
+        subset["classes"] = dict(
+            (clss, value) for clss, value in data["classes"].items()
+            if clss.lower() in classes)
+    return subset
+
+
+def verify_calls(db, data, dbcalls, **flags):
+    """
+    Read back the parts of the DB concerned by the calls, and check
+    them against the config. Returns the calls that would still be
+    needed (hopefully none), and the number of devices and classes
+    that were checked. Any flags are passed on to configure().
+    """
+    devices, classes, aliases = get_calls_scope(dbcalls)
+    dbdata = get_db_data_for_scope(db, devices=devices, classes=classes,
+                                   device_aliases=aliases, dservers=True,
+                                   subdevices=True)
+    # Devices found by alias are also checked
+    devices = devices | set(
+        dev.lower()
+        for _, _, _, dev in get_devices_from_dict(dbdata["servers"]))
+    subset = get_config_subset(data, devices, classes, dbdata)
+    return configure(subset, dbdata, **flags), len(devices), len(classes)
+
+
+def _device_states(devices):
+    return dict((name.lower(), (server, clss, device_digest(data)))
+                for name, (server, clss, data) in devices.items())
+
+
+def find_stale(db, dbdata, dbcalls):
+    """
+    Read the devices, classes and aliases concerned by the calls from
+    the DB, and compare them with 'dbdata'. Returns the (lowercase)
+    names of the devices and classes that differ, if any.
+    """
+    devices, classes, aliases = get_calls_scope(dbcalls)
+    current = get_db_data_for_scope(db, devices=devices, classes=classes,
+                                    device_aliases=aliases, dservers=True)
+    old_devices = index_devices(dbdata.get("servers", {}))
+    old = _device_states(old_devices)
+    new = _device_states(index_devices(current["servers"]))
+    # Devices found by alias, in either one
+    aliased = set(
+        name.lower() for name, (_, _, data) in old_devices.items()
+        if data.get("alias", "").lower() in aliases)
+    stale = sorted(name for name in devices | aliased | set(new)
+                   if old.get(name) != new.get(name))
+    old_classes = CaselessDictionary(dbdata.get("classes", {}))
+    new_classes = CaselessDictionary(current.get("classes", {}))
+    stale.extend(sorted(
+        clss for clss in classes
+        if device_digest(old_classes.get(clss, {}))
+        != device_digest(new_classes.get(clss, {}))))
+    return stale
+
+
+def read_entity_digests(db, keys):
+    """
+    Read the given devices and classes (as (kind, name) keys) from the
+    DB, and return their digests, see digest.get_entity_digests.
+    """
+    devices = set(name for kind, name in keys if kind == "device")
+    classes = set(name for kind, name in keys if kind == "class")
+    current = get_db_data_for_scope(db, devices=devices, classes=classes,
+                                    dservers=True)
+    return get_entity_digests(current, keys)
@@ -0,0 +1,599 @@
+"""
+Performing the DB calls recorded by configure().
+
+Calling the Database methods one by one means one round trip to the
+DB device per call, which adds up when there are many thousands of
+them. The DbPutDeviceProperty and DbPutClassProperty commands can
+however take properties for any number of devices (or classes) at
+once, so the BatchWriter collects consecutive property writes and
+sends them as a few big commands instead.
+
+The RateLimiter paces the calls according to how quickly the DB
+responds, instead of always sleeping a fixed time between them.
+
+Most calls concern a single device (or class), and only the order of
+the calls for the same device matters. So write_concurrently performs
+the calls for unrelated devices at the same time, in several threads.
+write_stream does the same for calls that are still being worked out,
+starting on each call as soon as it arrives.
+
+Calls that fail with errors that look temporary (e.g. timeouts) can
+be retried. If a FailureReport is given, a failed call doesn't stop
+the writing; instead the remaining calls concerning the same things
+are skipped, and the failures are reported at the end.
+
+A FailureReport can also be given a ConflictChecker, which checks
+that the devices and classes are still as they were when the calls
+were worked out, just before they are written. Calls concerning
+anything that someone else has changed meanwhile are skipped.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import tango
+
+from .tangodb import is_transient
+
+# Database methods whose calls can be combined, and the corresponding
+# DB device commands, which take properties for several objects.
+BATCHED_COMMANDS = {
+    "put_device_property": "DbPutDeviceProperty",
+    "put_class_property": "DbPutClassProperty",
+}
+
+# Calls that don't interfere with pending property writes, even if
+# they concern the same device
+INDEPENDENT_METHODS = [
+    "add_device", "put_device_alias", "delete_device_alias",
+    "put_device_attribute_property", "delete_device_attribute_property",
+    "put_class_attribute_property", "delete_class_attribute_property",
+]
+
+# The things that calls to each Database method concern, as (kind,
+# index of the argument naming it). Calls to other methods are assumed
+# to potentially concern anything.
+CALL_KEYS = {
+    "add_device": [("device", 0)],
+    "delete_device": [("device", 0)],
+    "put_device_property": [("device", 0)],
+    "delete_device_property": [("device", 0)],
+    "put_device_attribute_property": [("device", 0)],
+    "delete_device_attribute_property": [("device", 0)],
+    "put_class_property": [("class", 0)],
+    "delete_class_property": [("class", 0)],
+    "put_class_attribute_property": [("class", 0)],
+    "delete_class_attribute_property": [("class", 0)],
+    "put_device_alias": [("device", 0), ("alias", 1)],
+    "delete_device_alias": [("alias", 0)],
+}
+
+# Rough upper limit to the total length of the strings in a command
+MAX_SIZE = 100000
+
+def encode_properties(name, properties):
+    """
+    Encode the properties of a device or class the way the DB device
+    wants them: [name, n_props, (prop, n_values, values...)...]
+    """
+    result = [name, str(len(properties))]
+    for prop, values in properties.items():
+        if isinstance(values, str):
+            values = [values]
+        result.append(prop)
+        result.append(str(len(values)))
+        result.extend(str(value) for value in values)
+    return result
+
+
+def get_touched(args):
+    "The (lowercase) names of things a DB call is about"
+    names = set()
+    for arg in args:
+        if isinstance(arg, str):
+            names.add(arg.lower())
+        elif getattr(arg, "name", None):
+            names.add(arg.name.lower())  # e.g. DbDevInfo
+    return names
+
+
+def describe_error(error):
+    "A short description of an exception, e.g. a DevFailed"
+    if isinstance(error, tango.DevFailed) and error.args:
+        err = error.args[0]
+        return "%s: %s" % (err.reason, err.desc.strip())
+    return "%s: %s" % (type(error).__name__, error)
+
+
+def make_call(func, args, kwargs, limiter=None, retries=0, backoff=0.5,
+              sleep=time.sleep):
+    """
+    Make a DB call (through the limiter, if given). Transient errors
+    are retried up to 'retries' times, waiting longer each time.
+    """
+    for attempt in range(retries + 1):
+        try:
+            if limiter:
+                return limiter.call(func, *args, **kwargs)
+            return func(*args, **kwargs)
+        except tango.DevFailed as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            sleep(backoff * 2 ** attempt)
+
+
+class ConflictChecker(object):
+    """
+    Checks that the devices and classes concerned by a list of calls
+    are still as they were when the calls were worked out, according
+    to 'digests' (a dict of (kind, name): digest). read(keys) should
+    return the current digests of the given things.
+
+    Each thing is checked once, before the first call concerning it
+    is made. To save queries, the things concerned by the next few
+    calls (up to 'window' of them) are checked at the same time.
+    """
+
+    def __init__(self, calls, digests, read, window=100):
+        self.calls = calls
+        self.digests = digests
+        self.read = read
+        self.window = window
+        self.changed = {}  # key: True if someone else has changed it
+        self.lock = threading.Lock()
+
+    def _keys(self, call):
+        return [key for key in get_call_keys(call[0], call[1]) or []
+                if key in self.digests]
+
+    def check(self, i):
+        "The things concerned by call i that have been changed"
+        keys = self._keys(self.calls[i])
+        with self.lock:
+            if any(key not in self.changed for key in keys):
+                batch = set()
+                for call in self.calls[i:i + self.window]:
+                    batch.update(key for key in self._keys(call)
+                                 if key not in self.changed)
+                    if len(batch) >= self.window:
+                        break
+                current = self.read(batch)
+                for key in batch:
+                    self.changed[key] = current.get(key) != self.digests[key]
+        return [key for key in keys if self.changed[key]]
+
+
+class FailureReport(object):
+    """
+    Keeps track of the calls that failed, and of the devices, classes
+    and aliases they concern, so that later calls concerning the same
+    things can be skipped. Should be safe to use from several threads.
+
+    Unless 'keep_going' is set, the writers still stop at the first
+    failure. If a 'checker' (a ConflictChecker) is given, calls
+    concerning things that someone else has changed are not made.
+    """
+
+    def __init__(self, keep_going=True, checker=None):
+        self.keep_going = keep_going
+        self.checker = checker
+        self.failed = []  # (index, call, error description)
+        self.conflicts = []  # (index, call)
+        self.skipped = []  # (index, call)
+        self.keys = set()
+        self.lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.failed or self.conflicts)
+
+    __nonzero__ = __bool__
+
+    def skip(self, i, call):
+        """
+        Check if a call should be skipped, because of an earlier
+        failure or a conflict
+        """
+        keys = get_call_keys(call[0], call[1]) or []
+        with self.lock:
+            if any(key in self.keys for key in keys):
+                self.skipped.append((i, call))
+                return True
+        if self.checker is not None and self.checker.check(i):
+            with self.lock:
+                self.conflicts.append((i, call))
+                self.keys.update(keys)
+            return True
+        return False
+
+    def fail(self, i, call, error):
+        keys = get_call_keys(call[0], call[1]) or []
+        with self.lock:
+            self.failed.append((i, call, describe_error(error)))
+            self.keys.update(keys)
+
+    @staticmethod
+    def _entry(i, call):
+        keys = get_call_keys(call[0], call[1]) or []
+        return {"index": i, "method": call[0],
+                "concerns": ["%s %s" % key for key in keys]}
+
+    def to_dict(self):
+        "The report in a form that can be saved as JSON"
+        failed = []
+        for i, call, error in sorted(self.failed, key=lambda f: f[0]):
+            entry = self._entry(i, call)
+            entry["error"] = error
+            failed.append(entry)
+        conflicts = [self._entry(i, call) for i, call
+                     in sorted(self.conflicts, key=lambda c: c[0])]
+        skipped = [self._entry(i, call)
+                   for i, call in sorted(self.skipped, key=lambda s: s[0])]
+        return {"failed": failed, "conflicts": conflicts,
+                "skipped": skipped}
+
+    def summary(self):
+        lines = ["%d changes failed, %d conflicted with changes made by "
+                 "someone else, %d skipped because of that:"
+                 % (len(self.failed), len(self.conflicts),
+                    len(self.skipped))]
+        for i, (method, args, _), error in sorted(self.failed,
+                                                  key=lambda f: f[0]):
+            names = ", ".join("%s %s" % key
+                              for key in get_call_keys(method, args) or [])
+            lines.append("  %s (%s): %s" % (method, names or "?", error))
+        for i, (method, args, _) in sorted(self.conflicts,
+                                           key=lambda c: c[0]):
+            names = ", ".join("%s %s" % key
+                              for key in get_call_keys(method, args) or [])
+            lines.append("  %s (%s): changed by someone else"
+                         % (method, names or "?"))
+        return lines
+
+
+class RateLimiter(object):
+    """
+    Makes calls to the DB, adapting the delay between them to how well
+    the DB is doing. As long as calls take less than 'target' seconds,
+    the delay is decreased by 'step' at a time, down to 'min_delay'.
+    If a call takes longer, or fails, the delay is doubled (up to
+    'max_delay'). This way, we don't wait at all while the DB is idle,
+    but back off quickly if it is struggling.
+    """
+
+    def __init__(self, min_delay=0, target=0.1, step=0.005, max_delay=5.0,
+                 clock=time.time, sleep=time.sleep):
+        self.min_delay = self.delay = min_delay
+        self.target = target
+        self.step = step
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.calls = 0
+        self.errors = 0
+        self.slept = 0  # total time spent waiting
+        self.lock = threading.Lock()  # may be shared between threads
+
+    def call(self, method, *args, **kwargs):
+        delay = self.delay
+        if delay:
+            self.sleep(delay)
+        start = self.clock()
+        try:
+            result = method(*args, **kwargs)
+        except tango.DevFailed:
+            with self.lock:
+                self._count(delay, error=True)
+                self._back_off()
+            raise
+        latency = self.clock() - start
+        with self.lock:
+            self._count(delay)
+            if latency > self.target:
+                self._back_off()
+            else:
+                self.delay = max(self.min_delay, self.delay - self.step)
+        return result
+
+    def _count(self, delay, error=False):
+        self.calls += 1
+        self.errors += error
+        self.slept += delay
+
+    def _back_off(self):
+        self.delay = min(self.max_delay, max(2 * self.delay, self.step))
+
+    def summary(self):
+        return ("%d DB calls, %d errors, %.1f s spent waiting"
+                % (self.calls, self.errors, self.slept))
+
+
+class BatchWriter(object):
+    """
+    Performs DB calls, combining property writes into multi-object
+    commands of at most 'max_size' characters. Other calls are made as
+    usual, but first any pending writes concerning the same device
+    (e.g. deleting it) are sent, so that the order is kept where it
+    matters.
+
+    The calls are made through the 'limiter' (a RateLimiter), if given.
+
+    Remember to flush() at the end!
+    """
+
+    def __init__(self, db, dbproxy=None, max_size=MAX_SIZE, limiter=None):
+        self.db = db
+        self.dbproxy = dbproxy or tango.DeviceProxy(db.dev_name())
+        self.max_size = max_size
+        self.limiter = limiter
+        # method: {lowercase name: (name, properties)}
+        self.pending = dict((method, OrderedDict())
+                            for method in BATCHED_COMMANDS)
+        self.sizes = dict.fromkeys(BATCHED_COMMANDS, 0)
+        self.commands = 0  # the number of calls actually made
+
+    def write(self, method, args, kwargs):
+        if method in BATCHED_COMMANDS and len(args) == 2 and not kwargs:
+            self._add(method, *args)
+        else:
+            if method not in INDEPENDENT_METHODS:
+                touched = get_touched(args)
+                if any(name in pending for pending in self.pending.values()
+                       for name in touched):
+                    self.flush()
+            self._call(getattr(self.db, method), *args, **kwargs)
+
+    def _add(self, method, name, properties):
+        size = sum(len(s) for s in encode_properties(name, properties))
+        if self.sizes[method] + size > self.max_size:
+            self._flush_method(method)
+        pending = self.pending[method]
+        if name.lower() in pending:
+            # Later calls override earlier ones, like they would
+            pending[name.lower()][1].update(properties)
+        else:
+            pending[name.lower()] = (name, dict(properties))
+        self.sizes[method] += size
+
+    def _call(self, method, *args, **kwargs):
+        if self.limiter:
+            self.limiter.call(method, *args, **kwargs)
+        else:
+            method(*args, **kwargs)
+        self.commands += 1
+
+    def _flush_method(self, method):
+        pending = self.pending[method]
+        if not pending:
+            return
+        argin = [str(len(pending))]
+        for name, properties in pending.values():
+            argin.extend(encode_properties(name, properties))
+        self._call(self.dbproxy.command_inout, BATCHED_COMMANDS[method],
+                   argin)
+        pending.clear()
+        self.sizes[method] = 0
+
+    def flush(self):
+        "Send all pending writes"
+        for method in sorted(self.pending):
+            self._flush_method(method)
+
+
+def get_call_keys(method, args):
+    """
+    The (lowercase) names of the things a call concerns, e.g.
+    [("device", "a/b/c")], or None if we don't know.
+    """
+    if method not in CALL_KEYS:
+        return None
+    keys = []
+    for kind, index in CALL_KEYS[method]:
+        name = args[index]
+        if not isinstance(name, str):
+            name = name.name  # e.g. DbDevInfo
+        keys.append((kind, name.lower()))
+    return keys
+
+
+def group_calls(calls):
+    """
+    Split the calls into "chains" of calls that concern the same
+    things, e.g. everything about a device. Different chains can be
+    performed at the same time, while the calls within a chain must
+    be done in order. Calls we don't know anything about can't run
+    at the same time as anything else.
+
+    Returns a list of stages, that must be performed one after the
+    other, each being a list of chains (of indices into calls).
+    """
+    stages = []
+    segment = []
+
+    def end_segment():
+        # Calls sharing any key end up in the same chain
+        parents = {}
+
+        def find(key):
+            while parents.setdefault(key, key) != key:
+                key = parents[key]
+            return key
+
+        for i, keys in segment:
+            root = find(keys[0])
+            for key in keys[1:]:
+                parents[find(key)] = root
+        chains = OrderedDict()
+        for i, keys in segment:
+            chains.setdefault(find(keys[0]), []).append(i)
+        if chains:
+            stages.append(list(chains.values()))
+        del segment[:]
+
+    for i, (method, args, kwargs) in enumerate(calls):
+        keys = get_call_keys(method, args)
+        if keys:
+            segment.append((i, keys))
+        else:
+            end_segment()
+            stages.append([[i]])
+    end_segment()
+    return stages
+
+
+def write_concurrently(calls, db_factory, jobs=4, limiter=None,
+                       progress=None, journal=None, retries=0, report=None):
+    """
+    Perform the calls using 'jobs' threads, each with its own Database
+    object made by 'db_factory'. Calls are made through the 'limiter'
+    (a RateLimiter) if given, and progress(n_done, n_total) is called
+    after each call. If a 'journal' is given, each call is recorded
+    in it (see dsconfig.journal). Transient errors are retried up to
+    'retries' times.
+
+    If a call fails, no more calls are started and the error is raised
+    once the calls already running are done. If a 'report' (a
+    FailureReport) is given, the failure is recorded in it instead,
+    and only the calls concerning the same things are skipped.
+    """
+    local = threading.local()
+    lock = threading.Lock()
+    failed = threading.Event()
+    done = [0]
+
+    def run_chain(chain):
+        if not hasattr(local, "db"):
+            local.db = db_factory()
+        for i in chain:
+            if failed.is_set():
+                return
+            method, args, kwargs = calls[i]
+            if report is not None and report.skip(i, calls[i]):
+                continue
+            func = getattr(local.db, method)
+            if journal:
+                journal.begin(i)
+            try:
+                make_call(func, args, kwargs, limiter, retries)
+            except tango.DevFailed as e:
+                if report is None or not report.keep_going:
+                    failed.set()
+                    raise
+                report.fail(i, calls[i], e)
+                continue
+            except Exception:
+                failed.set()
+                raise
+            if journal:
+                journal.done(i)
+            with lock:
+                done[0] += 1
+                if progress:
+                    progress(done[0], len(calls))
+
+    with ThreadPoolExecutor(jobs) as executor:
+        try:
+            for stage in group_calls(calls):
+                # Start with the longest chains, to finish sooner
+                stage = sorted(stage, key=len, reverse=True)
+                futures = [executor.submit(run_chain, chain)
+                           for chain in stage]
+                for future in futures:
+                    future.result()
+        except BaseException:
+            # e.g. Ctrl-C; let the running calls finish, but no more
+            failed.set()
+            raise
+
+
+def write_stream(calls, db_factory, jobs=4, limiter=None, progress=None,
+                 started=None, max_pending=1000, retries=0, report=None):
+    """
+    Like write_concurrently, but takes the calls from an iterator (e.g.
+    configure.iter_configure) and makes each call as soon as the
+    earlier calls concerning the same things are done. Calls we don't
+    know anything about wait for all earlier calls, and all later
+    calls wait for them. At most 'max_pending' calls are queued at a
+    time, so that the iterator doesn't run too far ahead.
+
+    progress(n_done) is called after each call, and each call is
+    appended to the 'started' list (if given) before it is made.
+    Failures are handled like in write_concurrently.
+    """
+    local = threading.local()
+    lock = threading.Lock()
+    failed = threading.Event()
+    slots = threading.BoundedSemaphore(max_pending)
+    done = [0]
+
+    def run(i, call, dependencies):
+        try:
+            wait(dependencies)
+            if failed.is_set():
+                return
+            if report is not None and report.skip(i, call):
+                return
+            if not hasattr(local, "db"):
+                local.db = db_factory()
+            method, args, kwargs = call
+            func = getattr(local.db, method)
+            if started is not None:
+                with lock:
+                    started.append(call)
+            try:
+                make_call(func, args, kwargs, limiter, retries)
+            except tango.DevFailed as e:
+                if report is None or not report.keep_going:
+                    failed.set()
+                    raise
+                report.fail(i, call, e)
+                return
+            except Exception:
+                failed.set()
+                raise
+            with lock:
+                done[0] += 1
+                if progress:
+                    progress(done[0])
+        finally:
+            slots.release()
+
+    latest = {}  # key: future of the latest call concerning it
+    barrier = None  # the latest call concerning anything
+    futures = []
+    with ThreadPoolExecutor(jobs) as executor:
+        try:
+            for i, (method, args, kwargs) in enumerate(calls):
+                if failed.is_set():
+                    break
+                slots.acquire()
+                keys = get_call_keys(method, args)
+                if keys is None:
+                    dependencies = [f for f in futures if not f.done()]
+                else:
+                    dependencies = [latest[key] for key in keys
+                                    if key in latest]
+                    if barrier is not None:
+                        dependencies.append(barrier)
+                future = executor.submit(run, i, (method, args, kwargs),
+                                         dependencies)
+                futures.append(future)
+                if keys is None:
+                    barrier = future
+                    latest.clear()
+                else:
+                    latest.update(dict.fromkeys(keys, future))
+                if i % max_pending == 0:
+                    # Forget about calls that went well
+                    futures = [f for f in futures
+                               if not f.done() or f.exception()]
+                    latest = dict((key, f) for key, f in latest.items()
+                                  if not f.done())
+            for future in futures:
+                future.result()
+        except BaseException:
+            # e.g. Ctrl-C; let the running calls finish, but no more
+            failed.set()
+            raise
+    return done[0]
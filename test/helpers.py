@@ -0,0 +1,14 @@
+"""
+Small helpers shared by the tests.
+"""
+
+import PyTango
+
+
+def make_devinfo(name, server, clss):
+    "A DbDevInfo, as passed to Database.add_device"
+    devinfo = PyTango.DbDevInfo()
+    devinfo.name = name
+    devinfo.server = server
+    devinfo._class = clss
+    return devinfo
@@ -0,0 +1,83 @@
+import os
+from unittest.mock import Mock
+
+from dsconfig.cache import PlanCache, SnapshotCache, is_settled
+from dsconfig.plan import Plan
+
+
+STAMP = ["2020-01-01 12:00:10", "10", "123456", "100",
+         "2020-01-01 12:00:00", "50", "2020-01-01 11:00:00",
+         "5", "2020-01-01 10:00:00", "0", ""]
+
+
+def make_cache(tmpdir, stamp):
+    db = Mock()
+    db.get_db_host.return_value = "tango-host"
+    db.get_db_port.return_value = "10000"
+    dbproxy = Mock()
+    dbproxy.command_inout.side_effect = lambda cmd, query: (None, stamp)
+    return SnapshotCache(db, directory=str(tmpdir), dbproxy=dbproxy)
+
+
+def test_is_settled():
+    assert is_settled(STAMP)
+    stamp = list(STAMP)
+    stamp[4] = stamp[0]  # changed in the same second
+    assert not is_settled(stamp)
+
+
+def test_snapshot_cache_reuses_snapshot(tmpdir):
+    cache = make_cache(tmpdir, STAMP)
+    fetch = Mock(return_value={"servers": {"a": {}}})
+    assert cache.get("scope", fetch) == {"servers": {"a": {}}}
+    assert cache.get("scope", fetch) == {"servers": {"a": {}}}
+    assert fetch.call_count == 1
+
+    # different scope
+    cache.get("other scope", fetch)
+    assert fetch.call_count == 2
+
+
+def test_snapshot_cache_refetches_when_db_changed(tmpdir):
+    fetch = Mock(return_value={})
+    make_cache(tmpdir, STAMP).get("scope", fetch)
+
+    stamp = list(STAMP)
+    stamp[0] = "2020-01-01 12:05:00"
+    make_cache(tmpdir, stamp).get("scope", fetch)
+    assert fetch.call_count == 1  # only the time changed
+
+    stamp[3] = "101"
+    make_cache(tmpdir, stamp).get("scope", fetch)
+    assert fetch.call_count == 2
+
+
+def test_plan_cache(tmpdir):
+    cache = PlanCache(directory=str(tmpdir))
+    calls = [("put_device_property", ("a/b/c", {"x": ["1"]}), {})]
+    compute = Mock(return_value=Plan(calls))
+    key = cache.key({"servers": {}}, {"servers": {"a": {}}}, update=False)
+    assert cache.get(key, compute) == calls
+    assert cache.get(key, compute) == calls
+    assert compute.call_count == 1
+
+    # anything different gives another key
+    assert key != cache.key({"servers": {}}, {"servers": {"b": {}}},
+                            update=False)
+    assert key != cache.key({"servers": {}}, {"servers": {"a": {}}},
+                            update=True)
+
+
+def test_plan_cache_evicts_oldest(tmpdir):
+    cache = PlanCache(directory=str(tmpdir))
+    plan = Plan([("put_device_property", ("a/b/c", {"x": ["1"] * 100}), {})])
+    for i in range(3):
+        cache.get("key%d" % i, lambda: plan)
+        path = cache.path("key%d" % i)
+        os.utime(path, (i, i))
+    size = os.path.getsize(cache.path("key0"))
+    cache.max_size = 2 * size
+    cache.get("key0", Mock())  # now the most recently used
+    cache.get("key3", lambda: plan)
+    assert sorted(os.listdir(str(tmpdir))) == [
+        "plan-key0.json.gz", "plan-key3.json.gz"]
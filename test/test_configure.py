@@ -1,11 +1,13 @@
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 try:
     from unittest2 import TestCase
 except ImportError:
     from unittest import TestCase
 
-from dsconfig.configure import (update_server, update_device_or_class,
+from dsconfig.configure import (configure, has_changes, iter_configure,
+                                update_server, update_device_or_class,
                                 update_properties)
 from dsconfig.formatting import CLASSES_LEVELS, SERVERS_LEVELS
 from dsconfig.utils import ObjectWrapper, find_device
@@ -155,6 +157,21 @@ class ConfigureTestCase(TestCase):
 
         self.assertEqual(len(self.db.calls), 0)
 
+    def test_update_server_ignore_attribute_property_case(self):
+
+        "Test that attribute property names can be case insensitive"
+
+        dev = find_device(self.data, "sys/tg_test/2", caseless=True)[0]
+        dev["attribute_properties"] = {
+            "AMPLIZ": {"Min_Value": ["100"], "unit": ["hejsan"]}}
+
+        update_server(self.db, "test",
+                      self.data["servers"]["TangoTest"]["test"],
+                      self.dbdict["servers"]["TangoTest"]["test"],
+                      ignore_case=True, difactory=Mock)
+
+        self.assertEqual(len(self.db.calls), 0)
+
     def test_update_server_remove_property(self):
 
         dev = find_device(self.data, "sys/tg_test/2")[0]
@@ -263,6 +280,56 @@ class ConfigureTestCase(TestCase):
 
     # === tests for update_class ===
 
+    def test_configure_jobs(self):
+        "Configuring in several processes gives the same calls"
+        servers = self.data["servers"]
+        servers["TangoTest"]["test"]["TangoTest"]["sys/tg_test/2"][
+            "properties"]["flepp"] = ["56"]
+        for i in range(5):
+            servers["TangoTest"][str(i)] = {
+                "TangoTest": {"sys/tg_test/%d0" % i: {"alias": "tg%d" % i}},
+                "OtherClass": {"sys/other/%d" % i: {
+                    "properties": {"a": [str(i)]}}}
+            }
+        serial = configure(self.data, self.dbdict)
+        with patch("dsconfig.configure.ProcessPoolExecutor",
+                   wraps=ProcessPoolExecutor) as executor:
+            parallel = configure(self.data, self.dbdict, jobs=3)
+        executor.assert_called_once_with(3)
+
+        def summary(calls):
+            return [(method, [getattr(arg, "name", arg) for arg in args])
+                    for method, args, kwargs in calls]
+
+        self.assertEqual(len(serial), 21)
+        self.assertListEqual(summary(parallel), summary(serial))
+
+    def test_iter_configure(self):
+        servers = self.data["servers"]
+        for i in range(3):
+            servers["TangoTest"][str(i)] = {
+                "TangoTest": {"sys/tg_test/%d0" % i: {"alias": "tg%d" % i}}}
+        self.data["classes"]["TangoTest"]["properties"]["banana"] = ["green"]
+        calls = iter_configure(self.data, self.dbdict)
+        # the first calls come before the rest are worked out
+        method, args, _ = next(calls)
+        self.assertEqual(method, "add_device")
+        self.assertEqual(args[0].name, "sys/tg_test/00")
+        rest = list(calls)
+        self.assertEqual([method for method, _, _ in rest],
+                         ["put_device_alias"] + 2 * ["add_device",
+                                                     "put_device_alias"]
+                         + ["put_class_property"])
+
+    def test_has_changes(self):
+        self.assertFalse(has_changes(self.data, self.dbdict))
+        dev = find_device(self.data, "sys/tg_test/2")[0]
+        dev["properties"]["flepp"] = ["56"]
+        self.assertTrue(has_changes(self.data, self.dbdict))
+        self.data = deepcopy(TEST_DATA)
+        self.data["classes"]["TangoTest"]["properties"]["banana"] = ["green"]
+        self.assertTrue(has_changes(self.data, self.dbdict))
+
     def test_update_device_or_class_add_property(self):
         new_classname = "SomeClass"
         cls = {"properties": {"test": ["hello"]}}
@@ -0,0 +1,142 @@
+from copy import deepcopy
+from unittest.mock import patch
+
+from dsconfig.configure import configure, iter_configure
+from dsconfig.digest import (device_digest, get_digests, same_digest,
+                             get_entity_digests)
+
+
+SERVERS = {
+    "TangoTest": {
+        "1": {
+            "TangoTest": {
+                "sys/tg_test/1": {
+                    "properties": {"a": ["1"], "b": ["2", "3"]},
+                    "attribute_properties": {"ampliz": {"unit": ["V"]}},
+                    "alias": "test1"
+                },
+                "sys/tg_test/2": {"properties": {"a": ["2"]}}
+            }
+        }
+    }
+}
+
+
+def test_device_digest():
+    dev = {"properties": {"a": ["1"], "b": ["2"]}, "alias": "x"}
+    reordered = {"alias": "x", "properties": {"b": ["2"], "a": ["1"]}}
+    assert device_digest(dev) == device_digest(reordered)
+    assert device_digest(dev) != device_digest(dict(dev, alias="y"))
+    # other keys don't matter to configure
+    assert device_digest(dev) == device_digest(dict(dev, comment="hello"))
+
+
+def test_device_digest_ignore_case():
+    dev = {"properties": {"a": ["1"]}}
+    upper = {"properties": {"A": ["1"]}}
+    assert device_digest(dev) != device_digest(upper)
+    assert device_digest(dev, True) == device_digest(upper, True)
+    # values are still case sensitive
+    assert device_digest(dev, True) != device_digest(
+        {"properties": {"a": ["X"]}}, True)
+
+
+def test_device_digest_not_comparable():
+    # an empty value means "remove", so it can't match anything
+    assert device_digest({"properties": {"a": []}}) is None
+    assert device_digest(
+        {"attribute_properties": {"attr": {"unit": []}}}) is None
+    # names that only differ in case
+    assert device_digest({"properties": {"a": ["1"], "A": ["2"]}}) is not None
+    assert device_digest({"properties": {"a": ["1"], "A": ["2"]}}, True) is None
+
+
+def test_get_digests():
+    digests = get_digests(SERVERS)
+    assert set(digests) == {
+        ("TangoTest/1",),
+        ("TangoTest/1", "TangoTest"),
+        ("TangoTest/1", "TangoTest", "sys/tg_test/1"),
+        ("TangoTest/1", "TangoTest", "sys/tg_test/2"),
+    }
+    changed = deepcopy(SERVERS)
+    changed["TangoTest"]["1"]["TangoTest"]["sys/tg_test/2"]["alias"] = "x"
+    other = get_digests(changed)
+    assert not same_digest(digests, other, ("TangoTest/1",))
+    assert not same_digest(digests, other, ("TangoTest/1", "TangoTest"))
+    assert same_digest(digests, other,
+                       ("TangoTest/1", "TangoTest", "sys/tg_test/1"))
+    assert not same_digest(digests, other,
+                           ("TangoTest/1", "TangoTest", "sys/tg_test/2"))
+
+
+def test_get_digests_ignore_case():
+    digests = get_digests(SERVERS, ignore_case=True)
+    assert ("TangoTest/1", "tangotest", "sys/tg_test/1") in digests
+    upper = {"TangoTest": {"1": {"TANGOTEST": {
+        name.upper(): dev for name, dev
+        in SERVERS["TangoTest"]["1"]["TangoTest"].items()}}}}
+    assert same_digest(digests, get_digests(upper, ignore_case=True),
+                       ("TangoTest/1",))
+
+
+def test_configure_skips_unchanged_devices():
+    data = {"servers": deepcopy(SERVERS)}
+    dev = data["servers"]["TangoTest"]["1"]["TangoTest"]["sys/tg_test/2"]
+    dev["properties"]["a"] = ["3"]
+    with patch("dsconfig.configure.update_device") as update_device:
+        configure({"servers": SERVERS}, {"servers": SERVERS})
+        assert not update_device.called
+        configure(data, {"servers": SERVERS})
+    assert update_device.call_count == 1
+    assert update_device.call_args[0][1] == "sys/tg_test/2"
+
+
+def test_get_digests_scope():
+    dbdata = deepcopy(SERVERS)
+    dbdata["TangoTest"]["1"]["DServer"] = {"dserver/TangoTest/1": {}}
+    digests = get_digests(SERVERS)
+    assert not same_digest(digests, get_digests(dbdata), ("TangoTest/1",))
+    assert same_digest(digests, get_digests(dbdata, scope=SERVERS),
+                       ("TangoTest/1",))
+    # a class missing in the DB still makes a difference
+    assert not same_digest(digests, get_digests({}, scope=SERVERS),
+                           ("TangoTest/1",))
+
+
+def test_configure_skips_instances_with_dservers():
+    # DB data always has the DServer class, the config usually not
+    dbdata = {"servers": deepcopy(SERVERS)}
+    dbdata["servers"]["TangoTest"]["1"]["DServer"] = {
+        "dserver/TangoTest/1": {}}
+    with patch("dsconfig.configure.update_server") as update_server:
+        assert configure({"servers": SERVERS}, dbdata) == []
+        assert list(iter_configure({"servers": SERVERS}, dbdata)) == []
+    assert not update_server.called
+
+
+def test_configure_with_digests():
+    data = {"servers": deepcopy(SERVERS)}
+    dev = data["servers"]["TangoTest"]["1"]["TangoTest"]["sys/tg_test/2"]
+    dev["properties"]["a"] = ["3"]
+    calls = configure(data, {"servers": SERVERS},
+                      digests=get_digests(data["servers"]),
+                      db_digests=get_digests(SERVERS))
+    assert calls == [
+        ("put_device_property", ("sys/tg_test/2", {"a": ["3"]}), {})]
+
+
+def test_get_entity_digests():
+    keys = [("device", "sys/tg_test/1"), ("device", "sys/tg_test/3"),
+            ("class", "tangotest"), ("alias", "test1")]
+    digests = get_entity_digests({"servers": SERVERS}, keys)
+    assert set(digests) == set(keys[:3])
+    moved = {"Other": {"1": deepcopy(SERVERS["TangoTest"]["1"])}}
+    assert get_entity_digests({"servers": moved}, keys) != digests
+    changed = deepcopy(SERVERS)
+    changed["TangoTest"]["1"]["TangoTest"]["sys/tg_test/2"] = {}
+    # only the devices asked for matter
+    assert get_entity_digests({"servers": changed}, keys) == digests
+    with_class = {"servers": SERVERS,
+                  "classes": {"TangoTest": {"properties": {"c": ["1"]}}}}
+    assert get_entity_digests(with_class, keys) != digests
@@ -1,10 +1,16 @@
 import json
 
+import pytest
+from io import StringIO
+
 from unittest.mock import MagicMock, patch
 from os.path import dirname, abspath, join
 
 from .test_tangodb import make_db
-from dsconfig.dump import get_db_data
+from dsconfig.dump import (get_db_data, get_db_data_for_config, write_servers,
+                           dump_db_data)
+from dsconfig.history import TIMESTAMP_KEY
+from dsconfig.tangodb import compile_patterns
 
 
 query1 = ("SELECT device, property_device.name, property_device.value FROM "
@@ -36,28 +42,29 @@ query5 = ("select DISTINCT  property_attribute_class.class, "
           "device.class != 'TangoAccessControl' "
           "ORDER BY property_attribute_class.count ASC")
           
+where = ("(device.server = 'SOMESERVER' OR device.class = 'SOMECLASS' OR "
+         "device.name LIKE 'SOMEDEVICE/%')")
+
 query6 = ("select DISTINCT  property_attribute_class.class, "
           "property_attribute_class.attribute, property_attribute_class.name, "
           "property_attribute_class.value FROM property_attribute_class INNER JOIN "
-          "device ON property_attribute_class.class = device.class WHERE server "
-          "like 'SOMEDEVICE' AND device.class != 'DServer' AND "
+          "device ON property_attribute_class.class = device.class WHERE " + where +
+          " AND device.class != 'DServer' AND "
           "device.class != 'TangoAccessControl' "
           "ORDER BY property_attribute_class.count ASC")
-          
+
 query7 = ("select DISTINCT property_class.class, property_class.name, "
           "property_class.value FROM property_class INNER JOIN device ON "
-          "property_class.class = device.class WHERE server like 'SOMEDEVICE' AND "
+          "property_class.class = device.class WHERE " + where + " AND "
           "device.class != 'DServer' AND device.class != 'TangoAccessControl' "
           "ORDER BY property_class.count ASC")
-          
+
 query8 = ("SELECT device, attribute, property_attribute_device.name, "
           "property_attribute_device.value FROM property_attribute_device INNER JOIN "
-          "device ON property_attribute_device.device = device.name WHERE server "
-          "LIKE 'SOMESERVER' AND class LIKE '%' AND device LIKE '%' AND "
-          "class != 'DServer' "
+          "device ON property_attribute_device.device = device.name WHERE " + where +
+          " AND class != 'DServer' "
           "ORDER BY property_attribute_device.count ASC")
 
-
 def test_db_dump():
     json_data_file = join(dirname(abspath(__file__)), 'files', 'sample_db.json')
     with open(json_data_file, 'r') as json_file:
@@ -80,9 +87,97 @@ def test_db_dump():
             in_out_mock.assert_any_call('DbMySqlSelect', query5)
 
             in_out_mock.reset_mock()
+            # all the patterns are combined into one set of queries
             get_db_data(db, patterns=["server:SOMESERVER", 'clss:SOMECLASS',
-                                      'device:SOMEDEVICE'], class_properties=True)
-            assert in_out_mock.call_count == 15
+                                      'device:SOMEDEVICE/*', "server:SOMESERVER"],
+                        class_properties=True)
+            assert in_out_mock.call_count == 5
             in_out_mock.assert_any_call('DbMySqlSelect', query6)
             in_out_mock.assert_any_call('DbMySqlSelect', query7)
             in_out_mock.assert_any_call('DbMySqlSelect', query8)
+
+
+def test_write_servers_streams_valid_json():
+    devices = [
+        ("TangoTest", "1", "TangoTest", "sys/tg_test/1",
+         {"properties": {"a": ["1"]}}),
+        ("TangoTest", "1", "TangoTest", "sys/tg_test/2", {}),
+        ("TangoTest", "2", "TangoTest", "sys/tg_test/3", {"alias": "x"}),
+        ("Other", "1", "OtherClass", "a/b/c", {}),
+    ]
+    out = StringIO()
+    write_servers(iter(devices), out)
+    assert json.loads(out.getvalue()) == {
+        "TangoTest": {
+            "1": {"TangoTest": {"sys/tg_test/1": {"properties": {"a": ["1"]}},
+                                "sys/tg_test/2": {}}},
+            "2": {"TangoTest": {"sys/tg_test/3": {"alias": "x"}}}
+        },
+        "Other": {"1": {"OtherClass": {"a/b/c": {}}}}
+    }
+
+
+def test_dump_db_data_timestamp():
+    devices = [("TangoTest", "1", "TangoTest", "sys/tg_test/1", {})]
+    out = StringIO()
+    with patch("dsconfig.dump.tango"), \
+            patch("dsconfig.dump.iter_db_devices", return_value=iter(devices)):
+        dump_db_data(MagicMock(), out, timestamp="2020-01-31 12:00:00")
+    assert json.loads(out.getvalue()) == {
+        TIMESTAMP_KEY: "2020-01-31 12:00:00",
+        "servers": {"TangoTest": {"1": {"TangoTest": {"sys/tg_test/1": {}}}}}
+    }
+
+
+def test_get_db_data_for_config_is_scoped():
+    config = {
+        "servers": {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": {"sys/tg_test/1": {}}
+                }
+            }
+        },
+        "classes": {"TangoTest": {}}
+    }
+
+    def command_inout(cmd, query):
+        if query.startswith("SELECT server"):
+            return None, ["TangoTest/test", "TangoTest", "sys/tg_test/1", "",
+                          "TangoTest/test", "TangoTest", "sys/tg_test/2", ""]
+        return None, []
+
+    with patch('dsconfig.dump.tango') as mocked_pytango:
+        proxy = MagicMock(name='device_proxy_mock')
+        proxy.command_inout.side_effect = command_inout
+        mocked_pytango.DeviceProxy.return_value = proxy
+        data = get_db_data_for_config(MagicMock(), config, dservers=True)
+
+    assert data == {
+        "servers": {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": {"sys/tg_test/1": {}, "sys/tg_test/2": {}}
+                }
+            }
+        },
+        "classes": {}
+    }
+    queries = [args[1] for args, _ in proxy.command_inout.call_args_list]
+    assert len(queries) == 8
+    assert ("SELECT server, class, name, alias FROM device"
+            " WHERE device.server IN ('TangoTest/test')") in queries
+    assert ("SELECT server, class, name, alias FROM device"
+            " WHERE device.name IN ('sys/tg_test/1')") in queries
+    assert all("LIKE" not in query for query in queries)
+
+
+def test_compile_patterns():
+    assert compile_patterns(["server:TangoTest/*", "device:sys/tg_test/1",
+                             "clss:TangoTest", "server:TangoTest/*"]) == (
+        "(device.server LIKE 'TangoTest/%' OR "
+        "device.name = 'sys/tg_test/1' OR device.class = 'TangoTest')")
+    with pytest.raises(ValueError):
+        compile_patterns(["property:a"])
+    with pytest.raises(ValueError):
+        compile_patterns(["TangoTest/1"])
@@ -0,0 +1,84 @@
+from unittest.mock import MagicMock, patch
+
+from dsconfig.history import get_db_data_since, TIMESTAMP_KEY
+
+
+BASELINE = {
+    "servers": {
+        "TangoTest": {
+            "1": {
+                "TangoTest": {
+                    "sys/tg_test/1": {"properties": {"a": ["1"]}},
+                    "sys/tg_test/2": {"properties": {"b": ["2"]},
+                                      "alias": "tg2"},
+                    "sys/tg_test/3": {"properties": {"c": ["3"]}}
+                }
+            }
+        }
+    },
+    TIMESTAMP_KEY: "2020-01-01 12:00:00"
+}
+
+
+def make_proxy(queries):
+
+    def command_inout(cmd, query):
+        queries.append(query)
+        if query == "SELECT NOW()":
+            return None, ["2020-01-02 12:00:00"]
+        if query.startswith("SELECT DISTINCT device FROM property_device_hist"):
+            return None, ["SYS/TG_TEST/1"]
+        if query.startswith("SELECT DISTINCT device"):
+            return None, []
+        if query.startswith("SELECT server, class, name, alias FROM device"
+                            " WHERE server LIKE"):
+            return None, [
+                "TangoTest/1", "TangoTest", "sys/tg_test/1", "",
+                "TangoTest/2", "TangoTest", "sys/tg_test/2", "",
+                "TangoTest/1", "TangoTest", "sys/tg_test/4", ""]
+        if query.startswith("SELECT device, property_device.name"):
+            return None, ["sys/tg_test/1", "a", "10",
+                          "sys/tg_test/4", "d", "4"]
+        if query.startswith("SELECT server"):
+            return None, [
+                "TangoTest/1", "TangoTest", "sys/tg_test/1", "",
+                "TangoTest/1", "TangoTest", "sys/tg_test/4", ""]
+        return None, []
+
+    proxy = MagicMock()
+    proxy.command_inout.side_effect = command_inout
+    return proxy
+
+
+def test_get_db_data_since_patches_baseline():
+    queries = []
+    with patch("dsconfig.history.tango") as mocked_tango:
+        mocked_tango.DeviceProxy.return_value = make_proxy(queries)
+        data, report = get_db_data_since(
+            MagicMock(), BASELINE, BASELINE[TIMESTAMP_KEY])
+
+    assert data == {
+        "servers": {
+            "TangoTest": {
+                "1": {
+                    "TangoTest": {
+                        "sys/tg_test/1": {"properties": {"a": ["10"]}},
+                        "sys/tg_test/4": {"properties": {"d": ["4"]}}
+                    }
+                },
+                "2": {
+                    "TangoTest": {
+                        "sys/tg_test/2": {"properties": {"b": ["2"]}}
+                    }
+                }
+            }
+        },
+        TIMESTAMP_KEY: "2020-01-02 12:00:00"
+    }
+    assert report["added"] == ["sys/tg_test/4"]
+    assert report["removed"] == ["sys/tg_test/3"]
+    assert report["moved"] == ["sys/tg_test/2"]
+    assert report["changed"] == ["sys/tg_test/1", "sys/tg_test/2"]
+    # only the changed and new devices are read again
+    assert any("device.name IN ('sys/tg_test/1', 'sys/tg_test/4')" in query
+               for query in queries)
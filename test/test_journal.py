@@ -0,0 +1,73 @@
+from unittest.mock import MagicMock, patch
+
+from dsconfig.journal import Journal, load_journal, get_remaining_calls
+
+from .helpers import make_devinfo
+
+
+CALLS = [
+    ("add_device", (make_devinfo("a/b/c", "TangoTest/1", "TangoTest"),), {}),
+    ("put_device_property", ("a/b/c", {"x": ["1", "2"]}), {}),
+    ("delete_device_property", ("a/b/d", {"y": ["3"]}), {}),
+    ("put_device_attribute_property",
+     ("a/b/c", {"attr": {"unit": ["V"]}}), {}),
+    ("put_device_alias", ("a/b/d", "my_alias"), {}),
+    ("put_class_property", ("TangoTest", {"z": ["4"]}), {}),
+]
+
+
+def test_journal_roundtrip(tmpdir):
+    path = str(tmpdir.join("journal.jsonl"))
+    journal = Journal(path, CALLS)
+    journal.begin(0)
+    journal.done(0)
+    journal.begin(1)
+    journal.close()
+    # a crash in the middle of a line
+    with open(path, "a") as f:
+        f.write('{"do')
+
+    calls, begun, done = load_journal(path)
+    assert begun == {0, 1}
+    assert done == {0}
+    assert [method for method, _, _ in calls] == [m for m, _, _ in CALLS]
+    assert calls[1:] == CALLS[1:]
+    devinfo = calls[0][1][0]
+    assert (devinfo.name, devinfo.server, devinfo._class) == (
+        "a/b/c", "TangoTest/1", "TangoTest")
+
+    # resuming appends to the same journal
+    journal = Journal(path).subset([3, 4])
+    journal.done(1)
+    journal.journal.close()
+    _, _, done = load_journal(path)
+    assert done == {0, 4}
+
+
+def test_get_remaining_calls():
+    dbdata = {
+        "servers": {
+            "TangoTest": {
+                "1": {
+                    "TangoTest": {
+                        "A/B/C": {
+                            "properties": {"x": ["1", "2"]},
+                            "attribute_properties": {"attr": {"unit": ["mV"]}}
+                        },
+                        "a/b/d": {"properties": {"y": ["3"]}}
+                    }
+                }
+            }
+        },
+        "classes": {"TangoTest": {"properties": {"z": ["4"]}}}
+    }
+    with patch("dsconfig.journal.get_db_data_for_scope",
+               return_value=dbdata) as get_data:
+        remaining = get_remaining_calls(MagicMock(), CALLS, done={0})
+    # x and z are already there, but y is not deleted, the attribute
+    # property is different and there is no alias
+    assert remaining == [2, 3, 4]
+    _, kwargs = get_data.call_args
+    assert kwargs["devices"] == {"a/b/c", "a/b/d"}
+    assert kwargs["classes"] == {"tangotest"}
+    assert kwargs["device_aliases"] == {"my_alias"}
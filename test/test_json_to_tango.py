@@ -1,7 +1,10 @@
 from os.path import dirname, abspath, join
 from unittest.mock import MagicMock, patch
 
+import pytest
+
 from dsconfig.json2tango import json_to_tango
+from dsconfig.utils import CONFIG_NOT_APPLIED, ERROR
 
 
 def test_json_to_tango(capsys):
@@ -26,9 +29,30 @@ def test_json_to_tango(capsys):
     options.include_classes = []
     options.exclude_classes = ['class:SOMECLASS']
     options.dbdata = False
+    options.query_jobs = 1
+    options.cache = False
+    options.server_cache = False
+    options.batch = False
+    options.jobs = 1
+    options.diff_jobs = 1
+    options.check = False
+    options.stream = False
+    options.plan_cache = False
+    options.verify = False
+    options.keep_going = False
+    options.retries = 3
+    options.failure_report = None
+    options.journal = None
+    options.resume = None
+    options.undo = None
+    options.plan_out = None
+    options.apply_plan = None
+    options.read_host = None
+    options.check_conflicts = False
+    options.target_latency = 0.1
 
     with patch('dsconfig.json2tango.tango'):
-        with patch('dsconfig.json2tango.get_db_data') as mocked_get_db_data:
+        with patch('dsconfig.json2tango.get_db_data_for_config') as mocked_get_db_data:
             try:
                 json_to_tango(options, args)
             except SystemExit: # The script exits with SystemExit even when successful
@@ -50,3 +74,69 @@ def test_json_to_tango(capsys):
                 assert "  Class: Individual" in captured.out
                 assert "  Properties:" in captured.out
                 assert "    + PartnerTell" in captured.out
+
+
+def test_json_to_tango_check(capsys):
+    json_data_file = join(dirname(abspath(__file__)), 'files', 'sample_db.json')
+    options = MagicMock()
+    options.dbdata = False
+    options.input = False
+    options.cache = False
+    options.query_jobs = 1
+    options.include = options.exclude = None
+    options.include_classes = options.exclude_classes = None
+    options.resume = options.undo = options.apply_plan = None
+    options.update = False
+    options.case_sensitive = False
+    options.nostrictcheck = False
+    options.check = True
+    options.read_host = None
+
+    with patch('dsconfig.json2tango.tango'):
+        with patch('dsconfig.json2tango.get_db_data_for_config',
+                   return_value={"servers": {}, "classes": {}}):
+            with patch('dsconfig.json2tango.show_actions') as show_actions:
+                with pytest.raises(SystemExit) as exit_info:
+                    json_to_tango(options, [json_data_file])
+    assert exit_info.value.code == CONFIG_NOT_APPLIED
+    assert not show_actions.called
+    assert "does not match" in capsys.readouterr().err
+
+
+def test_json_to_tango_read_host(capsys):
+    json_data_file = join(dirname(abspath(__file__)), 'files', 'sample_db.json')
+    options = MagicMock()
+    options.write = True
+    options.dbdata = False
+    options.input = False
+    options.cache = False
+    options.query_jobs = 1
+    options.include = options.exclude = None
+    options.include_classes = options.exclude_classes = None
+    options.resume = options.undo = options.apply_plan = None
+    options.update = False
+    options.case_sensitive = False
+    options.nostrictcheck = False
+    options.check = options.stream = options.plan_cache = False
+    options.diff_jobs = 1
+    options.plan_out = None
+    options.verbose = False
+    options.read_host = "replica:10000"
+    options.check_conflicts = False
+
+    with patch('dsconfig.json2tango.tango') as tango, \
+            patch('dsconfig.json2tango.get_database') as get_database, \
+            patch('dsconfig.json2tango.get_db_data_for_config',
+                  return_value={"servers": {}, "classes": {}}) as get_data, \
+            patch('dsconfig.json2tango.find_stale',
+                  return_value=["a/b/c"]) as find_stale, \
+            patch('dsconfig.json2tango.write_with_undo') as write:
+        with pytest.raises(SystemExit) as exit_info:
+            json_to_tango(options, [json_data_file])
+    get_database.assert_called_once_with("replica:10000")
+    # read from the replica, checked against the primary
+    assert get_data.call_args[0][0] is get_database.return_value
+    assert find_stale.call_args[0][0] is tango.Database.return_value
+    assert exit_info.value.code == ERROR
+    assert not write.called
+    assert "out of date" in capsys.readouterr().err
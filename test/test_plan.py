@@ -0,0 +1,62 @@
+import pytest
+
+from dsconfig.plan import Call, Plan, save_plan, load_plan, add_digests
+
+from .helpers import make_devinfo
+
+
+CALLS = [
+    ("add_device", (make_devinfo("a/b/c", "TangoTest/1", "TangoTest"),), {}),
+    ("put_device_property", ("a/b/c", {"x": ["1", "2"]}), {}),
+    ("put_device_property", ("a/b/d", {"y": ["3"]}), {}),
+    ("put_device_alias", ("A/B/C", "my_alias"), {}),
+    ("put_class_property", ("TangoTest", {"z": ["4"]}), {}),
+    ("delete_server", ("TangoTest/2",), {}),
+]
+
+
+def test_plan_is_like_a_list_of_calls():
+    plan = Plan(CALLS)
+    assert len(plan) == 6
+    assert plan == CALLS
+    assert plan[1] == Call("put_device_property", ("a/b/c", {"x": ["1", "2"]}),
+                           {})
+    assert plan[1].method == "put_device_property"
+    for method, args, kwargs in plan:
+        assert isinstance(method, str)
+    assert not Plan()
+
+
+def test_plan_indexes():
+    plan = Plan(CALLS)
+    assert plan.by_method("put_device_property") == CALLS[1:3]
+    assert plan.by_method("delete_device") == []
+    assert plan.by_name("A/B/C") == CALLS[:2] + CALLS[3:4]
+    assert plan.by_name("my_alias", kind="alias") == CALLS[3:4]
+    assert plan.by_name("tangotest", kind="class") == CALLS[4:5]
+    assert plan.methods()["put_device_property"] == 2
+
+
+@pytest.mark.parametrize("filename", ["plan.json", "plan.json.gz"])
+def test_save_and_load_plan(tmpdir, filename):
+    path = str(tmpdir.join(filename))
+    save_plan(Plan(CALLS), path)
+    plan = load_plan(path)
+    assert plan[1:] == tuple(CALLS[1:])
+    devinfo = plan[0].args[0]
+    assert (devinfo.name, devinfo.server, devinfo._class) == (
+        "a/b/c", "TangoTest/1", "TangoTest")
+
+
+def test_plan_digests(tmpdir):
+    dbdata = {"servers": {"TangoTest": {"1": {"TangoTest": {
+        "a/b/c": {"properties": {"x": ["1"]}}}}}}, "classes": {}}
+    plan = add_digests(Plan(CALLS), dbdata)
+    assert set(plan.digests) == {("device", "a/b/c"), ("device", "a/b/d"),
+                                 ("class", "tangotest")}
+    assert plan == CALLS
+    path = str(tmpdir.join("plan.json"))
+    save_plan(plan, path)
+    assert load_plan(path).digests == plan.digests
+    save_plan(Plan(CALLS), path)
+    assert load_plan(path).digests is None
@@ -1,8 +1,13 @@
 import PyTango
 import pytest
-from dsconfig.tangodb import get_dict_from_db, get_servers_with_filters
+from dsconfig.tangodb import (get_dict_from_db, get_dict_from_db_bulk,
+                              get_servers_with_filters,
+                              get_servers_from_server_cache,
+                              iter_servers_with_filters, select, ProxyPool,
+                              get_database, split_server_pattern,
+                              get_classes_properties)
 from dsconfig.utils import ObjectWrapper, find_device
-from unittest.mock import Mock, MagicMock, create_autospec
+from unittest.mock import Mock, MagicMock, create_autospec, patch
 
 
 def make_db(dbdata):
@@ -80,3 +85,314 @@ def test_get_props_with_mixed_case():
     assert data["TangoTest"]["1"]["TangoTest"]["A/B/C"]["properties"]["prop2"] == [
         "prop2 line 1",
         "prop2 line 2"]
+
+
+def test_iter_servers_with_filters_pages():
+    db = create_autospec(PyTango.Database)
+    query_results = [
+        # first page of devices
+        (None, [
+            "TangoTest/1", "TangoTest", "a/b/c", "",
+            "TangoTest/1", "TangoTest", "a/b/d", "some_alias",
+        ]),
+        (None, [
+            "A/B/C", "prop1", "prop1 line 1",
+            "a/b/d", "prop2", "prop2 line 1",
+            "a/b/c", "prop1", "prop1 line 2",
+        ]),
+        # second (last) page of devices
+        (None, [
+            "TangoTest/2", "TangoTest", "a/b/e", "",
+        ]),
+        (None, []),
+    ]
+    db.command_inout = Mock(side_effect=query_results)
+    devices = list(iter_servers_with_filters(
+        db, attribute_properties=False, page_size=2))
+    assert devices == [
+        ("TangoTest", "1", "TangoTest", "a/b/c",
+         {"properties": {"prop1": ["prop1 line 1", "prop1 line 2"]}}),
+        ("TangoTest", "1", "TangoTest", "a/b/d",
+         {"properties": {"prop2": ["prop2 line 1"]}, "alias": "some_alias"}),
+        ("TangoTest", "2", "TangoTest", "a/b/e", {}),
+    ]
+    assert db.command_inout.call_count == 4
+    _, second_page_query = db.command_inout.call_args_list[2][0]
+    assert ("server > 'TangoTest/1' OR (server = 'TangoTest/1' AND "
+            "(class > 'TangoTest' OR (class = 'TangoTest' AND "
+            "name > 'a/b/d')))") in second_page_query
+    assert second_page_query.endswith("LIMIT 2")
+
+
+def test_proxy_pool_select():
+    def make_proxy(devname):
+        proxy = Mock()
+        proxy.command_inout.side_effect = lambda cmd, query: (None, [query])
+        return proxy
+    pool = ProxyPool("sys/database/2", size=3, factory=make_proxy)
+    results = pool.select([("a", "SELECT 1"), ("b", "SELECT 2"),
+                           ("c", "SELECT 3"), ("d", "SELECT 4")])
+    assert results == {"a": ["SELECT 1"], "b": ["SELECT 2"],
+                       "c": ["SELECT 3"], "d": ["SELECT 4"]}
+    assert sorted(name for name, _ in pool.timings) == [
+        "a", "b", "c", "d", "wall time"]
+    assert pool.summary()[-1].startswith("Sum of queries:")
+
+
+def test_get_dict_from_db_bulk():
+
+    indata = {
+        "servers": {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": {
+                        "sys/tg_test/1": {
+                            "attribute_properties": {
+                                "Ampli": {"unit": ["V"]}
+                            }
+                        },
+                        "sys/tg_test/2": {}
+                    }}}}}
+
+    query_results = [
+        # locations and aliases of the input devices
+        (None, ["sys/tg_test/1", "TangoTest/test", "TangoTest", "",
+                "sys/tg_test/2", "TangoTest/other", "TangoTest", "tg2"]),
+        # devices in the input servers
+        (None, ["TangoTest/test", "TangoTest", "SYS/TG_TEST/1", "",
+                "TangoTest/test", "TangoTest", "sys/tg_test/3", ""]),
+        # device properties
+        (None, ["sys/tg_test/1", "a", "1",
+                "sys/tg_test/1", "a", "2",
+                "sys/tg_test/1", "polled_attr", "ampli",
+                "sys/tg_test/3", "b", "3"]),
+        # attribute properties
+        (None, ["sys/tg_test/1", "ampli", "unit", "mV",
+                "sys/tg_test/1", "ampli", "format", "%3.1f",
+                "sys/tg_test/1", "double_scalar", "unit", "A"]),
+    ]
+    db = create_autospec(PyTango.Database)
+    db.get_class_property.return_value = {}
+    proxy = Mock()
+    proxy.command_inout = Mock(side_effect=query_results)
+    with patch("dsconfig.tangodb.tango.DeviceProxy", return_value=proxy):
+        dbdict, moved = get_dict_from_db_bulk(db, indata)
+
+    assert dbdict == {
+        "servers": {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": {
+                        "SYS/TG_TEST/1": {
+                            "properties": {"a": ["1", "2"]},
+                            "attribute_properties": {
+                                "Ampli": {"unit": ["mV"]}
+                            }
+                        },
+                        "sys/tg_test/3": {
+                            "properties": {"b": ["3"]}
+                        }
+                    }}}}}
+    assert moved == {"TangoTest/other": [("TangoTest", "sys/tg_test/2")]}
+
+
+def make_timeout_error():
+    error = PyTango.DevError()
+    error.reason = "API_DeviceTimedOut"
+    return PyTango.DevFailed(error)
+
+
+def test_select_retries_with_longer_timeout():
+    proxy = Mock()
+    proxy.command_inout.side_effect = [make_timeout_error(),
+                                       make_timeout_error(),
+                                       (None, ["a", "b"])]
+    with patch("dsconfig.tangodb.time.sleep") as sleep:
+        assert select(proxy, "SELECT 1", timeout=10, retries=3) == ["a", "b"]
+    assert [args[0] for args, _ in proxy.set_timeout_millis.call_args_list] \
+        == [10000, 20000, 40000]
+    assert sleep.call_count == 2
+
+
+def test_select_does_not_retry_other_errors():
+    error = PyTango.DevError()
+    error.reason = "DB_SQLError"
+    proxy = Mock()
+    proxy.command_inout.side_effect = PyTango.DevFailed(error)
+    with patch("dsconfig.tangodb.time.sleep") as sleep:
+        with pytest.raises(PyTango.DevFailed):
+            select(proxy, "SELECT nonsense", retries=3)
+    assert proxy.command_inout.call_count == 1
+    assert not sleep.called
+
+
+def test_get_servers_with_filters_splits_on_timeout():
+
+    def command_inout(cmd, query):
+        if "LEFT(server, 1)" in query:
+            return None, ["A", "B"]
+        if "server LIKE '%'" in query:
+            raise make_timeout_error()
+        if query.startswith("SELECT server") and "LIKE 'A%'" in query:
+            return None, ["A/1", "Cls", "a/b/c", ""]
+        if query.startswith("SELECT server") and "LIKE 'B%'" in query:
+            return None, ["B/1", "Cls", "d/e/f", ""]
+        return None, []
+
+    proxy = Mock()
+    proxy.command_inout.side_effect = command_inout
+    with patch("dsconfig.tangodb.time.sleep"):
+        servers = get_servers_with_filters(proxy, retries=1)
+    assert servers.to_dict() == {"A": {"1": {"Cls": {"a/b/c": {}}}},
+                                 "B": {"1": {"Cls": {"d/e/f": {}}}}}
+
+
+def test_get_classes_properties_splits_on_timeout():
+
+    def command_inout(cmd, query):
+        if "LEFT(server, 1)" in query:
+            return None, ["A", "B"]
+        if "server like '%'" in query:
+            raise make_timeout_error()
+        if "property_class.value" in query:
+            # the class is used by servers in both parts
+            return None, ["Foo", "p", "1"]
+        return None, []
+
+    proxy = Mock()
+    proxy.command_inout.side_effect = command_inout
+    with patch("dsconfig.tangodb.time.sleep"):
+        classes = get_classes_properties(proxy, retries=1)
+    assert classes.to_dict() == {"Foo": {"properties": {"p": ["1"]}}}
+
+
+def test_split_server_pattern_escapes_prefixes():
+    proxy = Mock()
+    proxy.command_inout.return_value = (None, ["Foo_", "Foo%", "Foo"])
+    assert split_server_pattern(proxy, "Foo*") == [
+        "Foo", "Foo\\%%", "Foo\\_%"]
+    query = proxy.command_inout.call_args[0][1]
+    assert "LEFT(server, 4)" in query
+    # The escaped characters only count as one
+    proxy.command_inout.return_value = (None, ["Foo_B"])
+    assert split_server_pattern(proxy, "Foo\\_%") == ["Foo\\_B%"]
+    assert "LEFT(server, 5)" in proxy.command_inout.call_args[0][1]
+    assert split_server_pattern(proxy, "Foo%Bar%") is None
+
+
+SERVER_CACHE = [
+    # admin device import info
+    "dserver/TangoTest/1", "IOR:0123", "5", "host", "1", "123",
+    # admin device properties
+    "dserver/TangoTest/1", "1", "polling_threads_pool_size", "1", "2",
+    # class list and class properties
+    "1", "TangoTest",
+    "TangoTest", "1", "cvs_location", "1", "x",
+    "TangoTest", "0",
+    # device list
+    "TangoTest", "2", "sys/tg_test/1", "sys/tg_test/2",
+    # devices
+    "sys/tg_test/1", "2", "prop1", "2", "a", "b",
+    "__SubDevices", "1", "sys/tg_test/2",
+    "sys/tg_test/1", "1", "ampli", "1", "unit", "1", "V",
+    "sys/tg_test/2", "0",
+    "sys/tg_test/2", "0",
+]
+
+
+def make_server_cache_proxy(cache_result):
+
+    def command_inout(cmd, arg):
+        if cmd == "DbGetDataForServerCache":
+            assert arg == ["TangoTest/1", ""]
+            if isinstance(cache_result, Exception):
+                raise cache_result
+            return cache_result
+        assert "server = 'TangoTest/1'" in arg
+        return None, ["TangoTest/1", "DServer", "dserver/TangoTest/1", "",
+                      "TangoTest/1", "TangoTest", "sys/tg_test/1", "tg",
+                      "TangoTest/1", "TangoTest", "sys/tg_test/2", ""]
+
+    proxy = Mock()
+    proxy.command_inout.side_effect = command_inout
+    return proxy
+
+
+def test_get_servers_from_server_cache():
+    proxy = make_server_cache_proxy(SERVER_CACHE)
+    servers, failed = get_servers_from_server_cache(
+        proxy, ["TangoTest/1"], dservers=True)
+    assert failed == []
+    assert servers.to_dict() == {
+        "TangoTest": {
+            "1": {
+                "DServer": {
+                    "dserver/TangoTest/1": {
+                        "properties": {"polling_threads_pool_size": ["2"]}
+                    }
+                },
+                "TangoTest": {
+                    "sys/tg_test/1": {
+                        "alias": "tg",
+                        "properties": {"prop1": ["a", "b"]},
+                        "attribute_properties": {"ampli": {"unit": ["V"]}}
+                    },
+                    "sys/tg_test/2": {}
+                }
+            }
+        }
+    }
+
+
+def test_get_servers_from_server_cache_falls_back():
+    error = PyTango.DevError()
+    error.reason = "API_CommandNotFound"
+    proxy = make_server_cache_proxy(PyTango.DevFailed(error))
+    servers, failed = get_servers_from_server_cache(proxy, ["TangoTest/1"])
+    assert failed == ["TangoTest/1"]
+    assert servers.to_dict() == {}
+
+    # a result that doesn't contain the devices can't be used
+    proxy = make_server_cache_proxy(SERVER_CACHE[:-4])
+    servers, failed = get_servers_from_server_cache(proxy, ["TangoTest/1"])
+    assert failed == ["TangoTest/1"]
+
+
+def test_get_dict_from_db_server_cache():
+    db = create_autospec(PyTango.Database)
+    proxy = make_server_cache_proxy(SERVER_CACHE)
+    data = {
+        "servers": {
+            "TangoTest": {
+                "1": {
+                    "TangoTest": {
+                        "sys/tg_test/1": {
+                            "attribute_properties": {
+                                "ampli": {"unit": ["mV"]}
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+    with patch("dsconfig.tangodb.tango.DeviceProxy", return_value=proxy):
+        dbdict, _ = get_dict_from_db(db, data, server_cache=True)
+    assert dbdict["servers"]["TangoTest"]["1"]["TangoTest"] == {
+        "sys/tg_test/1": {
+            "alias": "tg",
+            "properties": {"prop1": ["a", "b"]},
+            "attribute_properties": {"ampli": {"unit": ["V"]}}
+        },
+        "sys/tg_test/2": {}
+    }
+    assert not db.get_device_property.called
+
+
+def test_get_database():
+    with patch("dsconfig.tangodb.HostDatabase") as HostDatabase:
+        db = get_database("replica.example.com:10000")
+    HostDatabase.assert_called_once_with("replica.example.com", 10000)
+    assert db is HostDatabase.return_value
+    with pytest.raises(ValueError):
+        get_database("replica.example.com")
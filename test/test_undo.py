@@ -0,0 +1,67 @@
+from io import StringIO
+
+from unittest.mock import Mock
+
+from dsconfig.undo import get_undo_calls, save_undo_calls, load_undo_calls
+
+from .helpers import make_devinfo
+
+
+ORIGINAL = {
+    "servers": {
+        "TangoTest": {
+            "1": {
+                "TangoTest": {
+                    "a/b/c": {
+                        "alias": "old_alias",
+                        "properties": {"x": ["1"], "y": ["2"]},
+                        "attribute_properties": {"attr": {"unit": ["V"]}}
+                    },
+                    "a/b/d": {"properties": {"z": ["3"]}}
+                }
+            }
+        }
+    },
+    "classes": {"TangoTest": {"properties": {"w": ["4"]}}}
+}
+
+
+def test_get_undo_calls():
+    calls = [
+        ("add_device", (make_devinfo("a/b/e", "TangoTest/1", "TangoTest"),),
+         {}),
+        ("put_device_property", ("a/b/e", {"q": ["5"]}), {}),
+        ("delete_device_property", ("a/b/c", {"y": ["2"]}), {}),
+        ("put_device_property", ("A/B/C", {"x": ["10"], "n": ["6"]}), {}),
+        ("put_device_attribute_property",
+         ("a/b/c", {"attr": {"unit": ["mV"], "format": ["%d"]}}), {}),
+        ("put_device_alias", ("a/b/c", "new_alias"), {}),
+        ("delete_device", ("a/b/d",), {}),
+        ("put_class_property", ("TangoTest", {"w": ["7"]}), {}),
+    ]
+    undo = get_undo_calls(calls, ORIGINAL, difactory=Mock)
+    readd = undo[1][1][0]
+    assert (readd.name, readd.server, readd._class) == (
+        "a/b/d", "TangoTest/1", "TangoTest")
+    assert undo[:1] + undo[2:] == [
+        ("put_class_property", ("TangoTest", {"w": ["4"]}), {}),
+        ("put_device_property", ("a/b/d", {"z": ["3"]}), {}),
+        ("put_device_alias", ("a/b/c", "old_alias"), {}),
+        ("delete_device_attribute_property",
+         ("a/b/c", {"attr": {"format": ["%d"]}}), {}),
+        ("put_device_attribute_property",
+         ("a/b/c", {"attr": {"unit": ["V"]}}), {}),
+        ("delete_device_property", ("A/B/C", {"n": ["6"]}), {}),
+        ("put_device_property", ("A/B/C", {"x": ["1"]}), {}),
+        ("put_device_property", ("a/b/c", {"y": ["2"]}), {}),
+        ("delete_device_property", ("a/b/e", {"q": ["5"]}), {}),
+        ("delete_device", ("a/b/e",), {}),
+    ]
+
+
+def test_save_and_load_undo_calls():
+    calls = [("put_device_property", ("a/b/c", {"x": ["1"]}), {})]
+    f = StringIO()
+    save_undo_calls(calls, f)
+    f.seek(0)
+    assert load_undo_calls(f) == calls
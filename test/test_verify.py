@@ -0,0 +1,111 @@
+from unittest.mock import MagicMock, patch
+
+from dsconfig.verify import (get_config_subset, verify_calls, find_stale,
+                             read_entity_digests)
+
+
+CONFIG = {
+    "servers": {
+        "TangoTest": {
+            "1": {
+                "TangoTest": {
+                    "a/b/c": {"properties": {"x": ["1"]}},
+                    "a/b/d": {"properties": {"y": ["2"]}},
+                },
+                "Other": {"a/b/e": {}}
+            }
+        }
+    },
+    "classes": {
+        "TangoTest": {"properties": {"z": ["3"]}},
+        "Other": {"properties": {"w": ["4"]}}
+    }
+}
+
+
+def test_get_config_subset():
+    subset = get_config_subset(CONFIG, {"a/b/c"}, {"tangotest"})
+    assert subset == {
+        "servers": {"TangoTest": {"1": {"TangoTest": {
+            "a/b/c": {"properties": {"x": ["1"]}}}}}},
+        "classes": {"TangoTest": {"properties": {"z": ["3"]}}}
+    }
+
+
+def test_get_config_subset_keeps_classes_in_db():
+    dbdata = {"servers": {"tangotest": {"1": {"other": {"a/b/f": {}}}}}}
+    subset = get_config_subset(CONFIG, set(), set(), dbdata)
+    assert subset["servers"] == {"TangoTest": {"1": {"Other": {}}}}
+
+
+def test_verify_calls():
+    calls = [("put_device_property", ("a/b/c", {"x": ["1"]}), {}),
+             ("delete_device", ("a/b/f",), {})]
+    dbdata = {
+        "servers": {"TangoTest": {"1": {
+            "TangoTest": {"a/b/c": {"properties": {"x": ["1"]}}},
+            # this one should have been deleted
+            "Other": {"a/b/f": {}}
+        }}},
+        "classes": {}
+    }
+    with patch("dsconfig.verify.get_db_data_for_scope",
+               return_value=dbdata) as get_data:
+        remaining, n_devices, n_classes = verify_calls(MagicMock(), CONFIG,
+                                                       calls)
+    _, kwargs = get_data.call_args
+    assert kwargs["devices"] == {"a/b/c", "a/b/f"}
+    assert (n_devices, n_classes) == (2, 0)
+    assert remaining == [("delete_device", ("a/b/f",), {})]
+
+
+def test_find_stale():
+    calls = [("put_device_property", ("a/b/c", {"x": ["2"]}), {}),
+             ("put_device_property", ("a/b/d", {"y": ["3"]}), {}),
+             ("delete_device_alias", ("my_alias",), {}),
+             ("put_class_property", ("TangoTest", {"z": ["4"]}), {})]
+    replica = {
+        "servers": {"TangoTest": {"1": {"TangoTest": {
+            "a/b/c": {"properties": {"x": ["1"]}},
+            "a/b/d": {"properties": {"y": ["2"]}},
+            "a/b/e": {"alias": "my_alias"},
+        }}}},
+        "classes": {"TangoTest": {"properties": {"z": ["3"]}}}
+    }
+    primary = {
+        "servers": {"TangoTest": {"1": {"TangoTest": {
+            "a/b/c": {"properties": {"x": ["1"]}},
+            # changed after the replica was read
+            "a/b/d": {"properties": {"y": ["5"]}},
+        }}}},
+        "classes": {"TangoTest": {"properties": {"z": ["3"]}}}
+    }
+    with patch("dsconfig.verify.get_db_data_for_scope",
+               return_value=primary) as get_data:
+        stale = find_stale(MagicMock(), replica, calls)
+    _, kwargs = get_data.call_args
+    assert kwargs["devices"] == {"a/b/c", "a/b/d"}
+    assert kwargs["device_aliases"] == {"my_alias"}
+    # a/b/e has lost its alias in the primary
+    assert stale == ["a/b/d", "a/b/e"]
+
+
+def test_find_stale_nothing_changed():
+    calls = [("put_device_property", ("a/b/c", {"x": ["2"]}), {})]
+    dbdata = {"servers": {"TangoTest": {"1": {"TangoTest": {
+        "a/b/c": {"properties": {"x": ["1"]}}}}}}, "classes": {}}
+    with patch("dsconfig.verify.get_db_data_for_scope", return_value=dbdata):
+        assert find_stale(MagicMock(), dbdata, calls) == []
+
+
+def test_read_entity_digests():
+    keys = {("device", "a/b/c"), ("class", "tangotest")}
+    dbdata = {"servers": {"TangoTest": {"1": {"TangoTest": {
+        "a/b/c": {"properties": {"x": ["1"]}}}}}}, "classes": {}}
+    with patch("dsconfig.verify.get_db_data_for_scope",
+               return_value=dbdata) as get_data:
+        digests = read_entity_digests(MagicMock(), keys)
+    _, kwargs = get_data.call_args
+    assert kwargs["devices"] == {"a/b/c"}
+    assert kwargs["classes"] == {"tangotest"}
+    assert set(digests) == keys
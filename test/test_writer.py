@@ -0,0 +1,282 @@
+from unittest.mock import Mock
+
+import PyTango
+import pytest
+
+from dsconfig.writer import (BatchWriter, ConflictChecker, FailureReport,
+                             RateLimiter, encode_properties, group_calls,
+                             make_call, write_concurrently, write_stream)
+
+
+def test_encode_properties():
+    assert encode_properties("a/b/c", {"a": ["1", "2"], "b": "3"}) == [
+        "a/b/c", "2", "a", "2", "1", "2", "b", "1", "3"]
+
+
+def test_batch_writer_combines_property_writes():
+    db = Mock()
+    proxy = Mock()
+    writer = BatchWriter(db, dbproxy=proxy)
+    writer.write("put_device_property", ("a/b/c", {"x": ["1"]}), {})
+    writer.write("put_device_attribute_property",
+                 ("a/b/c", {"attr": {"unit": ["V"]}}), {})
+    writer.write("put_device_property", ("a/b/d", {"y": ["2", "3"]}), {})
+    writer.write("put_device_property", ("A/B/C", {"z": ["4"]}), {})
+    writer.write("put_class_property", ("SomeClass", {"w": ["5"]}), {})
+    assert not proxy.command_inout.called
+    writer.flush()
+
+    db.put_device_attribute_property.assert_called_once_with(
+        "a/b/c", {"attr": {"unit": ["V"]}})
+    assert proxy.command_inout.call_count == 2
+    proxy.command_inout.assert_any_call(
+        "DbPutDeviceProperty",
+        ["2", "a/b/c", "2", "x", "1", "1", "z", "1", "4",
+         "a/b/d", "1", "y", "2", "2", "3"])
+    proxy.command_inout.assert_any_call(
+        "DbPutClassProperty", ["1", "SomeClass", "1", "w", "1", "5"])
+    assert writer.commands == 3
+
+
+def test_batch_writer_keeps_order_for_same_device():
+    calls = []
+    db = Mock()
+    db.delete_device.side_effect = lambda *args: calls.append("delete")
+    proxy = Mock()
+    proxy.command_inout.side_effect = lambda *args: calls.append("put")
+    writer = BatchWriter(db, dbproxy=proxy)
+    writer.write("put_device_property", ("a/b/c", {"x": ["1"]}), {})
+    writer.write("delete_device", ("A/B/C",), {})
+    writer.flush()
+    assert calls == ["put", "delete"]
+
+
+def test_batch_writer_limits_size():
+    proxy = Mock()
+    writer = BatchWriter(Mock(), dbproxy=proxy, max_size=20)
+    for i in range(3):
+        writer.write("put_device_property",
+                     ("a/b/%d" % i, {"prop": ["value"]}), {})
+    writer.flush()
+    assert proxy.command_inout.call_count == 3
+
+
+def test_rate_limiter_adapts_delay():
+    now = [0]
+    sleeps = []
+    limiter = RateLimiter(min_delay=0.01, target=0.1, step=0.01,
+                          clock=lambda: now[0], sleep=sleeps.append)
+
+    def call(latency):
+        now[0] += latency
+
+    # slow calls; back off
+    limiter.call(call, 0.5)
+    limiter.call(call, 0.5)
+    assert limiter.delay == 0.04
+    # fast calls; speed up again, but not beyond the minimum
+    for _ in range(5):
+        limiter.call(call, 0.001)
+    assert limiter.delay == 0.01
+    assert sleeps == pytest.approx([0.01, 0.02, 0.04, 0.03, 0.02, 0.01, 0.01])
+
+
+def test_rate_limiter_backs_off_on_errors():
+    limiter = RateLimiter(step=0.01, sleep=lambda t: None)
+    failing = Mock(side_effect=PyTango.DevFailed())
+    with pytest.raises(PyTango.DevFailed):
+        limiter.call(failing)
+    assert limiter.delay == 0.01
+    assert limiter.errors == 1
+
+
+def test_group_calls():
+    devinfo = Mock()
+    devinfo.name = "A/B/C"
+    calls = [
+        ("add_device", (devinfo,), {}),
+        ("put_device_property", ("a/b/d", {"x": ["1"]}), {}),
+        ("put_device_property", ("a/b/c", {"x": ["1"]}), {}),
+        ("put_class_property", ("SomeClass", {"x": ["1"]}), {}),
+        ("delete_device_alias", ("my_alias",), {}),
+        ("put_device_alias", ("a/b/d", "my_alias"), {}),
+        ("delete_server", ("SomeServer/1",), {}),
+        ("delete_device", ("a/b/e",), {}),
+    ]
+    assert group_calls(calls) == [[[0, 2], [1, 4, 5], [3]], [[6]], [[7]]]
+
+
+def test_write_concurrently():
+    dbs = []
+
+    def db_factory():
+        db = Mock()
+        dbs.append(db)
+        return db
+
+    calls = [("put_device_property", ("a/b/%d" % i, {"x": ["1"]}), {})
+             for i in range(20)]
+    progress = []
+    write_concurrently(calls, db_factory, jobs=4,
+                       progress=lambda n, total: progress.append(n))
+    assert 1 <= len(dbs) <= 4
+    written = [args[0] for db in dbs
+               for args, _ in db.put_device_property.call_args_list]
+    assert sorted(written) == sorted(args[0] for _, args, _ in calls)
+    assert progress == list(range(1, 21))
+
+
+def test_write_concurrently_stops_on_error():
+    db = Mock()
+    db.delete_device.side_effect = PyTango.DevFailed()
+    calls = [("delete_device", ("a/b/c",), {}),
+             ("put_device_property", ("a/b/c", {"x": ["1"]}), {})]
+    with pytest.raises(PyTango.DevFailed):
+        write_concurrently(calls, lambda: db, jobs=2)
+    assert not db.put_device_property.called
+
+
+def test_write_stream():
+    made = []
+    db = Mock()
+    db.put_device_property.side_effect = lambda name, props: made.append(
+        (name, props["x"][0]))
+    db.delete_server.side_effect = lambda name: made.append((name, None))
+
+    def calls():
+        for i in range(50):
+            yield ("put_device_property", ("a/b/%d" % (i % 5), {"x": [i]}), {})
+        yield ("delete_server", ("SomeServer/1",), {})
+        yield ("put_device_property", ("a/b/0", {"x": [50]}), {})
+
+    started = []
+    progress = []
+    n = write_stream(calls(), lambda: db, jobs=4, started=started,
+                     progress=progress.append, max_pending=3)
+    assert n == 52
+    assert len(started) == 52
+    assert progress == list(range(1, 53))
+    # the calls for each device were made in order
+    for i in range(5):
+        values = [value for name, value in made if name == "a/b/%d" % i]
+        assert values == sorted(values)
+    # everything waited for the call we know nothing about
+    assert made.index(("SomeServer/1", None)) == 50
+    assert made[-1] == ("a/b/0", 50)
+
+
+def test_write_stream_stops_on_error():
+    db = Mock()
+    db.delete_device.side_effect = PyTango.DevFailed()
+    calls = iter([("delete_device", ("a/b/c",), {}),
+                  ("put_device_property", ("a/b/c", {"x": ["1"]}), {})])
+    with pytest.raises(PyTango.DevFailed):
+        write_stream(calls, lambda: db, jobs=2)
+    assert not db.put_device_property.called
+
+
+def make_devfailed(reason, desc="Something went wrong"):
+    err = PyTango.DevError()
+    err.reason = reason
+    err.desc = desc
+    return PyTango.DevFailed(err)
+
+
+def test_make_call_retries_transient_errors():
+    sleeps = []
+    func = Mock(side_effect=[make_devfailed("API_DeviceTimedOut"),
+                             make_devfailed("API_DeviceTimedOut"), "ok"])
+    assert make_call(func, ("a",), {}, retries=3,
+                     sleep=sleeps.append) == "ok"
+    assert sleeps == [0.5, 1.0]
+
+    func = Mock(side_effect=make_devfailed("DB_SQLError"))
+    with pytest.raises(PyTango.DevFailed):
+        make_call(func, ("a",), {}, retries=3, sleep=sleeps.append)
+    assert func.call_count == 1
+
+
+def test_write_concurrently_keeps_going():
+    def put_device_property(name, props):
+        if name == "a/b/c":
+            raise make_devfailed("DB_SQLError", "Oops")
+
+    db = Mock()
+    db.put_device_property.side_effect = put_device_property
+    calls = [("put_device_property", ("a/b/c", {"x": ["1"]}), {}),
+             ("put_device_alias", ("a/b/c", "my_alias"), {}),
+             ("put_device_property", ("a/b/d", {"x": ["1"]}), {}),
+             ("put_device_alias", ("a/b/d", "other_alias"), {})]
+    report = FailureReport()
+    write_concurrently(calls, lambda: db, jobs=2, report=report)
+    assert report
+    db.put_device_alias.assert_called_once_with("a/b/d", "other_alias")
+    assert report.to_dict() == {
+        "failed": [{"index": 0, "method": "put_device_property",
+                    "concerns": ["device a/b/c"],
+                    "error": "DB_SQLError: Oops"}],
+        "conflicts": [],
+        "skipped": [{"index": 1, "method": "put_device_alias",
+                     "concerns": ["device a/b/c", "alias my_alias"]}],
+    }
+
+
+def test_write_stream_keeps_going():
+    db = Mock()
+    db.delete_device.side_effect = make_devfailed("DB_SQLError")
+    calls = iter([("delete_device", ("a/b/c",), {}),
+                  ("put_device_property", ("a/b/c", {"x": ["1"]}), {}),
+                  ("put_device_property", ("a/b/d", {"x": ["1"]}), {})])
+    report = FailureReport()
+    write_stream(calls, lambda: db, jobs=2, report=report)
+    db.put_device_property.assert_called_once_with("a/b/d", {"x": ["1"]})
+    assert len(report.failed) == 1
+    assert len(report.skipped) == 1
+
+
+def test_conflict_checker_checks_ahead():
+    calls = [("put_device_property", ("a/b/c", {"x": ["1"]}), {}),
+             ("put_device_property", ("a/b/d", {"x": ["1"]}), {}),
+             ("put_class_property", ("MyClass", {"y": ["2"]}), {}),
+             ("put_device_property", ("a/b/e", {"x": ["1"]}), {})]
+    digests = {("device", "a/b/c"): "1", ("device", "a/b/d"): "2",
+               ("class", "myclass"): "3", ("device", "a/b/e"): "4"}
+    current = dict(digests)
+    current[("device", "a/b/d")] = "changed"
+    read = Mock(side_effect=lambda keys: dict((key, current[key])
+                                              for key in keys))
+    checker = ConflictChecker(calls, digests, read, window=3)
+    assert checker.check(0) == []
+    assert checker.check(1) == [("device", "a/b/d")]
+    assert checker.check(2) == []
+    assert checker.check(3) == []
+    assert [set(args[0]) for args, _ in read.call_args_list] == [
+        {("device", "a/b/c"), ("device", "a/b/d"), ("class", "myclass")},
+        {("device", "a/b/e")}]
+
+
+def test_write_concurrently_skips_conflicts():
+    db = Mock()
+    calls = [("put_device_property", ("a/b/c", {"x": ["1"]}), {}),
+             ("put_device_alias", ("a/b/c", "my_alias"), {}),
+             ("put_device_property", ("a/b/d", {"x": ["1"]}), {})]
+    digests = {("device", "a/b/c"): "1", ("device", "a/b/d"): "2"}
+    checker = ConflictChecker(
+        calls, digests, lambda keys: {("device", "a/b/c"): "changed",
+                                      ("device", "a/b/d"): "2"})
+    report = FailureReport(keep_going=False, checker=checker)
+    write_concurrently(calls, lambda: db, jobs=2, report=report)
+    db.put_device_property.assert_called_once_with("a/b/d", {"x": ["1"]})
+    assert not db.put_device_alias.called
+    assert report
+    assert [i for i, _ in report.conflicts] == [0]
+    assert [i for i, _ in report.skipped] == [1]
+
+
+def test_write_concurrently_stops_without_keep_going():
+    db = Mock()
+    db.put_device_property.side_effect = make_devfailed("DB_SQLError")
+    calls = [("put_device_property", ("a/b/c", {"x": ["1"]}), {})]
+    report = FailureReport(keep_going=False)
+    with pytest.raises(PyTango.DevFailed):
+        write_concurrently(calls, lambda: db, jobs=2, report=report)